@@ -0,0 +1,230 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import time
+from collections import deque
+from typing import Callable, Deque, Optional
+
+from opentelemetry import metrics
+
+logger = logging.getLogger("azureaiapp")
+meter = metrics.get_meter(__name__)
+
+
+class AdmissionRejected(Exception):
+    """
+    The request was not admitted because the wait queue is full or the wait timed out.
+
+    :param retry_after: The number of seconds after which the client should retry.
+    """
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SharedRunCounter:
+    """
+    The number of runs active in all the workers forked from the process which created it.
+
+    :param limit: The maximal number of runs in all the workers.
+    """
+
+    def __init__(self, limit: int) -> None:
+        """Constructor."""
+        self.limit = limit
+        self._value = multiprocessing.Value('i', 0)
+
+    def try_increment(self) -> bool:
+        """Take a slot if one is free."""
+        with self._value.get_lock():
+            if self._value.value >= self.limit:
+                return False
+            self._value.value += 1
+            return True
+
+    def decrement(self) -> None:
+        """Free the slot."""
+        with self._value.get_lock():
+            self._value.value -= 1
+
+
+class AdmissionController:
+    """
+    The limit of concurrent agent runs with a bounded FIFO wait queue.
+
+    The limit adapts to the upstream service: every throttled run halves it, at most once
+    per cooldown, and every successful run raises it by increase / limit, so it grows by
+    about increase per limit runs (additive increase, multiplicative decrease).
+
+    :param limit: The initial number of concurrent runs.
+    :param min_limit: The lowest limit the throttling can set.
+    :param max_limit: The highest limit the successful runs can set.
+    :param max_queue: The maximal number of requests waiting for a slot.
+    :param queue_timeout: The maximal time in seconds a request waits for a slot.
+    :param decrease: The factor applied to the limit when the service throttles.
+    :param increase: The amount the limit grows by over limit successful runs.
+    :param cooldown: The time in seconds after a decrease during which throttling is ignored.
+    :param shared: The counter of the runs in all the workers, None to limit only this worker.
+    :param clock: The monotonic clock.
+    """
+
+    _SHARED_POLL_INTERVAL = 0.05
+    _SMOOTHING = 0.1
+
+    def __init__(
+            self,
+            limit: int = 16,
+            min_limit: int = 1,
+            max_limit: int = 64,
+            max_queue: int = 64,
+            queue_timeout: float = 30.0,
+            decrease: float = 0.5,
+            increase: float = 1.0,
+            cooldown: float = 5.0,
+            shared: Optional[SharedRunCounter] = None,
+            clock: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        if not 1 <= min_limit <= limit <= max_limit:
+            raise ValueError("The limits must satisfy 1 <= min_limit <= limit <= max_limit.")
+        self._limit = float(limit)
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout
+        self._decrease = decrease
+        self._increase = increase
+        self._cooldown = cooldown
+        self._shared = shared
+        self._clock = clock
+        self._waiters: Deque[asyncio.Future[None]] = deque()
+        self._last_decrease = -math.inf
+        self._average_run: Optional[float] = None
+        self.active = 0
+        self.rejected = 0
+        self._wait_histogram = meter.create_histogram(
+            "admission.wait_time", unit="ms", description="The time a chat request waited for a run slot.")
+        self._rejected_counter = meter.create_counter(
+            "admission.rejected", description="The number of chat requests rejected with 503.")
+        meter.create_observable_gauge(
+            "admission.queue_depth", callbacks=[self._observe_queue_depth],
+            description="The number of chat requests waiting for a run slot.")
+        meter.create_observable_gauge(
+            "admission.limit", callbacks=[self._observe_limit],
+            description="The current number of concurrent runs allowed.")
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def _observe_queue_depth(self, options):
+        yield metrics.Observation(self.queue_depth)
+
+    def _observe_limit(self, options):
+        yield metrics.Observation(self.limit)
+
+    def retry_after(self) -> int:
+        """Return the estimated number of seconds until a slot frees up for a new request."""
+        average_run = self._average_run or 10.0
+        return min(max(math.ceil(average_run * (self.queue_depth + 1) / self.limit), 1), 60)
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        self.rejected += 1
+        self._rejected_counter.add(1, {"reason": reason})
+        return AdmissionRejected(f"The chat is busy ({reason}), please retry later.", self.retry_after())
+
+    def _try_take(self) -> bool:
+        if self.active >= self.limit:
+            return False
+        if self._shared is not None and not self._shared.try_increment():
+            return False
+        self.active += 1
+        return True
+
+    async def acquire(self) -> float:
+        """
+        Wait for a run slot.
+
+        :return: The time in seconds the request waited.
+        :raises AdmissionRejected: If the queue is full or the wait timed out.
+        """
+        start = self._clock()
+        if not self._waiters and self._try_take():
+            self._wait_histogram.record(0.0)
+            return 0.0
+        if len(self._waiters) >= self._max_queue:
+            raise self._reject("queue_full")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        deadline = start + self._queue_timeout
+        try:
+            while True:
+                timeout = deadline - self._clock()
+                if timeout <= 0:
+                    raise self._reject("timeout")
+                # Only the workers of the shared counter can free a slot without waking this worker.
+                if self._shared is not None:
+                    timeout = min(timeout, AdmissionController._SHARED_POLL_INTERVAL)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                if self._waiters[0] is waiter and self._try_take():
+                    break
+                if waiter.done():
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters[0] = waiter
+        finally:
+            self._waiters.remove(waiter)
+            self._wake()
+        waited = self._clock() - start
+        self._wait_histogram.record(waited * 1000)
+        return waited
+
+    def release(self, duration: Optional[float] = None, throttled: bool = False) -> None:
+        """
+        Free the run slot.
+
+        :param duration: The duration of the run in seconds, used to estimate Retry-After.
+        :param throttled: True if the service throttled the run.
+        """
+        if self.active == 0:
+            # Freeing a slot which was not taken would count as a successful run and raise the limit.
+            logger.warning("Ignoring the release of a run slot which was not acquired")
+            return
+        self.active -= 1
+        if self._shared is not None:
+            self._shared.decrement()
+        if duration is not None:
+            if self._average_run is None:
+                self._average_run = duration
+            else:
+                self._average_run += AdmissionController._SMOOTHING * (duration - self._average_run)
+        if throttled:
+            self.on_throttled()
+        else:
+            self._limit = min(self._limit + self._increase / self._limit, self._max_limit)
+        self._wake()
+
+    def on_throttled(self) -> None:
+        """Decrease the limit after the service has throttled a run."""
+        now = self._clock()
+        if now - self._last_decrease < self._cooldown:
+            return
+        self._last_decrease = now
+        self._limit = max(self._limit * self._decrease, self._min_limit)
+        logger.warning(f"Agent service is throttling, concurrent run limit decreased to {self.limit}")
+
+    def _wake(self) -> None:
+        """Wake up the first waiter if there is a free slot."""
+        if self._waiters and self.active < self.limit and not self._waiters[0].done():
+            self._waiters[0].set_result(None)
@@ -0,0 +1,126 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class AsyncLRUCache(Generic[V]):
+    """
+    The bounded LRU cache with time to live and in-flight request coalescing.
+
+    Concurrent calls to get_or_load for the same key share one call of the loader,
+    so a burst of lookups for the same value results in a single round trip.
+    The cache is not thread safe and must be used from a single event loop.
+
+    :param maxsize: The maximal number of entries to keep.
+    :param ttl: The time to live of an entry in seconds. None means entries never expire.
+    :param clock: The monotonic clock used to expire entries.
+    """
+
+    def __init__(
+            self,
+            maxsize: int = 1024,
+            ttl: Optional[float] = 3600.0,
+            clock: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        if maxsize <= 0:
+            raise ValueError("maxsize must be a positive integer.")
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._clock = clock
+        self._data: OrderedDict[Hashable, Tuple[float, V]] = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Future[V]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._lookup(key) is not None
+
+    def _lookup(self, key: Hashable) -> Optional[Tuple[float, V]]:
+        """Return the live entry for the key, evicting it if it has expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= self._clock():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def get(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        """
+        Return the cached value or default if it is absent or expired.
+
+        :param key: The key of the value.
+        :param default: The value to return on a miss.
+        :return: The cached value.
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        """
+        Store the value, evicting the least recently used entries above maxsize.
+
+        :param key: The key of the value.
+        :param value: The value to store.
+        :param ttl: The time to live overriding the one given to the constructor.
+        """
+        ttl = self._ttl if ttl is None else ttl
+        expires = float("inf") if ttl is None else self._clock() + ttl
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """Remove the key from the cache if it is present."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        self._data.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> V:
+        """
+        Return the cached value or load it, sharing the load between concurrent callers.
+
+        Exceptions raised by the loader are propagated to every waiting caller
+        and are not cached.
+
+        :param key: The key of the value.
+        :param loader: The coroutine function used to obtain the value on a miss.
+        :return: The cached or the newly loaded value.
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, loader))
+            self._in_flight[key] = future
+        # Shield the shared load so that one cancelled caller does not cancel it for the others.
+        return await asyncio.shield(future)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> V:
+        try:
+            value = await loader()
+            self.set(key, value)
+            return value
+        finally:
+            self._in_flight.pop(key, None)
@@ -0,0 +1,125 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from opentelemetry import metrics, trace
+
+meter = metrics.get_meter(__name__)
+
+cancelled_runs_counter = meter.create_counter(
+    "chat.runs.cancelled", description="The number of runs cancelled because the client disconnected.")
+tokens_saved_counter = meter.create_counter(
+    "chat.tokens.saved", unit="{token}",
+    description="The estimated number of completion tokens not generated thanks to the cancelled runs.")
+
+time_to_first_token_histogram = meter.create_histogram(
+    "chat.time_to_first_token", unit="ms", description="The time from the chat request to the first message delta.")
+inter_token_gap_histogram = meter.create_histogram(
+    "chat.inter_token_gap", unit="ms", description="The time between the consecutive message deltas.")
+run_duration_histogram = meter.create_histogram(
+    "chat.run.duration", unit="ms", description="The time from the start of the run stream to its end.")
+tool_call_histogram = meter.create_histogram(
+    "chat.tool_call.duration", unit="ms", description="The duration of the tool call steps of the run.")
+annotation_histogram = meter.create_histogram(
+    "chat.annotation.duration", unit="ms", description="The time spent resolving the annotations of a message.")
+sse_bytes_histogram = meter.create_histogram(
+    "chat.sse.sent", unit="By", description="The number of bytes of server sent events sent by a response.")
+
+
+class RunTiming:
+    """
+    The timing of the events of one run, recorded to the histograms as they happen.
+
+    :param start: The time the chat request started, to measure the time to first token.
+    :param clock: The clock used to time the events.
+    """
+
+    def __init__(self, start: Optional[float] = None, clock: Callable[[], float] = time.perf_counter) -> None:
+        """Constructor."""
+        self._clock = clock
+        self.run_start = clock()
+        self.start = self.run_start if start is None else start
+        self.first_token: Optional[float] = None
+        self._last_token: Optional[float] = None
+        self.deltas = 0
+        self.tool_calls = 0
+        self.tool_call_seconds = 0.0
+        # The start time and the tool types of the steps in progress.
+        self._steps: Dict[str, Tuple[float, str]] = {}
+
+    def on_delta(self) -> None:
+        """Record the arrival of a message delta."""
+        now = self._clock()
+        self.deltas += 1
+        if self._last_token is None:
+            self.first_token = now
+            time_to_first_token_histogram.record((now - self.start) * 1000)
+        else:
+            inter_token_gap_histogram.record((now - self._last_token) * 1000)
+        self._last_token = now
+
+    def on_step(self, step_id: str, status: str, tool_type: Optional[str]) -> None:
+        """
+        Record the state of the run step.
+
+        :param step_id: The ID of the step.
+        :param status: The status of the step.
+        :param tool_type: The type of the tool called by the step or None if it does not call a tool.
+        """
+        if tool_type is None:
+            return
+        if status == "in_progress":
+            self._steps.setdefault(step_id, (self._clock(), tool_type))
+        elif step_id in self._steps:
+            started, tool_type = self._steps.pop(step_id)
+            duration = self._clock() - started
+            self.tool_calls += 1
+            self.tool_call_seconds += duration
+            tool_call_histogram.record(duration * 1000, {"tool": tool_type, "status": status})
+
+    def finish(self, span: trace.Span) -> None:
+        """Record the duration of the run and set the attributes of its span."""
+        duration = self._clock() - self.run_start
+        run_duration_histogram.record(duration * 1000)
+        span.set_attribute("run.duration_ms", duration * 1000)
+        span.set_attribute("run.deltas", self.deltas)
+        span.set_attribute("run.tool_calls", self.tool_calls)
+        span.set_attribute("run.tool_call_ms", self.tool_call_seconds * 1000)
+        if self.first_token is not None:
+            span.set_attribute("run.time_to_first_token_ms", (self.first_token - self.start) * 1000)
+
+
+class CompletionTokens:
+    """
+    The moving average of the completion tokens used by the completed runs.
+
+    It is used to estimate how many tokens the cancelled run would still have generated.
+    """
+
+    _SMOOTHING = 0.1
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self.average: Optional[float] = None
+
+    def record(self, tokens: int) -> None:
+        """Record the completion tokens of the completed run."""
+        if self.average is None:
+            self.average = float(tokens)
+        else:
+            self.average += CompletionTokens._SMOOTHING * (tokens - self.average)
+
+    def remaining(self, generated: int) -> int:
+        """
+        Return the estimated number of tokens the run would still generate.
+
+        :param generated: The number of tokens the run has already generated.
+        """
+        if self.average is None:
+            return 0
+        return max(int(self.average) - generated, 0)
+
+
+completion_tokens = CompletionTokens()
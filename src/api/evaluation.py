@@ -0,0 +1,180 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, List, NamedTuple
+
+from azure.ai.projects.aio import AIProjectClient
+from azure.ai.projects.models import (
+    AgentEvaluationRedactionConfiguration,
+    AgentEvaluationRequest,
+    AgentEvaluationSamplingConfiguration,
+    EvaluatorIds,
+)
+from opentelemetry import metrics
+
+logger = logging.getLogger("azureaiapp")
+meter = metrics.get_meter(__name__)
+
+
+def create_evaluation_request(thread_id: str, run_id: str, app_insights_conn_str: str) -> AgentEvaluationRequest:
+    """
+    Return the request of the evaluation of the run.
+
+    :param thread_id: The ID of the thread.
+    :param run_id: The ID of the completed run.
+    :param app_insights_conn_str: The Application Insights connection string receiving the results.
+    """
+    return AgentEvaluationRequest(
+        run_id=run_id,
+        thread_id=thread_id,
+        evaluators={
+            "Relevance": {"Id": EvaluatorIds.RELEVANCE.value},
+            "TaskAdherence": {"Id": EvaluatorIds.TASK_ADHERENCE.value},
+            "ToolCallAccuracy": {"Id": EvaluatorIds.TOOL_CALL_ACCURACY.value},
+        },
+        # The runs are sampled before they are queued.
+        sampling_configuration=AgentEvaluationSamplingConfiguration(
+            name="default",
+            sampling_percent=100,
+        ),
+        redaction_configuration=AgentEvaluationRedactionConfiguration(
+            redact_score_properties=False,
+        ),
+        app_insights_connection_string=app_insights_conn_str,
+    )
+
+
+class _EvaluationJob(NamedTuple):
+    thread_id: str
+    run_id: str
+    queued_at: float
+
+
+class EvaluationDispatcher:
+    """
+    The background queue of the agent evaluations.
+
+    The completed runs are sampled and queued without waiting, and a fixed number of
+    workers submit the evaluations no faster than per_minute. When the queue is full
+    the run is not evaluated. On close the queued evaluations are submitted until the
+    drain timeout.
+
+    :param ai_project: The project client creating the evaluations.
+    :param app_insights_conn_str: The Application Insights connection string receiving the results.
+    :param max_queue: The maximal number of queued evaluations.
+    :param workers: The number of concurrent evaluation requests.
+    :param per_minute: The maximal number of evaluation requests per minute.
+    :param sampling_percent: The percentage of the completed runs which are evaluated.
+    :param sample: The function returning a random number in [0, 1).
+    """
+
+    def __init__(
+            self,
+            ai_project: AIProjectClient,
+            app_insights_conn_str: str,
+            max_queue: int = 1000,
+            workers: int = 2,
+            per_minute: float = 60.0,
+            sampling_percent: float = 100.0,
+            sample: Callable[[], float] = random.random
+        ) -> None:
+        """Constructor."""
+        self._ai_project = ai_project
+        self._app_insights_conn_str = app_insights_conn_str
+        self._queue: asyncio.Queue[_EvaluationJob] = asyncio.Queue(maxsize=max_queue)
+        self._workers = workers
+        self._interval = 60.0 / per_minute
+        self._next_request = 0.0
+        self._sampling_percent = sampling_percent
+        self._sample = sample
+        self._tasks: List[asyncio.Task[None]] = []
+        self.submitted = 0
+        self.dropped = 0
+        self.failed = 0
+        self._submitted_counter = meter.create_counter(
+            "evaluation.submitted", description="The number of agent evaluations created.")
+        self._dropped_counter = meter.create_counter(
+            "evaluation.dropped", description="The number of completed runs which were not evaluated.")
+        self._latency_histogram = meter.create_histogram(
+            "evaluation.latency", unit="ms", description="The time from the end of the run to the evaluation request.")
+        meter.create_observable_gauge(
+            "evaluation.queue_depth", callbacks=[self._observe_queue_depth],
+            description="The number of queued agent evaluations.")
+
+    def _observe_queue_depth(self, options):
+        yield metrics.Observation(self._queue.qsize())
+
+    def start(self) -> None:
+        """Start the workers."""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self._workers)]
+
+    def submit(self, thread_id: str, run_id: str) -> bool:
+        """
+        Queue the evaluation of the completed run.
+
+        :param thread_id: The ID of the thread.
+        :param run_id: The ID of the run.
+        :return: True if the evaluation was queued.
+        """
+        if self._sample() * 100 >= self._sampling_percent:
+            self._dropped_counter.add(1, {"reason": "sampling"})
+            return False
+        try:
+            self._queue.put_nowait(_EvaluationJob(thread_id, run_id, time.monotonic()))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._dropped_counter.add(1, {"reason": "queue_full"})
+            logger.warning(f"Evaluation queue is full, not evaluating run ID {run_id}")
+            return False
+        return True
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """
+        Submit the queued evaluations and stop the workers.
+
+        :param timeout: The maximal time in seconds to wait for the queued evaluations.
+        """
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                remaining = self._queue.qsize()
+                self.dropped += remaining
+                self._dropped_counter.add(remaining, {"reason": "shutdown"})
+                logger.warning(f"Dropping {remaining} queued evaluations at shutdown")
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+
+    async def _wait_for_rate_limit(self) -> None:
+        now = time.monotonic()
+        start = max(now, self._next_request)
+        self._next_request = start + self._interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._wait_for_rate_limit()
+                logger.info(f"Running agent evaluation on thread ID {job.thread_id} and run ID {job.run_id}")
+                agent_evaluation_response = await self._ai_project.evaluations.create_agent_evaluation(
+                    evaluation=create_evaluation_request(job.thread_id, job.run_id, self._app_insights_conn_str)
+                )
+                logger.info(f"Evaluation response: {agent_evaluation_response}")
+                self.submitted += 1
+                self._submitted_counter.add(1)
+                self._latency_histogram.record((time.monotonic() - job.queued_at) * 1000)
+            except Exception as e:
+                self.failed += 1
+                self._dropped_counter.add(1, {"reason": "error"})
+                logger.error(f"Error creating agent evaluation: {e}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,61 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import time
+from typing import Callable, Dict, List, Tuple
+
+from opentelemetry import metrics, trace
+
+meter = metrics.get_meter(__name__)
+phase_histogram = meter.create_histogram(
+    "chat.ttfb.phase", unit="ms",
+    description="The contribution of a phase of the chat request to the time to first byte.")
+
+
+class LatencyBreakdown:
+    """
+    The durations of the consecutive phases of a request.
+
+    Every call to mark closes the phase which started at the previous mark,
+    so the phases add up to the time elapsed since the breakdown was created.
+
+    :param clock: The monotonic clock used to time the phases.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter) -> None:
+        """Constructor."""
+        self._clock = clock
+        self.start = clock()
+        self._last = self.start
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, phase: str) -> float:
+        """
+        Close the current phase.
+
+        :param phase: The name of the phase which has just finished.
+        :return: The duration of the phase in seconds.
+        """
+        now = self._clock()
+        duration = now - self._last
+        self._last = now
+        self.phases.append((phase, duration))
+        return duration
+
+    def as_dict(self) -> Dict[str, float]:
+        """Return the duration of every phase in milliseconds."""
+        return {phase: duration * 1000 for phase, duration in self.phases}
+
+    def server_timing(self) -> str:
+        """Return the phases formatted as the value of the Server-Timing header."""
+        return ", ".join(f"{phase};dur={duration * 1000:.1f}" for phase, duration in self.phases)
+
+    def record(self, span: trace.Span) -> None:
+        """
+        Record the phases to the histogram and as the attributes of the span.
+
+        :param span: The span of the request.
+        """
+        for phase, duration in self.phases:
+            phase_histogram.record(duration * 1000, {"phase": phase})
+            span.set_attribute(f"latency.{phase}_ms", duration * 1000)
@@ -1,10 +1,15 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
 
+import asyncio
 import contextlib
 import os
+import time
+from typing import Optional
 
+from azure.ai.agents.models import Agent
 from azure.ai.projects.aio import AIProjectClient
+from azure.core.exceptions import ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
 
 import fastapi
@@ -12,21 +17,83 @@ from fastapi.staticfiles import StaticFiles
 from fastapi import Request
 from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
+from opentelemetry import metrics
 
+from bootstrap import BOOTSTRAP_DIRECTORY, BootstrapState, agent_digest, config_digest, shared_state
 from logging_config import configure_logging
+from shared_token import shared_credential
+from .evaluation import EvaluationDispatcher
+from .prometheus import PrometheusMetrics
+from .thread_pool import ThreadPool
 
 enable_trace = False
 logger = None
 
+meter = metrics.get_meter(__name__)
+time_to_ready_histogram = meter.create_histogram(
+    "startup.time_to_ready", unit="ms", description="The time from the start of the worker to serving requests.")
+
+
+async def find_agent_by_name(ai_project: AIProjectClient, agent_name: str) -> Optional[Agent]:
+    """
+    Return the agent with the name, or None.
+
+    :param ai_project: The project client.
+    :param agent_name: The name of the agent.
+    """
+    agent_list = ai_project.agents.list_agents()
+    if agent_list:
+        async for agent_object in agent_list:
+            if agent_object.name == agent_name:
+                logger.info(f"Found agent by name '{agent_name}', ID={agent_object.id}")
+                return agent_object
+    return None
+
+
+async def validate_agent(app: fastapi.FastAPI, ai_project: AIProjectClient, agent: Agent) -> None:
+    """
+    Check the agent of the bootstrap state after startup and replace it if it has changed.
+
+    :param app: The application using the agent.
+    :param ai_project: The project client.
+    :param agent: The agent read from the bootstrap state.
+    """
+    try:
+        current = await ai_project.agents.get_agent(agent.id)
+    except ResourceNotFoundError:
+        logger.error(f"The agent {agent.id} of the bootstrap state was not found, searching it by name")
+        current = await find_agent_by_name(ai_project, os.environ["AZURE_AI_AGENT_NAME"])
+        if current is None:
+            logger.error("No agent found. Ensure gunicorn.conf.py created one or set AZURE_EXISTING_AGENT_ID.")
+            return
+    except Exception as e:
+        logger.warning(f"Could not validate the agent {agent.id} of the bootstrap state: {e}")
+        return
+    if agent_digest(current) != agent_digest(agent):
+        logger.info(f"The agent {current.id} has changed since the bootstrap, using its current definition")
+        app.state.agent = current
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app: fastapi.FastAPI):
+    started = time.perf_counter()
     agent = None
+    agent_source = "service"
+    thread_pool = None
+    evaluation_dispatcher = None
+    validation_task = None
 
     proj_endpoint = os.environ.get("AZURE_EXISTING_AIPROJECT_ENDPOINT")
     agent_id = os.environ.get("AZURE_EXISTING_AGENT_ID")
     try:
+        # Under gunicorn the access token is acquired and refreshed by the master.
+        credential = shared_credential(lambda: DefaultAzureCredential(exclude_shared_token_cache_credential=True))
+        if credential is not None:
+            logger.info("Using the access token shared by the gunicorn master")
+        else:
+            credential = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
         ai_project = AIProjectClient(
-            credential=DefaultAzureCredential(exclude_shared_token_cache_credential=True),
+            credential=credential,
             endpoint=proj_endpoint,
             api_version = "2025-05-15-preview" # Evaluations yet not supported on stable (api_version="2025-05-01")
         )
@@ -49,7 +116,30 @@ async def lifespan(app: fastapi.FastAPI):
                 app.state.application_insights_connection_string = application_insights_connection_string
                 logger.info("Configured Application Insights for tracing.")
 
-        if agent_id:
+                # Evaluate the completed runs in the background.
+                evaluation_dispatcher = EvaluationDispatcher(
+                    ai_project,
+                    application_insights_connection_string,
+                    max_queue=int(os.getenv("EVALUATION_QUEUE_SIZE", "1000")),
+                    workers=int(os.getenv("EVALUATION_WORKERS", "2")),
+                    per_minute=float(os.getenv("EVALUATION_REQUESTS_PER_MINUTE", "60")),
+                    sampling_percent=float(os.getenv("EVALUATION_SAMPLING_PERCENT", "100")),
+                )
+                evaluation_dispatcher.start()
+                app.state.evaluation_dispatcher = evaluation_dispatcher
+
+        # The agent resolved by gunicorn on_starting, inherited from the master or read
+        # from the file, used without calling the service.
+        state = shared_state()
+        inherited = state is not None
+        if state is None:
+            state = BootstrapState.load(os.getenv("BOOTSTRAP_STATE", os.path.join(BOOTSTRAP_DIRECTORY, "state.json")))
+        if state is not None and state.matches(config_digest(), agent_id):
+            agent = state.agent
+            agent_source = "bootstrap_master" if inherited else "bootstrap_state"
+            logger.info(f"Using agent {agent.id} of the bootstrap state")
+
+        if not agent and agent_id:
             try: 
                 agent = await ai_project.agents.get_agent(agent_id)
                 logger.info("Agent already exists, skipping creation")
@@ -60,21 +150,32 @@ async def lifespan(app: fastapi.FastAPI):
 
         if not agent:
             # Fallback to searching by name
-            agent_name = os.environ["AZURE_AI_AGENT_NAME"]
-            agent_list = ai_project.agents.list_agents()
-            if agent_list:
-                async for agent_object in agent_list:
-                    if agent_object.name == agent_name:
-                        agent = agent_object
-                        logger.info(f"Found agent by name '{agent_name}', ID={agent_object.id}")
-                        break
+            agent = await find_agent_by_name(ai_project, os.environ["AZURE_AI_AGENT_NAME"])
 
         if not agent:
             raise RuntimeError("No agent found. Ensure qunicorn.py created one or set AZURE_EXISTING_AGENT_ID.")
 
         app.state.ai_project = ai_project
         app.state.agent = agent
-        
+
+        # Keep empty threads ready for the new chat sessions.
+        thread_pool = ThreadPool(
+            ai_project.agents,
+            size=int(os.getenv("THREAD_POOL_SIZE", "4")),
+            max_age=float(os.getenv("THREAD_POOL_MAX_AGE_SECONDS", "3600")),
+        )
+        thread_pool.start()
+        app.state.thread_pool = thread_pool
+
+        # The master has just resolved the agent it passed on, only the agent read from the
+        # file, e.g. written by a previous deployment, may have changed since.
+        if agent_source == "bootstrap_state":
+            validation_task = asyncio.create_task(validate_agent(app, ai_project, agent))
+
+        time_to_ready = (time.perf_counter() - started) * 1000
+        time_to_ready_histogram.record(time_to_ready, {"agent_source": agent_source})
+        logger.info(f"Worker {os.getpid()} ready in {time_to_ready:.0f} ms with the agent from the {agent_source}")
+
         yield
 
     except Exception as e:
@@ -82,6 +183,19 @@ async def lifespan(app: fastapi.FastAPI):
         raise RuntimeError(f"Error during startup: {e}")
 
     finally:
+        if validation_task is not None:
+            validation_task.cancel()
+        if evaluation_dispatcher is not None:
+            try:
+                await evaluation_dispatcher.close(
+                    timeout=float(os.getenv("EVALUATION_DRAIN_TIMEOUT_SECONDS", "10")))
+            except Exception:
+                logger.error("Error draining the evaluation queue", exc_info=True)
+        if thread_pool is not None:
+            try:
+                await thread_pool.close()
+            except Exception:
+                logger.error("Error closing the thread pool", exc_info=True)
         try:
             await ai_project.close()
             logger.info("Closed AIProjectClient")
@@ -116,6 +230,12 @@ def create_app():
 
     directory = os.path.join(os.path.dirname(__file__), "static")
     app = fastapi.FastAPI(lifespan=lifespan)
+
+    # Without Application Insights, the metrics are served locally on /metrics.
+    if not enable_trace and os.getenv("ENABLE_PROMETHEUS_METRICS", "true").lower() == "true":
+        app.state.prometheus_metrics = PrometheusMetrics()
+        logger.info("Serving the metrics on /metrics.")
+
     app.mount("/static", StaticFiles(directory=directory), name="static")
     
     # Mount React static files
@@ -0,0 +1,111 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import math
+import re
+from typing import Dict, List, Mapping, Optional
+
+from opentelemetry import metrics
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import (
+    Gauge,
+    Histogram,
+    InMemoryMetricReader,
+    MetricsData,
+    Sum,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_INVALID_NAME_CHARACTERS = re.compile(r"[^a-zA-Z0-9_:]")
+_UNITS = {"ms": "milliseconds", "s": "seconds", "By": "bytes"}
+
+
+def _metric_name(name: str, unit: str) -> str:
+    name = _INVALID_NAME_CHARACTERS.sub("_", name)
+    suffix = _UNITS.get(unit)
+    if suffix and not name.endswith(suffix):
+        name = f"{name}_{suffix}"
+    return name
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(attributes: Optional[Mapping], extra: Optional[Dict[str, str]] = None) -> str:
+    labels = {_INVALID_NAME_CHARACTERS.sub("_", k): v for k, v in (attributes or {}).items()}
+    labels.update(extra or {})
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics_data: Optional[MetricsData]) -> str:
+    """
+    Return the metrics in the Prometheus text exposition format.
+
+    :param metrics_data: The metrics collected by the reader with the cumulative temporality.
+    """
+    lines: List[str] = []
+    seen = set()
+    for resource_metrics in (metrics_data.resource_metrics if metrics_data else []):
+        for scope_metrics in resource_metrics.scope_metrics:
+            for metric in scope_metrics.metrics:
+                data = metric.data
+                name = _metric_name(metric.name, metric.unit)
+                if isinstance(data, Sum) and data.is_monotonic:
+                    kind = "counter"
+                    name = name if name.endswith("_total") else f"{name}_total"
+                elif isinstance(data, (Sum, Gauge)):
+                    kind = "gauge"
+                elif isinstance(data, Histogram):
+                    kind = "histogram"
+                else:
+                    continue
+                if name not in seen:
+                    seen.add(name)
+                    if metric.description:
+                        lines.append(f"# HELP {name} {_escape(metric.description)}")
+                    lines.append(f"# TYPE {name} {kind}")
+                for point in data.data_points:
+                    if kind != "histogram":
+                        lines.append(f"{name}{_labels(point.attributes)} {_number(point.value)}")
+                        continue
+                    cumulative = 0
+                    bounds = list(point.explicit_bounds) + [math.inf]
+                    for bound, count in zip(bounds, point.bucket_counts):
+                        cumulative += count
+                        le = _labels(point.attributes, {"le": _number(float(bound))})
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(point.attributes)} {_number(point.sum)}")
+                    lines.append(f"{name}_count{_labels(point.attributes)} {point.count}")
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusMetrics:
+    """
+    The local metrics of the worker, collected in memory and rendered on request.
+
+    It installs the global meter provider, so it is only used when no other exporter,
+    such as Application Insights, has installed one.
+    """
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self._reader = InMemoryMetricReader()
+        self._provider = MeterProvider(metric_readers=[self._reader])
+        metrics.set_meter_provider(self._provider)
+
+    def render(self) -> str:
+        """Return the current metrics in the Prometheus text exposition format."""
+        return render(self._reader.get_metrics_data())
+
+    def shutdown(self) -> None:
+        self._provider.shutdown()
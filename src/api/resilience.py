@@ -0,0 +1,266 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import logging
+import math
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from opentelemetry import metrics
+
+logger = logging.getLogger("azureaiapp")
+meter = metrics.get_meter(__name__)
+operation_histogram = meter.create_histogram(
+    "agent.operation.duration", unit="ms", description="The duration of a call to the agent service.")
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+def is_transient(error: BaseException) -> bool:
+    """Return True if the call may succeed when it is repeated."""
+    if isinstance(error, HttpResponseError) and error.status_code is not None:
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (ServiceRequestError, ServiceResponseError, asyncio.TimeoutError))
+
+
+class CircuitOpenError(Exception):
+    """
+    The call was not made because the operation has been failing.
+
+    :param retry_after: The number of seconds after which the operation is tried again.
+    """
+
+    def __init__(self, operation: str, retry_after: int) -> None:
+        super().__init__(f"The agent service operation {operation} is unavailable, please retry later.")
+        self.retry_after = retry_after
+
+
+class CircuitPermit:
+    """
+    The permission to make one call through a circuit breaker.
+
+    :param trial: True if the call is the trial call of the half-open circuit.
+    """
+
+    def __init__(self, trial: bool) -> None:
+        self.trial = trial
+
+
+class CircuitBreaker:
+    """
+    The circuit breaker of one operation.
+
+    After failure_threshold consecutive transient failures the circuit opens and the
+    calls fail at once. After reset_timeout one trial call is let through; its success
+    closes the circuit and its failure opens it again.
+
+    :param failure_threshold: The number of consecutive failures opening the circuit.
+    :param reset_timeout: The time in seconds the circuit stays open.
+    :param clock: The monotonic clock.
+    """
+
+    def __init__(
+            self,
+            failure_threshold: int = 5,
+            reset_timeout: float = 30.0,
+            clock: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def retry_after(self) -> int:
+        """Return the number of seconds until the next trial call."""
+        if self._opened_at is None:
+            return 0
+        return max(math.ceil(self._opened_at + self._reset_timeout - self._clock()), 1)
+
+    def allow(self) -> Optional[CircuitPermit]:
+        """Return the permission to make the call or None if the call may not be made."""
+        if self._opened_at is None:
+            return CircuitPermit(trial=False)
+        if self._trial or self._clock() < self._opened_at + self._reset_timeout:
+            return None
+        self._trial = True
+        return CircuitPermit(trial=True)
+
+    def release_trial(self, permit: CircuitPermit) -> None:
+        """
+        Let another trial call through if the call which did not complete was the trial call.
+
+        :param permit: The permission of the call.
+        """
+        if permit.trial:
+            self._trial = False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._trial or self._failures >= self._failure_threshold:
+            if self._opened_at is None or self._trial:
+                logger.warning(f"Opening the circuit after {self._failures} consecutive failures")
+            self._opened_at = self._clock()
+            self._trial = False
+
+
+class ResiliencePolicy:
+    """
+    The retry, circuit breaker and hedging policy of the calls to the agent service.
+
+    The idempotent calls are retried on transient errors with exponential backoff and
+    full jitter. The hedged calls are repeated, without cancelling the first one, when
+    the first one has not finished within the 95th percentile of the recent durations
+    of the operation, and the first result wins. Every operation has its own circuit
+    breaker and its durations are recorded to the agent.operation.duration histogram.
+
+    :param max_retries: The number of retries of the idempotent calls.
+    :param backoff: The base delay of the retries in seconds.
+    :param max_backoff: The maximal delay of the retries in seconds.
+    :param failure_threshold: The number of consecutive failures opening the circuit.
+    :param reset_timeout: The time in seconds the circuit stays open.
+    :param hedge_delay: The hedging delay in seconds used until enough durations are known.
+    :param min_hedge_delay: The lowest hedging delay in seconds.
+    """
+
+    _LATENCY_SAMPLES = 200
+    _MIN_SAMPLES = 20
+
+    def __init__(
+            self,
+            max_retries: int = 3,
+            backoff: float = 0.2,
+            max_backoff: float = 5.0,
+            failure_threshold: int = 5,
+            reset_timeout: float = 30.0,
+            hedge_delay: float = 0.5,
+            min_hedge_delay: float = 0.05
+        ) -> None:
+        """Constructor."""
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._hedge_delay = hedge_delay
+        self._min_hedge_delay = min_hedge_delay
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._durations: Dict[str, Deque[float]] = {}
+
+    def breaker(self, operation: str) -> CircuitBreaker:
+        """Return the circuit breaker of the operation."""
+        if operation not in self._breakers:
+            self._breakers[operation] = CircuitBreaker(self._failure_threshold, self._reset_timeout)
+        return self._breakers[operation]
+
+    def hedge_delay(self, operation: str) -> float:
+        """Return the time after which a hedged call of the operation is repeated."""
+        durations = self._durations.get(operation)
+        if not durations or len(durations) < ResiliencePolicy._MIN_SAMPLES:
+            return self._hedge_delay
+        ordered = sorted(durations)
+        return max(ordered[int(len(ordered) * 0.95) - 1], self._min_hedge_delay)
+
+    async def call(
+            self,
+            operation: str,
+            func: Callable[[], Awaitable[T]],
+            idempotent: bool = False,
+            hedge: bool = False) -> T:
+        """
+        Call the agent service.
+
+        :param operation: The name of the operation, e.g. "files.get".
+        :param func: The function making the call. It is called again for every attempt.
+        :param idempotent: True if the call may be repeated without side effects.
+        :param hedge: True to repeat the slow call in parallel. Only used for the idempotent calls.
+        :return: The result of the call.
+        :raises CircuitOpenError: If the operation has been failing.
+        """
+        breaker = self.breaker(operation)
+        attempts = self._max_retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            permit = breaker.allow()
+            if permit is None:
+                raise CircuitOpenError(operation, breaker.retry_after())
+            try:
+                if idempotent and hedge:
+                    result = await self._hedged(operation, func)
+                else:
+                    result = await self._timed(operation, func)
+            except Exception as e:
+                if not is_transient(e):
+                    # The service has answered, e.g. with not found.
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise
+                delay = random.uniform(0, min(self._max_backoff, self._backoff * 2 ** attempt))
+                logger.warning(f"Retrying {operation} in {delay:.2f}s after error: {e}")
+                await asyncio.sleep(delay)
+            except BaseException:
+                # The call was cancelled, e.g. by a client disconnect, before the service answered.
+                breaker.release_trial(permit)
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+    async def _timed(self, operation: str, func: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await func()
+            outcome = "success"
+            return result
+        finally:
+            duration = time.perf_counter() - start
+            operation_histogram.record(duration * 1000, {"operation": operation, "outcome": outcome})
+            if outcome == "success":
+                durations = self._durations.setdefault(operation, deque(maxlen=ResiliencePolicy._LATENCY_SAMPLES))
+                durations.append(duration)
+
+    async def _hedged(self, operation: str, func: Callable[[], Awaitable[T]]) -> T:
+        first = asyncio.ensure_future(self._timed(operation, func))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(operation))
+            if done:
+                return first.result()
+            tasks.append(asyncio.ensure_future(self._timed(operation, func)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            # Both calls failed, report the error of the first one.
+            return first.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+                # The error of the losing call is not reported, retrieve it to keep asyncio from logging it.
+                task.add_done_callback(_retrieve_exception)
+
+
+def _retrieve_exception(task: asyncio.Future[T]) -> None:
+    if not task.cancelled():
+        task.exception()
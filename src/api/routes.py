@@ -2,13 +2,14 @@
 # Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
 
 import asyncio
-import json
+import heapq
 import os
-from typing import AsyncGenerator, Optional, Dict
+import time
+from typing import AsyncGenerator, AsyncIterator, Callable, Optional, Dict, List, Tuple, Union
 
 import fastapi
-from fastapi import Request, Depends, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi import Request, Depends, HTTPException, Query
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import JSONResponse
 
@@ -18,23 +19,42 @@ from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapProp
 from azure.ai.agents.aio import AgentsClient
 from azure.ai.agents.models import (
     Agent,
+    ListSortOrder,
     MessageDeltaChunk,
+    MessageRole,
+    ThreadMessageOptions,
     ThreadMessage,
     ThreadRun,
     AsyncAgentEventHandler,
     RunStep
 )
 from azure.ai.projects import AIProjectClient
-from azure.ai.projects.models import (
-   AgentEvaluationRequest,
-   AgentEvaluationSamplingConfiguration,
-   AgentEvaluationRedactionConfiguration,
-   EvaluatorIds
+from azure.core.exceptions import HttpResponseError
+
+from .admission import AdmissionController, AdmissionRejected, SharedRunCounter
+from .async_cache import AsyncLRUCache
+from .chat_metrics import (
+    RunTiming,
+    annotation_histogram,
+    cancelled_runs_counter,
+    completion_tokens,
+    sse_bytes_histogram,
+    tokens_saved_counter,
 )
+from .evaluation import EvaluationDispatcher
+from .latency import LatencyBreakdown
+from .prometheus import CONTENT_TYPE as PROMETHEUS_CONTENT_TYPE
+from .resilience import CircuitOpenError, ResiliencePolicy
+from .sse import TextDelta, coalesce_deltas, serialize_sse_event
+from .stream_session import EventsExpired, StreamSession, parse_event_id
+from .thread_cache import ThreadCache, is_not_found
+from .thread_pool import ThreadPool
 
 
 # Create a logger for this module
 logger = logging.getLogger("azureaiapp")
+# The records of every stream event and annotation, which may be sampled with APP_LOG_SAMPLING.
+event_logger = logging.getLogger("azureaiapp.events")
 
 # Set the log level for the azure HTTP logging policy to WARNING (or ERROR)
 logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(logging.WARNING)
@@ -88,31 +108,65 @@ def get_agent_client(request: Request) -> AgentsClient:
 def get_agent(request: Request) -> Agent:
     return request.app.state.agent
 
+def get_thread_pool(request: Request) -> Optional[ThreadPool]:
+    return getattr(request.app.state, "thread_pool", None)
+
+def get_evaluation_dispatcher(request: Request) -> Optional[EvaluationDispatcher]:
+    return getattr(request.app.state, "evaluation_dispatcher", None)
+
 def get_app_insights_conn_str(request: Request) -> str:
     if hasattr(request.app.state, "application_insights_connection_string"):
         return request.app.state.application_insights_connection_string
     else:
         return None
 
-def serialize_sse_event(data: Dict) -> str:
-    return f"data: {json.dumps(data)}\n\n"
+# The retry, circuit breaker and hedging policy of the calls to the agent service.
+resilience = ResiliencePolicy(
+    max_retries=int(os.getenv("AGENT_MAX_RETRIES", "3")),
+    failure_threshold=int(os.getenv("AGENT_CIRCUIT_FAILURES", "5")),
+    reset_timeout=float(os.getenv("AGENT_CIRCUIT_RESET_SECONDS", "30")),
+    hedge_delay=float(os.getenv("AGENT_HEDGE_DELAY_SECONDS", "0.5")),
+)
+
+# Process-wide cache of file names used by the citation annotations. File names never
+# change for a given file ID, so the handler and the history endpoint share it.
+file_name_cache: AsyncLRUCache[str] = AsyncLRUCache(
+    maxsize=int(os.getenv("FILE_NAME_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("FILE_NAME_CACHE_TTL_SECONDS", "3600")),
+)
+
+async def get_file_name(agent_client : AgentsClient, file_id: str) -> str:
+    async def fetch_file_name() -> str:
+        logger.info(f"Fetching file with ID for annotation {file_id}")
+        openai_file = await resilience.call(
+            "files.get", lambda: agent_client.files.get(file_id, retry_total=0), idempotent=True, hedge=True)
+        return openai_file.filename
+
+    return await file_name_cache.get_or_load(file_id, fetch_file_name)
 
 async def get_message_and_annotations(agent_client : AgentsClient, message: ThreadMessage) -> Dict:
     annotations = []
     # Get file annotations for the file search.
-    for annotation in (a.as_dict() for a in message.file_citation_annotations):
-        file_id = annotation["file_citation"]["file_id"]
-        logger.info(f"Fetching file with ID for annotation {file_id}")
-        openai_file = await agent_client.files.get(file_id)
-        annotation["file_name"] = openai_file.filename
-        logger.info(f"File name for annotation: {annotation['file_name']}")
+    file_annotations = [a.as_dict() for a in message.file_citation_annotations]
+    # Resolve all distinct file IDs of the message together.
+    file_ids = list(dict.fromkeys(a["file_citation"]["file_id"] for a in file_annotations))
+    start = time.perf_counter()
+    file_names = dict(zip(file_ids, await asyncio.gather(
+        *(get_file_name(agent_client, file_id) for file_id in file_ids))))
+    if file_ids:
+        duration = (time.perf_counter() - start) * 1000
+        annotation_histogram.record(duration)
+        trace.get_current_span().set_attribute("annotations.duration_ms", duration)
+    for annotation in file_annotations:
+        annotation["file_name"] = file_names[annotation["file_citation"]["file_id"]]
+        event_logger.info(f"File name for annotation: {annotation['file_name']}")
         annotations.append(annotation)
 
     # Get url annotation for the index search.
     for url_annotation in message.url_citation_annotations:
         annotation = url_annotation.as_dict()
         annotation["file_name"] = annotation['url_citation']['title']
-        logger.info(f"File name for annotation: {annotation['file_name']}")
+        event_logger.info(f"File name for annotation: {annotation['file_name']}")
         annotations.append(annotation)
             
     return {
@@ -120,24 +174,203 @@ async def get_message_and_annotations(agent_client : AgentsClient, message: Thre
         'annotations': annotations
     }
 
-class MyEventHandler(AsyncAgentEventHandler[str]):
-    def __init__(self, ai_project: AIProjectClient, app_insights_conn_str: str):
+# The creation time and the formatted message by message ID, for each thread. Only the messages
+# which will not change anymore are kept, the newest HISTORY_CACHE_MESSAGES of each thread,
+# so a reload only formats the messages which are new or were still being generated.
+history_cache: AsyncLRUCache[Dict[str, Tuple[float, Dict]]] = AsyncLRUCache(
+    maxsize=int(os.getenv("HISTORY_CACHE_THREADS", "256")),
+    ttl=float(os.getenv("HISTORY_CACHE_TTL_SECONDS", "3600")),
+)
+HISTORY_CACHE_MESSAGES = int(os.getenv("HISTORY_CACHE_MESSAGES", "200"))
+HISTORY_FORMAT_CONCURRENCY = int(os.getenv("HISTORY_FORMAT_CONCURRENCY", "8"))
+# The largest page the messages list returns.
+MESSAGES_PAGE_SIZE = 100
+
+def is_immutable_message(message: ThreadMessage) -> bool:
+    return message.role == "user" or message.status in ("completed", "incomplete")
+
+async def format_history_messages(agent_client : AgentsClient, messages: List[ThreadMessage]) -> List[Dict]:
+    semaphore = asyncio.Semaphore(HISTORY_FORMAT_CONCURRENCY)
+
+    async def format_message(message: ThreadMessage) -> Dict:
+        async with semaphore:
+            formatted_message = await get_message_and_annotations(agent_client, message)
+        formatted_message['id'] = message.id
+        formatted_message['role'] = message.role
+        formatted_message['created_at'] = message.created_at.astimezone().strftime("%m/%d/%y, %I:%M %p")
+        return formatted_message
+
+    return list(await asyncio.gather(*(format_message(message) for message in messages)))
+
+async def list_thread_messages(
+        agent_client : AgentsClient, thread_id: str, limit: Optional[int], before: Optional[str]
+    ) -> List[ThreadMessage]:
+    """Return at most limit messages of the thread older than the before message, newest first."""
+    # In the descending order the messages after the cursor are the older ones.
+    pages = agent_client.messages.list(
+        thread_id=thread_id,
+        order=ListSortOrder.DESCENDING,
+        limit=min(limit, MESSAGES_PAGE_SIZE) if limit else MESSAGES_PAGE_SIZE,
+        retry_total=0,
+    ).by_page(continuation_token=before)
+    messages = []
+    async for page in pages:
+        async for message in page:
+            messages.append(message)
+            # Stop before requesting the pages which are not returned.
+            if limit is not None and len(messages) >= limit:
+                return messages
+    return messages
+
+async def has_message(agent_client : AgentsClient, thread_id: str, message_id: str) -> bool:
+    if message_id in (history_cache.get(thread_id) or {}):
+        return True
+    try:
+        await resilience.call(
+            "messages.get",
+            lambda: agent_client.messages.get(thread_id=thread_id, message_id=message_id, retry_total=0),
+            idempotent=True)
+    except Exception as e:
+        if is_not_found(e):
+            return False
+        raise
+    return True
+
+async def get_thread_history(
+        agent_client : AgentsClient,
+        thread_id: str,
+        limit: Optional[int] = None,
+        before: Optional[str] = None
+    ) -> Tuple[List[Dict], bool]:
+    """
+    Return the formatted messages of the thread, newest first.
+
+    :param agent_client: The agents client.
+    :param thread_id: The ID of the thread.
+    :param limit: The maximal number of messages, None for all of them.
+    :param before: The ID of the message the returned messages are older than, None for the newest ones.
+    :return: The messages and whether the thread has older ones.
+    """
+    # One more message tells whether there is a next page.
+    messages = await resilience.call(
+        "messages.list",
+        lambda: list_thread_messages(agent_client, thread_id, None if limit is None else limit + 1, before),
+        idempotent=True)
+    has_more = limit is not None and len(messages) > limit
+    messages = messages[:limit]
+
+    cached = history_cache.get(thread_id) or {}
+    new_messages = [message for message in messages if message.id not in cached]
+    formatted = dict(zip(
+        (message.id for message in new_messages), await format_history_messages(agent_client, new_messages)))
+
+    immutable = {
+        message.id: (message.created_at.timestamp(), formatted[message.id])
+        for message in new_messages if is_immutable_message(message)}
+    if immutable:
+        # Keep the newest messages, the first page is the one every reload asks for.
+        newest = heapq.nlargest(HISTORY_CACHE_MESSAGES, {**cached, **immutable}.items(), key=lambda i: i[1][0])
+        history_cache.set(thread_id, dict(newest))
+    return [cached[message.id][1] if message.id in cached else formatted[message.id] for message in messages], has_more
+
+# Threads which are known to exist, so that the requests of an ongoing conversation do not
+# need to check the thread before using it. A stale entry is detected when the thread is used.
+thread_cache = ThreadCache(
+    maxsize=int(os.getenv("THREAD_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("THREAD_CACHE_TTL_SECONDS", "600")),
+)
+
+async def get_thread_id(
+        agent_client : AgentsClient,
+        thread_id: Optional[str],
+        agent_id: Optional[str],
+        agent: Agent,
+        thread_pool: Optional[ThreadPool] = None) -> Tuple[str, bool]:
+    """
+    Return the ID of the thread from the cookie or of a new thread.
+
+    :param agent_client: The agents client.
+    :param thread_id: The thread ID from the cookie.
+    :param agent_id: The agent ID from the cookie.
+    :param agent: The agent served by the application.
+    :param thread_pool: The pool of empty threads for the new sessions.
+    :return: The thread ID and True if it was taken from the cache without checking it.
+    """
+    span = trace.get_current_span()
+    if thread_id and agent_id == agent.id:
+        thread_id = thread_cache.replacement(thread_id) or thread_id
+        if thread_cache.is_known(thread_id):
+            span.set_attribute("thread_cache.hit", True)
+            return thread_id, True
+        span.set_attribute("thread_cache.hit", False)
+        logger.info(f"Retrieving thread with ID {thread_id}")
+        start = time.perf_counter()
+        thread = await resilience.call(
+            "threads.get", lambda: agent_client.threads.get(thread_id, retry_total=0), idempotent=True, hedge=True)
+        thread_cache.record_lookup(time.perf_counter() - start)
+        thread_id = thread.id
+    else:
+        thread_id = await create_thread(agent_client, thread_pool)
+    thread_cache.remember(thread_id)
+    return thread_id, False
+
+async def create_thread(agent_client : AgentsClient, thread_pool: Optional[ThreadPool]) -> str:
+    """Return the ID of a new thread, taken from the pool if there is one."""
+    if thread_pool is not None:
+        logger.info("Taking a new thread from the pool")
+        return await thread_pool.acquire()
+    logger.info("Creating a new thread")
+    thread = await resilience.call("threads.create", agent_client.threads.create)
+    return thread.id
+
+async def replace_thread(
+        agent_client : AgentsClient,
+        stale_thread_id: str,
+        thread_pool: Optional[ThreadPool] = None) -> str:
+    """Replace the cached thread, which does not exist anymore, with a new one."""
+    logger.info(f"Thread {stale_thread_id} was not found, creating a new thread")
+    history_cache.invalidate(stale_thread_id)
+    thread_id = await create_thread(agent_client, thread_pool)
+    thread_cache.replace(stale_thread_id, thread_id)
+    return thread_id
+
+# The window in which the message deltas are merged into one server sent event.
+SSE_COALESCE_WINDOW = float(os.getenv("SSE_COALESCE_WINDOW_MS", "30")) / 1000
+SSE_COALESCE_MAX_CHARS = int(os.getenv("SSE_COALESCE_MAX_CHARS", "1024"))
+# The number of frames buffered for a slow client before the run stream is not read anymore.
+SSE_STREAM_BUFFER_FRAMES = int(os.getenv("SSE_STREAM_BUFFER_FRAMES", "64"))
+# The interval in seconds between the checks that the client is still connected.
+DISCONNECT_CHECK_INTERVAL = float(os.getenv("DISCONNECT_CHECK_INTERVAL_SECONDS", "1"))
+
+class MyEventHandler(AsyncAgentEventHandler[Union[str, TextDelta]]):
+    def __init__(
+            self,
+            ai_project: AIProjectClient,
+            app_insights_conn_str: str,
+            evaluation_dispatcher: Optional[EvaluationDispatcher] = None,
+            request_start: Optional[float] = None):
         super().__init__()
         self.agent_client = ai_project.agents
         self.ai_project = ai_project
         self.app_insights_conn_str = app_insights_conn_str
+        self.evaluation_dispatcher = evaluation_dispatcher
+        # The last state of the run, used to cancel an abandoned run.
+        self.run: Optional[ThreadRun] = None
+        self.timing = RunTiming(request_start)
 
-    async def on_message_delta(self, delta: MessageDeltaChunk) -> Optional[str]:
-        stream_data = {'content': delta.text, 'type': "message"}
-        return serialize_sse_event(stream_data)
+    async def on_message_delta(self, delta: MessageDeltaChunk) -> Optional[TextDelta]:
+        self.timing.on_delta()
+        # The deltas are serialized by coalesce_deltas.
+        return TextDelta(delta.text)
 
     async def on_thread_message(self, message: ThreadMessage) -> Optional[str]:
         try:
-            logger.info(f"MyEventHandler: Received thread message, message ID: {message.id}, status: {message.status}")
+            event_logger.info(
+                f"MyEventHandler: Received thread message, message ID: {message.id}, status: {message.status}")
             if message.status != "completed":
                 return None
 
-            logger.info("MyEventHandler: Received completed message")
+            event_logger.info("MyEventHandler: Received completed message")
 
             stream_data = await get_message_and_annotations(self.agent_client, message)
             stream_data['type'] = "completed_message"
@@ -147,14 +380,17 @@ class MyEventHandler(AsyncAgentEventHandler[str]):
             return None
 
     async def on_thread_run(self, run: ThreadRun) -> Optional[str]:
-        logger.info("MyEventHandler: on_thread_run event received")
+        event_logger.info("MyEventHandler: on_thread_run event received")
+        self.run = run
         run_information = f"ThreadRun status: {run.status}, thread ID: {run.thread_id}"
         stream_data = {'content': run_information, 'type': 'thread_run'}
         if run.status == "failed":
             stream_data['error'] = run.last_error.as_dict()
         # automatically run agent evaluation when the run is completed
         if run.status == "completed":
-            run_agent_evaluation(run.thread_id, run.id, self.ai_project, self.app_insights_conn_str)
+            if run.usage:
+                completion_tokens.record(run.usage.completion_tokens)
+            run_agent_evaluation(run.thread_id, run.id, self.evaluation_dispatcher)
         return serialize_sse_event(stream_data)
 
     async def on_error(self, data: str) -> Optional[str]:
@@ -163,22 +399,23 @@ class MyEventHandler(AsyncAgentEventHandler[str]):
         return serialize_sse_event(stream_data)
 
     async def on_done(self) -> Optional[str]:
-        logger.info("MyEventHandler: on_done event received")
+        event_logger.info("MyEventHandler: on_done event received")
         stream_data = {'type': "stream_end"}
         return serialize_sse_event(stream_data)
 
     async def on_run_step(self, step: RunStep) -> Optional[str]:
-        logger.info(f"Step {step['id']} status: {step['status']}")
+        event_logger.info(f"Step {step['id']} status: {step['status']}")
         step_details = step.get("step_details", {})
         tool_calls = step_details.get("tool_calls", [])
+        self.timing.on_step(step['id'], step['status'], tool_calls[0].get("type") if tool_calls else None)
 
         if tool_calls:
-            logger.info("Tool calls:")
+            event_logger.info("Tool calls:")
             for call in tool_calls:
                 azure_ai_search_details = call.get("azure_ai_search", {})
                 if azure_ai_search_details:
-                    logger.info(f"azure_ai_search input: {azure_ai_search_details.get('input')}")
-                    logger.info(f"azure_ai_search output: {azure_ai_search_details.get('output')}")
+                    event_logger.info(f"azure_ai_search input: {azure_ai_search_details.get('input')}")
+                    event_logger.info(f"azure_ai_search output: {azure_ai_search_details.get('output')}")
         return None
 
 @router.get("/", response_class=HTMLResponse)
@@ -191,43 +428,203 @@ async def index(request: Request, _ = auth_dependency):
     )
 
 
+def is_throttled(error: Exception) -> bool:
+    """Return True if the agent service rejected the request because of its rate limits."""
+    return isinstance(error, HttpResponseError) and error.status_code == 429
+
+def is_throttled_run(run: Optional[ThreadRun]) -> bool:
+    """Return True if the run failed because of the rate limits of the model."""
+    return run is not None and run.status == "failed" and run.last_error is not None \
+        and run.last_error.code == "rate_limit_exceeded"
+
+# The limit of concurrent runs of this worker, adapted to the throttling of the agent service.
+# With ADMISSION_GLOBAL_LIMIT, the runs of all the workers forked from the master are limited too.
+admission = AdmissionController(
+    limit=int(os.getenv("ADMISSION_LIMIT", "16")),
+    min_limit=int(os.getenv("ADMISSION_MIN_LIMIT", "1")),
+    max_limit=int(os.getenv("ADMISSION_MAX_LIMIT", "64")),
+    max_queue=int(os.getenv("ADMISSION_QUEUE_SIZE", "64")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "30")),
+    shared=SharedRunCounter(int(os.getenv("ADMISSION_GLOBAL_LIMIT"))) if os.getenv("ADMISSION_GLOBAL_LIMIT") else None,
+)
+
+TERMINAL_RUN_STATUSES = ("completed", "failed", "cancelled", "cancelling", "expired", "incomplete")
+
+# The cancellations of abandoned runs, referenced until they finish.
+cancellation_tasks = set()
+
+async def cancel_run(agent_client : AgentsClient, handler: "MyEventHandler") -> None:
+    """Cancel the run of the client which has disconnected."""
+    run = handler.run
+    try:
+        await agent_client.runs.cancel(thread_id=run.thread_id, run_id=run.id)
+        tokens_saved = completion_tokens.remaining(handler.timing.deltas)
+        cancelled_runs_counter.add(1)
+        tokens_saved_counter.add(tokens_saved)
+        logger.info(f"Cancelled run {run.id} of the disconnected client, estimated tokens saved: {tokens_saved}")
+    except Exception as e:
+        logger.warning(f"Error cancelling run {run.id}: {e}")
+
+def schedule_run_cancellation(agent_client : AgentsClient, handler: Optional["MyEventHandler"]) -> None:
+    """Cancel the run in the background unless it has already finished."""
+    if handler is None or handler.run is None or handler.run.status in TERMINAL_RUN_STATUSES:
+        return
+    # The generator is being cancelled, so the cancellation cannot be awaited in it.
+    task = asyncio.ensure_future(cancel_run(agent_client, handler))
+    cancellation_tasks.add(task)
+    task.add_done_callback(cancellation_tasks.discard)
+
 async def get_result(
     request: Request, 
     thread_id: str, 
     agent_id: str, 
     ai_project: AIProjectClient,
     app_insight_conn_str: Optional[str], 
-    carrier: Dict[str, str]
+    carrier: Dict[str, str],
+    content: Optional[str] = None,
+    cached: bool = False,
+    thread_pool: Optional[ThreadPool] = None,
+    breakdown: Optional[LatencyBreakdown] = None,
+    admission: Optional[AdmissionController] = None,
+    evaluation_dispatcher: Optional[EvaluationDispatcher] = None
 ) -> AsyncGenerator[str, None]:
     ctx = TraceContextTextMapPropagator().extract(carrier=carrier)
-    with tracer.start_as_current_span('get_result', context=ctx):
+    with tracer.start_as_current_span('get_result', context=ctx) as span:
         logger.info(f"get_result invoked for thread_id={thread_id} and agent_id={agent_id}")
+        handler: Optional[MyEventHandler] = None
+        agent_client = ai_project.agents
+        start = time.monotonic()
+        throttled = False
         try:
-            agent_client = ai_project.agents
-            async with await agent_client.runs.stream(
-                thread_id=thread_id, 
-                agent_id=agent_id,
-                event_handler=MyEventHandler(ai_project, app_insight_conn_str),
-            ) as stream:
+            # With the content, the user message is added by the request starting the run.
+            additional_messages = None
+            if content is not None:
+                additional_messages = [ThreadMessageOptions(role=MessageRole.USER, content=content)]
+
+            async def start_stream(thread_id: str):
+                nonlocal handler
+                handler = MyEventHandler(
+                    ai_project, app_insight_conn_str, evaluation_dispatcher,
+                    request_start=breakdown.start if breakdown else None)
+                return await resilience.call("runs.stream", lambda: agent_client.runs.stream(
+                    thread_id=thread_id, 
+                    agent_id=agent_id,
+                    additional_messages=additional_messages,
+                    event_handler=handler,
+                ))
+
+            try:
+                run_stream = await start_stream(thread_id)
+            except Exception as e:
+                if not (cached and additional_messages and is_not_found(e)):
+                    raise
+                # The cached thread was deleted, continue the conversation in a new one.
+                thread_id = await replace_thread(agent_client, thread_id, thread_pool)
+                run_stream = await start_stream(thread_id)
+            if breakdown:
+                breakdown.mark("run_start")
+            async with run_stream as stream:
                 logger.info("Successfully created stream; starting to process events")
-                async for event in stream:
-                    _, _, event_func_return_val = event
-                    logger.debug(f"Received event: {event}")
-                    if event_func_return_val:
-                        logger.info(f"Yielding event: {event_func_return_val}")
-                        yield event_func_return_val
-                    else:
-                        logger.debug("Event received but no data to yield")
+
+                async def stream_events():
+                    async for event in stream:
+                        _, _, event_func_return_val = event
+                        event_logger.debug("Received event: %s", event)
+                        if event_func_return_val:
+                            yield event_func_return_val
+                        else:
+                            event_logger.debug("Event received but no data to yield")
+
+                async for frame in coalesce_deltas(
+                        stream_events(), window=SSE_COALESCE_WINDOW, max_chars=SSE_COALESCE_MAX_CHARS,
+                        max_frames=SSE_STREAM_BUFFER_FRAMES):
+                    if breakdown:
+                        breakdown.mark("first_event")
+                        breakdown.record(span)
+                        logger.info(f"Time to first event breakdown (ms): {breakdown.as_dict()}")
+                        breakdown = None
+                    event_logger.debug("Yielding event: %s", frame)
+                    yield frame
+        except (asyncio.CancelledError, GeneratorExit):
+            # The stream session stops reading when no client is connected anymore.
+            logger.info(f"Stream of thread ID {thread_id} was closed before the run finished")
+            schedule_run_cancellation(agent_client, handler)
+            raise
         except Exception as e:
+            throttled = is_throttled(e)
             logger.exception(f"Exception in get_result: {e}")
             yield serialize_sse_event({'type': "error", 'message': str(e)})
+        finally:
+            if handler is not None:
+                handler.timing.finish(span)
+            if admission is not None:
+                # The slot is held for the whole run, also when the client left earlier.
+                throttled = throttled or (handler is not None and is_throttled_run(handler.run))
+                admission.release(time.monotonic() - start, throttled)
+
+
+# The streams of the runs, kept to let the clients reconnect with Last-Event-ID. The streams are
+# in the memory of the worker, a reconnection routed to another worker gets a 404 and the client
+# reloads the history instead. A run is cancelled SSE_RESUME_GRACE seconds after its client left,
+# so a client which does not come back still uses the run for the grace.
+SSE_RESUME_GRACE = float(os.getenv("SSE_RESUME_GRACE_SECONDS", "15"))
+SSE_REPLAY_EVENTS = int(os.getenv("SSE_REPLAY_EVENTS", "256"))
+SSE_REPLAY_TTL = float(os.getenv("SSE_REPLAY_TTL_SECONDS", "60"))
+stream_sessions: AsyncLRUCache[StreamSession] = AsyncLRUCache(
+    maxsize=int(os.getenv("SSE_RESUME_MAX_STREAMS", "256")),
+    ttl=float(os.getenv("SSE_RESUME_MAX_RUN_SECONDS", "600")),
+)
 
+def start_stream_session(
+    frames: AsyncIterator[str], thread_id: str, on_not_started: Optional[Callable[[], None]] = None
+) -> StreamSession:
+    """Start reading the run stream in the background and register it for the reconnections."""
+    def on_finished(session: StreamSession) -> None:
+        # Keep the finished stream only for the replay of its tail.
+        if session.stream_id in stream_sessions:
+            stream_sessions.set(session.stream_id, session, ttl=SSE_REPLAY_TTL)
+
+    session = StreamSession(
+        frames, thread_id, max_events=SSE_REPLAY_EVENTS, grace=SSE_RESUME_GRACE, on_finished=on_finished,
+        on_not_started=on_not_started)
+    stream_sessions.set(session.stream_id, session)
+    session.start()
+    return session
+
+async def follow_stream(request: Request, session: StreamSession, after: int = 0) -> AsyncGenerator[str, None]:
+    """Yield the events of the stream session until the run finishes or the client disconnects."""
+    with tracer.start_as_current_span("chat_stream") as span:
+        span.set_attribute("sse.resumed", after > 0)
+        sent_bytes = 0
+        events = 0
+        try:
+            next_check = time.monotonic() + DISCONNECT_CHECK_INTERVAL
+            async for frame in session.subscribe(after):
+                if time.monotonic() >= next_check:
+                    if await request.is_disconnected():
+                        logger.info(f"Client disconnected from the stream {session.stream_id}")
+                        return
+                    next_check = time.monotonic() + DISCONNECT_CHECK_INTERVAL
+                sent_bytes += len(frame.encode("utf-8"))
+                events += 1
+                yield frame
+        except EventsExpired as e:
+            # The events were dropped between the check of the reconnection and the subscription.
+            logger.warning(str(e))
+            yield serialize_sse_event({'type': "error", 'message': str(e)})
+        finally:
+            sse_bytes_histogram.record(sent_bytes)
+            span.set_attribute("sse.bytes_sent", sent_bytes)
+            span.set_attribute("sse.events", events)
 
 @router.get("/chat/history")
 async def history(
     request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=100),
+    before: Optional[str] = None,
     ai_project : AIProjectClient = Depends(get_ai_project),
     agent : Agent = Depends(get_agent),
+    thread_pool : Optional[ThreadPool] = Depends(get_thread_pool),
 	_ = auth_dependency
 ):
     with tracer.start_as_current_span("chat_history"):
@@ -238,39 +635,44 @@ async def history(
         # Attempt to get an existing thread. If not found, create a new one.
         try:
             agent_client = ai_project.agents
-            if thread_id and agent_id == agent.id:
-                logger.info(f"Retrieving thread with ID {thread_id}")
-                thread = await agent_client.threads.get(thread_id)
-            else:
-                logger.info("Creating a new thread")
-                thread = await agent_client.threads.create()
+            thread_id, cached = await get_thread_id(agent_client, thread_id, agent_id, agent, thread_pool)
+        except CircuitOpenError as e:
+            logger.error(f"Error handling thread: {e}")
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
         except Exception as e:
             logger.error(f"Error handling thread: {e}")
             raise HTTPException(status_code=400, detail=f"Error handling thread: {e}")
 
-        thread_id = thread.id
         agent_id = agent.id
 
-    # Create a new message from the user's input.
     try:
-        content = []
-        response = agent_client.messages.list(
-            thread_id=thread_id,
-        )
-        async for message in response:
-            formatteded_message = await get_message_and_annotations(agent_client, message)
-            formatteded_message['role'] = message.role
-            formatteded_message['created_at'] = message.created_at.astimezone().strftime("%m/%d/%y, %I:%M %p")
-            content.append(formatteded_message)
-                
-                                        
+        # The history is returned newest first and paged with the "before" message ID cursor.
+        if before and not await has_message(agent_client, thread_id, before):
+            raise HTTPException(status_code=400, detail=f"Unknown message ID: {before}")
+        try:
+            content, has_more = await get_thread_history(agent_client, thread_id, limit, before)
+        except Exception as e:
+            if not (cached and is_not_found(e)):
+                raise
+            # The cached thread was deleted, the new thread has no history.
+            thread_id = await replace_thread(agent_client, thread_id, thread_pool)
+            content, has_more = [], False
+        next_before = content[-1]['id'] if has_more else None
+
         logger.info(f"List message, thread ID: {thread_id}")
         response = JSONResponse(content=content)
+        if next_before:
+            response.headers["X-Next-Before"] = next_before
     
         # Update cookies to persist the thread and agent IDs.
         response.set_cookie("thread_id", thread_id)
         response.set_cookie("agent_id", agent_id)
         return response
+    except HTTPException:
+        raise
+    except CircuitOpenError as e:
+        logger.error(f"Error listing message: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(f"Error listing message: {e}")
         raise HTTPException(status_code=500, detail=f"Error list message: {e}")
@@ -281,12 +683,46 @@ async def get_chat_agent(
 ):
     return JSONResponse(content=get_agent(request).as_dict())  
 
+# The Server-Sent Events (SSE) response headers.
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Content-Type": "text/event-stream",
+    # Ask the proxies not to buffer the stream.
+    "X-Accel-Buffering": "no",
+}
+
+def resume_chat(request: Request, thread_id: Optional[str], last_event_id: str) -> StreamingResponse:
+    """
+    Return the events of the run following the last event the client has received.
+
+    :param request: The request of the reconnecting client.
+    :param thread_id: The thread ID from the cookie.
+    :param last_event_id: The value of the Last-Event-ID header.
+    """
+    parsed = parse_event_id(last_event_id)
+    session = stream_sessions.get(parsed[0]) if parsed else None
+    if session is None or session.thread_id != thread_id:
+        # The stream may also belong to another worker.
+        logger.info(f"Stream of the event {last_event_id} is not available")
+        raise HTTPException(status_code=404, detail=f"Unknown or expired stream of the event: {last_event_id}")
+    if not session.can_resume(parsed[1]):
+        logger.info(f"The events after {last_event_id} were dropped from the replay buffer")
+        raise HTTPException(status_code=410, detail=f"The events after {last_event_id} are no longer available")
+    logger.info(f"Resuming stream {session.stream_id} after event {parsed[1]}")
+    return StreamingResponse(follow_stream(request, session, parsed[1]), headers=SSE_HEADERS)
+
+# Add the user message with the request starting the run instead of creating it first.
+CHAT_FAST_PATH = os.getenv("CHAT_FAST_PATH", "true").lower() == "true"
+
 @router.post("/chat")
 async def chat(
     request: Request,
     agent : Agent = Depends(get_agent),
     ai_project: AIProjectClient = Depends(get_ai_project),
     app_insights_conn_str : str = Depends(get_app_insights_conn_str),
+    thread_pool : Optional[ThreadPool] = Depends(get_thread_pool),
+    evaluation_dispatcher : Optional[EvaluationDispatcher] = Depends(get_evaluation_dispatcher),
 	_ = auth_dependency
 ):
     # Retrieve the thread ID from the cookies (if available).
@@ -294,23 +730,27 @@ async def chat(
     agent_id = request.cookies.get('agent_id')
 
     with tracer.start_as_current_span("chat_request"):
+        # Reattach the reconnecting client to its run instead of starting a new one.
+        last_event_id = request.headers.get("Last-Event-ID")
+        if last_event_id:
+            return resume_chat(request, thread_id, last_event_id)
+
+        breakdown = LatencyBreakdown()
         carrier = {}        
         TraceContextTextMapPropagator().inject(carrier)
         
         # Attempt to get an existing thread. If not found, create a new one.
         try:
             agent_client = ai_project.agents
-            if thread_id and agent_id == agent.id:
-                logger.info(f"Retrieving thread with ID {thread_id}")
-                thread = await agent_client.threads.get(thread_id)
-            else:
-                logger.info("Creating a new thread")
-                thread = await agent_client.threads.create()
+            thread_id, cached = await get_thread_id(agent_client, thread_id, agent_id, agent, thread_pool)
+        except CircuitOpenError as e:
+            logger.error(f"Error handling thread: {e}")
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
         except Exception as e:
             logger.error(f"Error handling thread: {e}")
             raise HTTPException(status_code=400, detail=f"Error handling thread: {e}")
+        breakdown.mark("thread")
 
-        thread_id = thread.id
         agent_id = agent.id
 
         # Parse the JSON from the request.
@@ -319,31 +759,74 @@ async def chat(
         except Exception as e:
             logger.error(f"Invalid JSON in request: {e}")
             raise HTTPException(status_code=400, detail=f"Invalid JSON in request: {e}")
+        if not isinstance(user_message, dict) or not isinstance(user_message.get('message', ''), str):
+            logger.error(f"Invalid chat request: {user_message}")
+            raise HTTPException(status_code=400, detail="The request must be an object with a message string.")
+        breakdown.mark("parse")
 
         logger.info(f"user_message: {user_message}")
+        content = user_message.get('message', '')
 
-        # Create a new message from the user's input.
+        # Wait for a run slot or tell the client to come back later.
         try:
-            message = await agent_client.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_message.get('message', '')
-            )
-            logger.info(f"Created message, message ID: {message.id}")
-        except Exception as e:
-            logger.error(f"Error creating message: {e}")
-            raise HTTPException(status_code=500, detail=f"Error creating message: {e}")
-
-        # Set the Server-Sent Events (SSE) response headers.
-        headers = {
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream"
-        }
-        logger.info(f"Starting streaming response for thread ID {thread_id}")
-
-        # Create the streaming response using the generator.
-        response = StreamingResponse(get_result(request, thread_id, agent_id, ai_project, app_insights_conn_str, carrier), headers=headers)
+            await admission.acquire()
+        except AdmissionRejected as e:
+            logger.warning(f"Rejecting chat request: {e}")
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+        breakdown.mark("admission")
+
+        # The slot is released here until get_result, which releases it when the run ends, owns it.
+        slot_owned_by_stream = False
+        throttled = False
+        try:
+            if CHAT_FAST_PATH:
+                # The message is added by the request starting the run, inside the stream.
+                run_content = content
+            else:
+                # Create a new message from the user's input.
+                run_content = None
+                try:
+                    try:
+                        message = await resilience.call("messages.create", lambda: agent_client.messages.create(
+                            thread_id=thread_id,
+                            role="user",
+                            content=content
+                        ))
+                    except Exception as e:
+                        if not (cached and is_not_found(e)):
+                            raise
+                        # The cached thread was deleted, continue the conversation in a new one.
+                        thread_id = await replace_thread(agent_client, thread_id, thread_pool)
+                        message = await resilience.call("messages.create", lambda: agent_client.messages.create(
+                            thread_id=thread_id,
+                            role="user",
+                            content=content
+                        ))
+                    logger.info(f"Created message, message ID: {message.id}")
+                except Exception as e:
+                    throttled = is_throttled(e)
+                    logger.error(f"Error creating message: {e}")
+                    raise HTTPException(status_code=500, detail=f"Error creating message: {e}")
+                breakdown.mark("message")
+
+            # Set the Server-Sent Events (SSE) response headers.
+            headers = dict(SSE_HEADERS)
+            headers["Server-Timing"] = breakdown.server_timing()
+            logger.info(f"Starting streaming response for thread ID {thread_id}")
+
+            # Create the streaming response using the generator.
+            session = start_stream_session(
+                get_result(request, thread_id, agent_id, ai_project, app_insights_conn_str, carrier,
+                           content=run_content, cached=cached, thread_pool=thread_pool, breakdown=breakdown,
+                           admission=admission, evaluation_dispatcher=evaluation_dispatcher),
+                thread_id,
+                # get_result releases the slot when it ends, unless it never started.
+                on_not_started=admission.release)
+            slot_owned_by_stream = True
+        finally:
+            if not slot_owned_by_stream:
+                admission.release(throttled=throttled)
+        response = StreamingResponse(follow_stream(request, session), headers=headers)
 
         # Update cookies to persist the thread and agent IDs.
         response.set_cookie("thread_id", thread_id)
@@ -358,40 +841,20 @@ def read_file(path: str) -> str:
 def run_agent_evaluation(
     thread_id: str, 
     run_id: str,
-    ai_project: AIProjectClient,
-    app_insights_conn_str: str):
-
-    if app_insights_conn_str:
-        agent_evaluation_request = AgentEvaluationRequest(
-            run_id=run_id,
-            thread_id=thread_id,
-            evaluators={
-                "Relevance": {"Id": EvaluatorIds.RELEVANCE.value},
-                "TaskAdherence": {"Id": EvaluatorIds.TASK_ADHERENCE.value},
-                "ToolCallAccuracy": {"Id": EvaluatorIds.TOOL_CALL_ACCURACY.value},
-            },
-            sampling_configuration=AgentEvaluationSamplingConfiguration(
-                name="default",
-                sampling_percent=100,
-            ),
-            redaction_configuration=AgentEvaluationRedactionConfiguration(
-                redact_score_properties=False,
-            ),
-            app_insights_connection_string=app_insights_conn_str,
-        )
-        
-        async def run_evaluation():
-            try:        
-                logger.info(f"Running agent evaluation on thread ID {thread_id} and run ID {run_id}")
-                agent_evaluation_response = await ai_project.evaluations.create_agent_evaluation(
-                    evaluation=agent_evaluation_request
-                )
-                logger.info(f"Evaluation response: {agent_evaluation_response}")
-            except Exception as e:
-                logger.error(f"Error creating agent evaluation: {e}")
+    evaluation_dispatcher: Optional[EvaluationDispatcher]):
+
+    if evaluation_dispatcher is not None:
+        # The evaluation is created in the background, off the request path.
+        evaluation_dispatcher.submit(thread_id, run_id)
+
 
-        # Create a new task to run the evaluation asynchronously
-        asyncio.create_task(run_evaluation())
+@router.get("/metrics")
+async def get_metrics(request: Request, _ = auth_dependency):
+    """Return the metrics of this worker in the Prometheus text format."""
+    prometheus_metrics = getattr(request.app.state, "prometheus_metrics", None)
+    if prometheus_metrics is None:
+        raise HTTPException(status_code=404, detail="Local metrics are not enabled")
+    return Response(content=prometheus_metrics.render(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 
 @router.get("/config/azure")
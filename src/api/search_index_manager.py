@@ -1,15 +1,23 @@
-from typing import Any, Dict, Optional
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union)
 
+import asyncio
 import csv
 import glob
+import hashlib
 import json
+import logging
 import os
+import random
+import re
 import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.search.documents.aio import AsyncSearchItemPaged, SearchClient 
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     AzureOpenAIVectorizerParameters,
@@ -27,6 +35,229 @@ from azure.search.documents.indexes.models import (
 )
 from azure.search.documents.models import VectorizableTextQuery
 
+try:
+    from .async_cache import AsyncLRUCache
+except ImportError:
+    from async_cache import AsyncLRUCache
+
+logger = logging.getLogger("azureaiapp")
+
+
+_TOKENIZER_RESOURCES = ('punkt', 'punkt_tab')
+_tokenizer_ready = False
+
+
+def _ensure_tokenizer(download: bool = True) -> None:
+    """
+    Make sure the nltk sentence tokenizer data is present and loaded.
+
+    The data is only downloaded if it is absent and it is checked once per process.
+    We do lazy loading of nltk, because it is only used during rag generation.
+
+    :param download: Download the absent tokenizer data.
+    """
+    global _tokenizer_ready
+    if _tokenizer_ready:
+        return
+    import nltk
+    for resource in _TOKENIZER_RESOURCES:
+        try:
+            nltk.data.find(f'tokenizers/{resource}')
+        except LookupError:
+            if not download:
+                return
+            nltk.download(resource, quiet=True)
+            try:
+                nltk.data.find(f'tokenizers/{resource}')
+            except LookupError:
+                # The download failed, sent_tokenize reports the missing data.
+                return
+    _tokenizer_ready = True
+
+
+def _json_to_lines(data: Any, path: str = '') -> Iterator[str]:
+    """
+    Render the JSON document as the lines of "key: value" text.
+
+    :param data: The parsed JSON document.
+    :param path: The keys leading to the data.
+    :return: The iterator over lines.
+    """
+    if isinstance(data, dict):
+        for key, value in data.items():
+            yield from _json_to_lines(value, f"{path} {key}".strip())
+    elif isinstance(data, list):
+        for value in data:
+            yield from _json_to_lines(value, path)
+    elif data is not None:
+        yield f"{path}: {data}" if path else str(data)
+
+
+def _chunk_file(file_name: str, sentences_per_embedding: int) -> List[Tuple[str, str]]:
+    """
+    Split the file to the chunks of sentences_per_embedding sentences.
+
+    The chunks are computed per file, so editing a file changes only its own chunks.
+    This function runs in the worker processes of the chunking pool.
+
+    :param file_name: The markdown or JSON file to split.
+    :param sentences_per_embedding: The number of sentences used to build embedding.
+    :return: The list of chunk text and the file name pairs.
+    """
+    _ensure_tokenizer(download=False)
+    from nltk.tokenize import sent_tokenize
+    reference = os.path.split(file_name)[-1]
+    chunks = []
+    index = 0
+    with open(file_name) as f:
+        lines = _json_to_lines(json.load(f)) if file_name.endswith('.json') else list(f)
+    for line in lines:
+        line = line.strip()
+        # Skip non informative lines.
+        if (len(line) < SearchIndexManager.MIN_LINE_LENGTH
+                or len(set(line)) < SearchIndexManager.MIN_DIFF_CHARACTERS_IN_LINE):
+            continue
+        for sentence in sent_tokenize(line):
+            if index % sentences_per_embedding == 0:
+                chunks.append((sentence, reference))
+            else:
+                chunks[-1] = (chunks[-1][0] + ' ' + sentence, reference)
+            index += 1
+    return chunks
+
+
+class RateBudget:
+    """
+    The per minute budget of requests or tokens, implemented as a token bucket.
+
+    The bucket holds at most one minute worth of budget and is refilled continuously.
+
+    :param per_minute: The budget per minute.
+    :param clock: The monotonic clock.
+    """
+
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic) -> None:
+        """Constructor."""
+        if per_minute <= 0:
+            raise ValueError("The budget per minute must be positive.")
+        self._capacity = float(per_minute)
+        self._available = float(per_minute)
+        self._clock = clock
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount: float = 1) -> None:
+        """
+        Wait until the amount is available and consume it.
+
+        The amounts larger than the capacity wait for the full bucket.
+
+        :param amount: The amount of the budget to consume.
+        """
+        amount = min(float(amount), self._capacity)
+        # The lock keeps the acquisitions in the first come first served order.
+        async with self._lock:
+            while True:
+                now = self._clock()
+                self._available = min(
+                    self._capacity, self._available + (now - self._updated) * self._capacity / 60)
+                self._updated = now
+                if self._available >= amount:
+                    self._available -= amount
+                    return
+                await asyncio.sleep((amount - self._available) * 60 / self._capacity)
+
+
+class CsvEmbeddingsWriter:
+    """
+    The writer of the embeddings to the CSV file, storing every vector as a JSON string.
+
+    :param output_file: The CSV file to write.
+    """
+
+    def __init__(self, output_file: str) -> None:
+        """Constructor."""
+        self._fp = open(output_file, 'w', newline='')
+        self._writer = csv.DictWriter(self._fp, fieldnames=['token', 'embedding', 'title'])
+        self._writer.writeheader()
+
+    def write(self, token: str, embedding: Sequence[float], title: str) -> None:
+        """Write one embedding."""
+        self._writer.writerow({
+            'token': token,
+            'embedding': json.dumps([float(v) for v in embedding]),
+            'title': title})
+
+    def close(self) -> None:
+        """Close the file."""
+        self._fp.close()
+
+    def __enter__(self) -> "CsvEmbeddingsWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class EmbeddingsStoreWriter:
+    """
+    The writer of the binary embeddings store.
+
+    The store consists of the memory mappable float32 matrix in the NumPy .npy format
+    and of the JSON lines sidecar with token, title and the row offset of every vector.
+    The vectors are appended to a raw temporary file, so the memory used does not depend
+    on the number of embeddings; the .npy file is assembled on close.
+
+    :param output_file: The .npy file to write.
+    """
+
+    _COPY_ROWS = 65536
+
+    def __init__(self, output_file: str) -> None:
+        """Constructor."""
+        self._output_file = output_file
+        self._raw_file = output_file + '.raw'
+        self._raw_fp = open(self._raw_file, 'wb')
+        self._meta_fp = open(SearchIndexManager.get_metadata_file(output_file), 'w')
+        self._rows = 0
+        self._dimensions = None
+
+    def write(self, token: str, embedding: Sequence[float], title: str) -> None:
+        """Write one embedding."""
+        import numpy as np
+        vector = np.asarray(embedding, dtype=np.float32)
+        if self._dimensions is None:
+            self._dimensions = vector.shape[0]
+        elif vector.shape[0] != self._dimensions:
+            raise ValueError(f"Expected embedding of {self._dimensions} dimensions, got {vector.shape[0]}.")
+        self._raw_fp.write(vector.tobytes())
+        self._meta_fp.write(json.dumps({'token': token, 'title': title, 'offset': self._rows}) + '\n')
+        self._rows += 1
+
+    def close(self) -> None:
+        """Assemble the .npy file and close the store."""
+        import numpy as np
+        self._raw_fp.close()
+        self._meta_fp.close()
+        try:
+            dimensions = self._dimensions or 0
+            matrix = np.lib.format.open_memmap(
+                self._output_file, mode='w+', dtype=np.float32, shape=(self._rows, dimensions))
+            raw = np.memmap(self._raw_file, dtype=np.float32, mode='r', shape=(self._rows, dimensions)) \
+                if self._rows and dimensions else None
+            for start in range(0, self._rows, EmbeddingsStoreWriter._COPY_ROWS):
+                end = min(start + EmbeddingsStoreWriter._COPY_ROWS, self._rows)
+                matrix[start:end] = raw[start:end]
+            matrix.flush()
+            del matrix, raw
+        finally:
+            os.remove(self._raw_file)
+
+    def __enter__(self) -> "EmbeddingsStoreWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
 
 
 class SearchIndexManager:
@@ -45,6 +276,13 @@ class SearchIndexManager:
     :param embed_api_key: The api key used by the embedding resource.
     :param embedding_client: The embedding client, used t build the embedding. Needed only
                              to create embedding file. Not used in inference time.
+    :param readiness_timeout: The maximal time in seconds the search waits for freshly
+                              uploaded documents to become searchable.
+    :param result_cache_size: The number of search results to cache, 0 disables the cache.
+    :param result_cache_ttl: The time to live of the cached search results in seconds.
+    :param similarity_threshold: If set, the question with the embedding at least this cosine
+                                 similar to the one of a cached question is answered from the
+                                 cache. The questions are embedded by the embedding client.
     """
     
     MIN_DIFF_CHARACTERS_IN_LINE = 5
@@ -54,6 +292,13 @@ class SearchIndexManager:
     _EMBEDDING_CONFIG = "embedding_config"
     _VECTORIZER = "search_vectorizer"
 
+    _READINESS_INITIAL_DELAY = 0.1
+    _READINESS_MAX_DELAY = 2.0
+    _RETRYABLE_STATUS_CODES = (429, 503)
+
+    EMBEDDINGS_STORE_EXTENSION = '.npy'
+    CHUNKED_FILE_PATTERNS = ('*.md', '*.json')
+
 
     def __init__(
             self,
@@ -65,7 +310,11 @@ class SearchIndexManager:
             deployment_name: str,
             embedding_endpoint: str, 
             embed_api_key: Optional[str],
-            embedding_client: Optional[Any] = None
+            embedding_client: Optional[Any] = None,
+            readiness_timeout: float = 30.0,
+            result_cache_size: int = 1024,
+            result_cache_ttl: float = 300.0,
+            similarity_threshold: Optional[float] = None
         ) -> None:
         """Constructor."""
         self._dimensions = dimensions
@@ -79,6 +328,19 @@ class SearchIndexManager:
         self._embed_api_key = embed_api_key
         self._client = None
         self._embedding_client = embedding_client
+        self._readiness_timeout = readiness_timeout
+        # The number of documents the index must contain before the uploaded data is searchable.
+        self._upload_watermark: Optional[int] = None
+        # The keys of the deleted documents, which are counted until their deletion is searchable.
+        self._deleted_legacy_keys: Tuple[str, ...] = ()
+        self._readiness_lock = asyncio.Lock()
+        # The version is a part of the result cache key, it changes when the index content changes.
+        self._index_version = 0
+        self._result_cache = AsyncLRUCache(
+            maxsize=result_cache_size, ttl=result_cache_ttl) if result_cache_size else None
+        self._similarity_threshold = similarity_threshold
+        self._similar_queries = deque(maxlen=result_cache_size or 1)
+        self._similar_hits = 0
 
     def _get_client(self):
         """Get search client if it is absent."""
@@ -87,28 +349,375 @@ class SearchIndexManager:
                 endpoint=self._endpoint, index_name=self._index.name, credential=self._credential)
         return self._client
     
-    async def upload_documents(self, embeddings_file: str) -> None:
+    async def upload_documents(
+            self,
+            embeddings_file: str,
+            batch_size: int = 1000,
+            max_batch_bytes: int = 8 * 1024 * 1024,
+            max_concurrency: int = 4,
+            max_retries: int = 5,
+            checkpoint_file: Optional[str] = None
+        ) -> None:
         """
         Upload the embeggings file to index search.
 
-        :param embeddings_file: The embeddings file to upload.
+        The file is streamed in batches, capped both by the number of documents and by
+        the payload size, with up to max_concurrency batches uploaded at once. Batches
+        throttled by the service (HTTP 429 or 503) are retried with exponential backoff.
+        If checkpoint_file is given, the number of acknowledged batches is persisted to it,
+        so an interrupted upload of the same file resumes after the last acknowledged batch.
+        If the file is the delta written by build_embeddings_file, i.e. the deletes file exists
+        next to it, the documents are merged into the index and the deleted chunks are removed.
+        The documents keyed by their row number, uploaded before the keys were the content hashes,
+        are deleted after a full upload, so the index does not hold every chunk twice.
+
+        :param embeddings_file: The embeddings file to upload, either the CSV file
+               or the .npy file of the binary embeddings store.
+        :param batch_size: The maximal number of documents in one batch.
+        :param max_batch_bytes: The maximal approximate payload size of one batch in bytes.
+        :param max_concurrency: The maximal number of batches uploaded at the same time.
+        :param max_retries: The number of retries of a throttled batch.
+        :param checkpoint_file: The file to store the upload progress in.
         """
         self._raise_if_no_index()
-        documents = []
-        index = 0
+        start = time.perf_counter()
+        checkpoint = self._load_upload_checkpoint(checkpoint_file, embeddings_file, batch_size, max_batch_bytes)
+        acknowledged = checkpoint['acknowledged_batches']
+        if acknowledged:
+            logger.info(f"Resuming the upload of {embeddings_file} after {acknowledged} batches.")
+        deletes_file = self.get_deletes_file(embeddings_file)
+        is_delta = os.path.isfile(deletes_file)
+        action = 'merge_or_upload_documents' if is_delta else 'upload_documents'
+        legacy_documents = 0 if is_delta else await self._count_legacy_documents()
+        done = set()
+        pending = set()
+        # The documents of the file, including the batches uploaded before the resume.
+        total_documents = 0
+        uploaded_documents = 0
+
+        async def upload_batch(batch_number: int, rows: List[Dict[str, Any]]) -> Tuple[int, int]:
+            await self._upload_batch_with_retry([self._row_to_document(row) for row in rows], max_retries, action)
+            return batch_number, len(rows)
+
+        batches = self._batch_rows(self._read_rows(embeddings_file), batch_size, max_batch_bytes)
+        try:
+            for batch_number, rows in enumerate(batches):
+                total_documents += len(rows)
+                if batch_number < acknowledged:
+                    continue
+                if len(pending) >= max_concurrency:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    uploaded_documents += self._acknowledge_batches(finished, done, checkpoint, checkpoint_file)
+                pending.add(asyncio.ensure_future(upload_batch(batch_number, rows)))
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                uploaded_documents += self._acknowledge_batches(finished, done, checkpoint, checkpoint_file)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if is_delta:
+            with open(deletes_file) as fp:
+                deleted_ids = json.load(fp)
+            for i in range(0, len(deleted_ids), batch_size):
+                await self._upload_batch_with_retry(
+                    [{'embedId': embed_id} for embed_id in deleted_ids[i:i + batch_size]],
+                    max_retries, 'delete_documents')
+            logger.info(f"Deleted {len(deleted_ids)} documents.")
+        if legacy_documents:
+            # Deleting the keys which do not exist is not an error.
+            for i in range(0, legacy_documents, batch_size):
+                await self._upload_batch_with_retry(
+                    [{'embedId': str(row)} for row in range(i, min(i + batch_size, legacy_documents))],
+                    max_retries, 'delete_documents')
+            logger.info(f"Deleted up to {legacy_documents} documents keyed by their row number.")
+
+        if checkpoint_file and os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+        # The number of documents in the index after the delta is not known in advance. The chunks
+        # of the files written by build_embeddings_file are unique, so every row is a document.
+        self._upload_watermark = None if is_delta else total_documents
+        # The legacy documents would make up the count before the uploaded ones are searchable.
+        self._deleted_legacy_keys = tuple(sorted({'0', str(legacy_documents - 1)})) if legacy_documents else ()
+        self._invalidate_results()
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Uploaded {uploaded_documents} documents in {elapsed:.2f} s, "
+            f"{uploaded_documents / max(elapsed, 1e-9):.1f} documents/s.")
+
+    async def _count_legacy_documents(self) -> int:
+        """
+        Return the number of documents in the index if they are keyed by their row number, 0 otherwise.
+
+        The first document of the embeddings file had the key "0", the content hashes are never numeric.
+        """
+        try:
+            await self._get_client().get_document(key='0', selected_fields=['embedId'])
+        except ResourceNotFoundError:
+            return 0
+        return await self._get_client().get_document_count()
+
+    @staticmethod
+    def _read_rows(embeddings_file: str) -> Iterator[Dict[str, Any]]:
+        """Stream the rows of the CSV or binary embeddings file."""
+        if embeddings_file.endswith(SearchIndexManager.EMBEDDINGS_STORE_EXTENSION):
+            yield from SearchIndexManager.read_embeddings_store(embeddings_file)
+            return
         with open(embeddings_file, newline='') as fp:
-            reader = csv.DictReader(fp)
-            for row in reader:
-                documents.append(
-                    {
-                        'embedId': str(index),
-                        'token': row['token'],
-                        'embedding': json.loads(row['embedding']),
-                        'title': row['title'] 
-                    }
-                )
-                index += 1
-        await self._get_client().upload_documents(documents)
+            yield from csv.DictReader(fp)
+
+    @staticmethod
+    def _batch_rows(
+            rows: Iterable[Dict[str, Any]],
+            batch_size: int,
+            max_batch_bytes: int
+        ) -> Iterator[List[Dict[str, Any]]]:
+        """Group the rows to the batches limited by the number of documents and payload size."""
+        batch = []
+        batch_bytes = 0
+        for row in rows:
+            # The length of the serialized fields is a close estimate of the document payload.
+            # Binary vectors take about 12 characters per float32 once serialized to JSON.
+            embedding = row['embedding']
+            embedding_bytes = len(embedding) if isinstance(embedding, str) else embedding.size * 12
+            row_bytes = embedding_bytes + len(row['token']) + len(row['title']) + 64
+            if batch and (len(batch) >= batch_size or batch_bytes + row_bytes > max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(row)
+            batch_bytes += row_bytes
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _parse_embedding(embedding: Any) -> Any:
+        """Return the embedding vector, parsing it if it was read from the CSV file."""
+        return json.loads(embedding) if isinstance(embedding, str) else embedding
+
+    @staticmethod
+    def _row_to_document(row: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert the row of embeddings file to the search document."""
+        embedding = SearchIndexManager._parse_embedding(row['embedding'])
+        return {
+            'embedId': SearchIndexManager._get_row_embed_id(row),
+            'token': row['token'],
+            'embedding': embedding if isinstance(embedding, list) else embedding.tolist(),
+            'title': row['title']
+        }
+
+    @staticmethod
+    def get_metadata_file(embeddings_file: str) -> str:
+        """
+        Return the path of the metadata sidecar of the binary embeddings store.
+
+        :param embeddings_file: The .npy file of the store.
+        :return: The path to the JSON lines file with token, title and offset of each vector.
+        """
+        return os.path.splitext(embeddings_file)[0] + '.meta.jsonl'
+
+    @staticmethod
+    def load_embeddings_matrix(embeddings_file: str) -> Any:
+        """
+        Memory map the float32 matrix of the binary embeddings store.
+
+        :param embeddings_file: The .npy file of the store.
+        :return: The read only numpy matrix, one row per embedding.
+        """
+        import numpy as np
+        return np.load(embeddings_file, mmap_mode='r')
+
+    @staticmethod
+    def read_embeddings_store(embeddings_file: str) -> Iterator[Dict[str, Any]]:
+        """
+        Stream the binary embeddings store.
+
+        :param embeddings_file: The .npy file of the store.
+        :return: The iterator of dictionaries with token, title and the embedding vector as a numpy array.
+        """
+        matrix = SearchIndexManager.load_embeddings_matrix(embeddings_file)
+        with open(SearchIndexManager.get_metadata_file(embeddings_file)) as fp:
+            for line in fp:
+                metadata = json.loads(line)
+                yield {
+                    'token': metadata['token'],
+                    'title': metadata['title'],
+                    'embedding': matrix[metadata['offset']],
+                }
+
+    @staticmethod
+    def open_embeddings_writer(output_file: str) -> Any:
+        """
+        Open the writer of embeddings based on the file extension.
+
+        :param output_file: The .npy file of binary store or the CSV file.
+        :return: The writer with write(token, embedding, title) and close methods.
+        """
+        if output_file.endswith(SearchIndexManager.EMBEDDINGS_STORE_EXTENSION):
+            return EmbeddingsStoreWriter(output_file)
+        return CsvEmbeddingsWriter(output_file)
+
+    @staticmethod
+    def convert_embeddings_file(input_file: str, output_file: str) -> int:
+        """
+        Convert the embeddings between the CSV and the binary store formats.
+
+        The formats are determined by the file extensions, so this method both migrates
+        the existing CSV files to the binary store and exports the store to CSV.
+
+        :param input_file: The embeddings file to read.
+        :param output_file: The embeddings file to write.
+        :return: The number of converted embeddings.
+        """
+        count = 0
+        with SearchIndexManager.open_embeddings_writer(output_file) as writer:
+            for row in SearchIndexManager._read_rows(input_file):
+                writer.write(row['token'], SearchIndexManager._parse_embedding(row['embedding']), row['title'])
+                count += 1
+        return count
+
+    async def _upload_batch_with_retry(
+            self,
+            documents: List[Dict[str, Any]],
+            max_retries: int,
+            action: str = 'upload_documents'
+        ) -> None:
+        """
+        Upload the batch, retrying the throttled requests and documents.
+
+        :param documents: The documents to upload.
+        :param max_retries: The number of retries.
+        :param action: The name of the search client method to apply to the documents.
+        :raises: HttpResponseError if the batch was not accepted after all retries.
+        """
+        for attempt in range(max_retries + 1):
+            try:
+                results = await getattr(self._get_client(), action)(documents)
+            except HttpResponseError as e:
+                if e.status_code not in SearchIndexManager._RETRYABLE_STATUS_CODES or attempt == max_retries:
+                    raise
+                logger.warning(f"Request {action} of {len(documents)} documents was throttled, retrying: {e}")
+            else:
+                throttled = {
+                    r.key for r in results
+                    if not r.succeeded and r.status_code in SearchIndexManager._RETRYABLE_STATUS_CODES}
+                failed = [r for r in results if not r.succeeded and r.key not in throttled]
+                if failed:
+                    raise HttpResponseError(
+                        f"Unable to upload {len(failed)} documents, first error: {failed[0].error_message}")
+                if not throttled:
+                    return
+                if attempt == max_retries:
+                    raise HttpResponseError(f"Upload of {len(throttled)} documents was throttled.")
+                documents = [d for d in documents if d['embedId'] in throttled]
+            await asyncio.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+
+    @staticmethod
+    def _load_upload_checkpoint(
+            checkpoint_file: Optional[str],
+            embeddings_file: str,
+            batch_size: int,
+            max_batch_bytes: int
+        ) -> Dict[str, Any]:
+        """
+        Load the checkpoint or create the new one if it is absent or belongs to the other upload.
+
+        The batches are only reproducible if the file and the batch limits did not change.
+        """
+        stat = os.stat(embeddings_file)
+        checkpoint = {
+            'embeddings_file': os.path.abspath(embeddings_file),
+            'file_size': stat.st_size,
+            'file_mtime': stat.st_mtime,
+            'batch_size': batch_size,
+            'max_batch_bytes': max_batch_bytes,
+            'acknowledged_batches': 0,
+        }
+        if checkpoint_file and os.path.isfile(checkpoint_file):
+            with open(checkpoint_file) as fp:
+                saved = json.load(fp)
+            if all(saved.get(k) == v for k, v in checkpoint.items() if k != 'acknowledged_batches'):
+                checkpoint['acknowledged_batches'] = saved.get('acknowledged_batches', 0)
+        return checkpoint
+
+    @staticmethod
+    def _acknowledge_batches(
+            finished: Iterable["asyncio.Future[Tuple[int, int]]"],
+            done: Set[int],
+            checkpoint: Dict[str, Any],
+            checkpoint_file: Optional[str]
+        ) -> int:
+        """
+        Record the finished batches and persist the number of contiguously acknowledged ones.
+
+        :return: The number of documents in the finished batches.
+        :raises: The exception of the failed batch.
+        """
+        documents = 0
+        for task in finished:
+            batch_number, count = task.result()
+            done.add(batch_number)
+            documents += count
+        acknowledged = checkpoint['acknowledged_batches']
+        while acknowledged in done:
+            done.remove(acknowledged)
+            acknowledged += 1
+        if checkpoint_file and acknowledged != checkpoint['acknowledged_batches']:
+            checkpoint['acknowledged_batches'] = acknowledged
+            tmp_file = checkpoint_file + '.tmp'
+            with open(tmp_file, 'w') as fp:
+                json.dump(checkpoint, fp)
+            os.replace(tmp_file, checkpoint_file)
+        checkpoint['acknowledged_batches'] = acknowledged
+        return documents
+
+    async def wait_until_ready(self) -> bool:
+        """
+        Wait until the documents uploaded by upload_documents are searchable.
+
+        The index document count is polled with exponential backoff only if there
+        were uploads since the last successful check, so steady state queries do not wait.
+        If the upload deleted the documents keyed by their row number, the count is only
+        compared once they are gone, as they would make up for the documents not yet searchable.
+
+        :return: True if the index is ready, False if the readiness timeout was exceeded.
+        """
+        if self._upload_watermark is None:
+            return True
+        async with self._readiness_lock:
+            watermark = self._upload_watermark
+            if watermark is None:
+                return True
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self._readiness_timeout
+            delay = SearchIndexManager._READINESS_INITIAL_DELAY
+            while True:
+                legacy_visible = await self._legacy_documents_visible()
+                count = await self._get_client().get_document_count()
+                if count >= watermark and not legacy_visible:
+                    self._upload_watermark = None
+                    return True
+                if loop.time() + delay > deadline:
+                    logger.warning(
+                        f"Only {count} of {watermark} uploaded documents are searchable "
+                        f"after {self._readiness_timeout} seconds.")
+                    # Do not make the subsequent queries wait for the documents again.
+                    self._upload_watermark = None
+                    self._deleted_legacy_keys = ()
+                    return False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, SearchIndexManager._READINESS_MAX_DELAY)
+
+    async def _legacy_documents_visible(self) -> bool:
+        """Return True while the legacy documents deleted by the last upload are still in the index."""
+        for key in self._deleted_legacy_keys:
+            try:
+                await self._get_client().get_document(key=key, selected_fields=['embedId'])
+                return True
+            except ResourceNotFoundError:
+                pass
+        self._deleted_legacy_keys = ()
+        return False
 
     def _raise_if_no_index(self) -> None:
         """
@@ -127,6 +736,9 @@ class SearchIndexManager:
         async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
             await ix_client.delete_index(self._index.name)
         self._index = None
+        self._upload_watermark = None
+        self._deleted_legacy_keys = ()
+        self._invalidate_results()
 
     def _check_dimensions(self, vector_index_dimensions: Optional[int] = None) -> int:
         """
@@ -156,6 +768,79 @@ class SearchIndexManager:
         results = [f"{result['token']}, source: {result['title']}" async for result in response]
         return "\n------\n".join(results)
 
+    def _invalidate_results(self) -> None:
+        """Invalidate the cached search results after the index content has changed."""
+        self._index_version += 1
+        if self._result_cache is not None:
+            self._result_cache.clear()
+        self._similar_queries.clear()
+
+    def get_cache_statistics(self) -> Dict[str, int]:
+        """
+        Return the counters of the search result cache.
+
+        :return: The dictionary with the number of hits, misses, near duplicate hits and cached results.
+        """
+        if self._result_cache is None:
+            return {'hits': 0, 'misses': 0, 'similar_hits': 0, 'size': 0}
+        return {
+            'hits': self._result_cache.hits,
+            'misses': self._result_cache.misses,
+            'similar_hits': self._similar_hits,
+            'size': len(self._result_cache),
+        }
+
+    @staticmethod
+    def _normalize_query(message: str) -> str:
+        """Normalize the case, white spaces and the trailing punctuation of the question."""
+        return " ".join(message.lower().split()).rstrip("?!. ")
+
+    async def _embed_query(self, message: str) -> Any:
+        """Embed the question with the embedding client."""
+        response = await self._embedding_client.embed(
+            input=[message],
+            dimensions=self._dimensions,
+            model=self._embedding_model
+        )
+        return response["data"][0]["embedding"]
+
+    async def _cached_search(
+        self, mode: str, message: str, search: Callable[..., Any], pass_embedding: bool = False
+    ) -> str:
+        """
+        Return the cached result of the search or perform it.
+
+        :param mode: The search mode, a part of the cache key.
+        :param message: The customer question.
+        :param search: The coroutine function performing the search.
+        :param pass_embedding: Pass the embedding of the question, once it is computed to find
+               the similar questions, to the search as the second argument.
+        :return: The context for the question.
+        """
+        self._raise_if_no_index()
+        if self._result_cache is None:
+            return await search(message)
+        key = (self._index_version, mode, self._normalize_query(message))
+        if self._similarity_threshold is None or key in self._result_cache:
+            return await self._result_cache.get_or_load(key, lambda: search(message))
+
+        import numpy as np
+        embedding = np.asarray(await self._embed_query(message), dtype=np.float32)
+        embedding /= np.linalg.norm(embedding) or 1
+        candidates = [(k, e) for k, e in self._similar_queries if k[:2] == key[:2] and k in self._result_cache]
+        if candidates:
+            similarities = np.stack([e for _, e in candidates]) @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self._similarity_threshold:
+                result = self._result_cache.get(candidates[best][0])
+                if result is not None:
+                    self._similar_hits += 1
+                    return result
+        result = await self._result_cache.get_or_load(
+            key, lambda: search(message, embedding) if pass_embedding else search(message))
+        self._similar_queries.append((key, embedding))
+        return result
+
     async def semantic_search(self, message: str) -> str:
         """
         Perform the semantic search on the search resource.
@@ -163,6 +848,19 @@ class SearchIndexManager:
         :param message: The customer question.
         :return: The context for the question.
         """
+        return await self._cached_search('semantic', message, self._semantic_search)
+
+    async def search(self, message: str) -> str:
+        """
+        Search the message in the vector store.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        return await self._cached_search('vector', message, self._search)
+
+    async def _semantic_search(self, message: str) -> str:
+        """Perform the semantic search, bypassing the result cache."""
         self._raise_if_no_index()
         response = await self._get_client().search(
             search_text=message,
@@ -173,14 +871,10 @@ class SearchIndexManager:
         return await self._format_search_results(response)
         
 
-    async def search(self, message: str) -> str:
-        """
-        Search the message in the vector store.
-
-        :param message: The customer question.
-        :return: The context for the question.
-        """
+    async def _search(self, message: str) -> str:
+        """Perform the vector search, bypassing the result cache."""
         self._raise_if_no_index()
+        await self.wait_until_ready()
         vector_query = VectorizableTextQuery(
             text=message,
             k_nearest_neighbors=5,
@@ -190,8 +884,6 @@ class SearchIndexManager:
             vector_queries=[vector_query],
             select=['token', 'title'],
         )
-        # This lag is necessary, despite it is not described in documentation.
-        time.sleep(1)
         return await self._format_search_results(response)
 
     async def create_index(
@@ -300,65 +992,646 @@ class SearchIndexManager:
             input_directory: str,
             output_file: str,
             sentences_per_embedding: int=4,
+            embedding_batch_size: int=512,
+            max_concurrency: int=4,
+            tokens_per_minute: Optional[int]=None,
+            requests_per_minute: Optional[int]=None,
+            incremental: bool=False,
+            delta_file: Optional[str]=None,
+            chunking_workers: Optional[int]=None,
+            chunk_queue_size: int=4096,
             ) -> None:
         """
-        In this method we do lazy loading of nltk and download the needed data set to split
+        Build the embeddings of the markdown and JSON files in the input directory.
 
-        document into tokens. This operation takes time that is why we hide import nltk under this
+        In this method we do lazy loading of nltk and download the needed data set to split
+        document into tokens once. This operation takes time that is why we hide import nltk under this
         method. We also do not include nltk into requirements because this method is only used
         during rag generation.
+        The files are split by a process pool and the chunks are streamed to the embedding
+        stage through the bounded queue, so splitting and embedding overlap.
+        Every chunk is identified by the hash of its content, which is stored in the manifest
+        next to the output file. In the incremental mode only the chunks absent from the
+        manifest are embedded, the embeddings of the other ones are copied from the previous
+        output file.
         :param dimensions: The number of dimensions in the embeddings. Must be the same as
                the one used for SearchIndexManager creation.
         :param input_directory: The directory with the embedding files.
-        :param output_file: The file csv file to store embeddings.
+        :param output_file: The file csv file to store embeddings. If the file has .npy extension,
+               the binary embeddings store is written instead.
         :param embeddings_client: The embedding client, used to create embeddings. 
                 Must be the same as the one used for SearchIndexManager creation.
         :param sentences_per_embedding: The number of sentences used to build embedding.
+        :param embedding_batch_size: The number of chunks embedded in one request.
+        :param max_concurrency: The maximal number of embedding requests in flight.
+        :param tokens_per_minute: The optional budget of embedded tokens per minute.
+        :param requests_per_minute: The optional budget of embedding requests per minute.
+        :param incremental: Reuse the embeddings of unchanged chunks from the previous output file.
+        :param delta_file: The optional embeddings file to write the new or changed chunks to.
+               The IDs of the removed chunks are written to the deletes file next to it,
+               see get_deletes_file. The delta can be applied with upload_documents.
+        :param chunking_workers: The number of processes splitting the files. None means
+               the number of CPUs, 0 means splitting the files in a thread.
+        :param chunk_queue_size: The maximal number of chunks waiting to be embedded.
         """
-        import nltk
-        nltk.download('punkt')
-        
-        from nltk.tokenize import sent_tokenize
-        # Split the data to sentence tokens.
-        sentence_tokens = []
-        references = []
-        globs = glob.glob(input_directory + '/*.md', recursive=True)
-        index = 0
-        for fle in globs:
-            with open(fle) as f:
-                for line in f:
-                    line = line.strip()
-                    # Skip non informative lines.
-                    if len(line) < SearchIndexManager.MIN_LINE_LENGTH or len(set(line)) < SearchIndexManager.MIN_DIFF_CHARACTERS_IN_LINE:
-                        continue
-                    for sentence in sent_tokenize(line):
-                        if index % sentences_per_embedding == 0:
-                            sentence_tokens.append(sentence)
-                            references.append(os.path.split(fle)[-1])
-                        else:
-                            sentence_tokens[-1] += ' '
-                            sentence_tokens[-1] += sentence
-                        index += 1
-        
-        
-        # For each token build the embedding, which will be used in the search.
-        batch_size = 2000
-        with open(output_file, 'w') as fp:
-            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
-            writer.writeheader()
-            for i in range(0, len(sentence_tokens), batch_size):
-                emedding = (await self._embedding_client.embed(
-                    input=sentence_tokens[i:i+min(batch_size, len(sentence_tokens))],
-                    dimensions=self._dimensions,
-                    model=self._embedding_model
-                ))["data"]
-                for token, float_data, reference in zip(sentence_tokens, emedding, references):
-                    writer.writerow({
-                        'token': token,
-                        'embedding': json.dumps(float_data['embedding']),
-                        'title': reference})
+        manifest_file = self.get_manifest_file(output_file)
+        manifest = {
+            'model': self._embedding_model,
+            'dimensions': self._dimensions,
+            'sentences_per_embedding': sentences_per_embedding,
+        }
+        previous_ids = []
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as fp:
+                previous_manifest = json.load(fp)
+            previous_ids = previous_manifest.get('chunks', [])
+            # The embeddings can only be reused if they were built the same way.
+            if any(previous_manifest.get(k) != v for k, v in manifest.items()):
+                incremental = False
+        reusable_ids = set(previous_ids) if incremental and os.path.isfile(output_file) else set()
+        # The IDs of all chunks in the corpus and the chunks, which embeddings will be copied.
+        seen_ids = set()
+        reused_chunks = {}
+
+        async def new_batches() -> AsyncIterator[List[Tuple[str, str]]]:
+            """Group the chunks streamed from the chunking stage, which need to be embedded."""
+            batch = []
+            async for token, title in self._iter_chunks(
+                    input_directory, sentences_per_embedding, chunking_workers, chunk_queue_size):
+                embed_id = self.get_embed_id(token, title)
+                # The identical chunks of the same file share the ID, only the first one is kept.
+                if embed_id in seen_ids:
+                    continue
+                seen_ids.add(embed_id)
+                if embed_id in reusable_ids:
+                    reused_chunks[embed_id] = (token, title)
+                    continue
+                batch.append((token, title))
+                if len(batch) >= embedding_batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        root, extension = os.path.splitext(output_file)
+        tmp_file = root + '.tmp' + extension
+        written_ids = []
+        embedded_count = 0
+        with self.open_embeddings_writer(tmp_file) as writer:
+            delta_writer = self.open_embeddings_writer(delta_file) if delta_file else None
+            try:
+                async def write_embeddings(batches) -> int:
+                    count = 0
+                    # For each new or changed chunk build the embedding, which will be used in the search.
+                    async for embedded in self.embed_chunks(
+                            batches,
+                            max_concurrency=max_concurrency,
+                            tokens_per_minute=tokens_per_minute,
+                            requests_per_minute=requests_per_minute):
+                        for token, reference, embedding in embedded:
+                            writer.write(token, embedding, reference)
+                            written_ids.append(self.get_embed_id(token, reference))
+                            if delta_writer:
+                                delta_writer.write(token, embedding, reference)
+                            count += 1
+                    return count
+
+                embedded_count += await write_embeddings(new_batches())
+                if reused_chunks:
+                    for row in self._read_rows(output_file):
+                        embed_id = self._get_row_embed_id(row)
+                        if reused_chunks.pop(embed_id, None):
+                            writer.write(row['token'], self._parse_embedding(row['embedding']), row['title'])
+                            written_ids.append(embed_id)
+                # The chunks listed in the manifest, but absent from the previous output are embedded again.
+                missing = list(reused_chunks.values())
+                embedded_count += await write_embeddings(
+                    missing[i:i + embedding_batch_size] for i in range(0, len(missing), embedding_batch_size))
+            finally:
+                if delta_writer:
+                    delta_writer.close()
+
+        deleted_ids = [embed_id for embed_id in previous_ids if embed_id not in seen_ids]
+        if delta_file:
+            with open(self.get_deletes_file(delta_file), 'w') as fp:
+                json.dump(deleted_ids, fp)
+        self._replace_embeddings_file(tmp_file, output_file)
+        manifest['chunks'] = written_ids
+        with open(manifest_file, 'w') as fp:
+            json.dump(manifest, fp)
+        logger.info(
+            f"Embedded {embedded_count} of {len(seen_ids)} chunks, "
+            f"{len(deleted_ids)} chunks were removed.")
+
+    async def _iter_chunks(
+            self,
+            input_directory: str,
+            sentences_per_embedding: int,
+            chunking_workers: Optional[int] = None,
+            queue_size: int = 4096
+        ) -> AsyncIterator[Tuple[str, str]]:
+        """
+        Stream the chunks of the markdown and JSON files in the input directory.
+
+        The files are split in parallel by a process pool and the chunks are passed
+        through the bounded queue, so the chunking overlaps with the consumer.
+
+        :param input_directory: The directory with the embedding files.
+        :param sentences_per_embedding: The number of sentences used to build embedding.
+        :param chunking_workers: The number of processes to split the files. None means
+               the number of CPUs, 0 means splitting the files in a thread.
+        :param queue_size: The maximal number of chunks waiting for the consumer.
+        :return: The asynchronous iterator over the chunk text and the file name pairs.
+        """
+        files = sorted(
+            file_name for pattern in SearchIndexManager.CHUNKED_FILE_PATTERNS
+            for file_name in glob.glob(os.path.join(input_directory, pattern)))
+        # Download the tokenizer data once, before the workers need it.
+        _ensure_tokenizer()
+        if chunking_workers is None:
+            chunking_workers = min(len(files), os.cpu_count() or 1)
+        executor = ProcessPoolExecutor(
+            max_workers=chunking_workers, initializer=_ensure_tokenizer, initargs=(False,)
+        ) if chunking_workers and files else None
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=queue_size)
+
+        async def produce() -> None:
+            try:
+                futures = [
+                    loop.run_in_executor(executor, _chunk_file, file_name, sentences_per_embedding)
+                    for file_name in files]
+                # The files are split concurrently, but their chunks are queued in a stable order.
+                for future in futures:
+                    for chunk in await future:
+                        await queue.put(chunk)
+            finally:
+                await queue.put(None)
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                yield chunk
+            await producer
+        finally:
+            producer.cancel()
+            if executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def get_embed_id(token: str, title: str) -> str:
+        """
+        Return the stable document key, derived from the chunk content.
+
+        :param token: The text of the chunk.
+        :param title: The name of the file, the chunk was taken from.
+        :return: The hexadecimal SHA-256 hash of the title and the text.
+        """
+        return hashlib.sha256(f"{title}\0{token}".encode()).hexdigest()
+
+    @staticmethod
+    def _get_row_embed_id(row: Dict[str, Any]) -> str:
+        """Return the key of the embeddings file row."""
+        return row.get('embedId') or SearchIndexManager.get_embed_id(row['token'], row['title'])
+
+    @staticmethod
+    def get_manifest_file(embeddings_file: str) -> str:
+        """
+        Return the path of the manifest with the chunk IDs of the embeddings file.
+
+        :param embeddings_file: The embeddings file.
+        :return: The path to the manifest.
+        """
+        return os.path.splitext(embeddings_file)[0] + '.manifest.json'
+
+    @staticmethod
+    def get_deletes_file(embeddings_file: str) -> str:
+        """
+        Return the path of the file with the IDs of the deleted chunks of the delta.
+
+        :param embeddings_file: The delta embeddings file.
+        :return: The path to the JSON list of deleted IDs.
+        """
+        return os.path.splitext(embeddings_file)[0] + '.deletes.json'
+
+    @staticmethod
+    def _replace_embeddings_file(source_file: str, target_file: str) -> None:
+        """Move the embeddings file together with its metadata sidecar, if any."""
+        os.replace(source_file, target_file)
+        if target_file.endswith(SearchIndexManager.EMBEDDINGS_STORE_EXTENSION):
+            os.replace(
+                SearchIndexManager.get_metadata_file(source_file),
+                SearchIndexManager.get_metadata_file(target_file))
+
+    async def embed_chunks(
+            self,
+            batches: Union[Iterable[List[Tuple[str, str]]], AsyncIterable[List[Tuple[str, str]]]],
+            max_concurrency: int = 4,
+            tokens_per_minute: Optional[int] = None,
+            requests_per_minute: Optional[int] = None,
+            max_retries: int = 5
+        ) -> AsyncIterator[List[Tuple[str, str, List[float]]]]:
+        """
+        Embed the batches of chunks concurrently, yielding the results in the input order.
+
+        Up to max_concurrency embedding requests are in flight, limited by the optional
+        tokens and requests per minute budgets. Throttled requests are retried with
+        exponential backoff.
+
+        :param batches: The batches of (token, title) pairs to embed, may be an asynchronous iterable.
+        :param max_concurrency: The maximal number of embedding requests in flight.
+        :param tokens_per_minute: The budget of tokens per minute, estimated from the text length.
+        :param requests_per_minute: The budget of requests per minute.
+        :param max_retries: The number of retries of a throttled request.
+        :return: The asynchronous iterator over batches of (token, title, embedding) triples.
+        """
+        token_budget = RateBudget(tokens_per_minute) if tokens_per_minute else None
+        request_budget = RateBudget(requests_per_minute) if requests_per_minute else None
+
+        async def embed_batch(batch_number: int, batch: List[Tuple[str, str]]) -> Tuple[int, List[List[float]]]:
+            texts = [token for token, _ in batch]
+            if token_budget:
+                await token_budget.acquire(sum(self._estimate_tokens(text) for text in texts))
+            for attempt in range(max_retries + 1):
+                if request_budget:
+                    await request_budget.acquire()
+                try:
+                    response = await self._embedding_client.embed(
+                        input=texts,
+                        dimensions=self._dimensions,
+                        model=self._embedding_model
+                    )
+                    break
+                except HttpResponseError as e:
+                    if e.status_code not in SearchIndexManager._RETRYABLE_STATUS_CODES or attempt == max_retries:
+                        raise
+                    logger.warning(f"Embedding request was throttled, retrying: {e}")
+                await asyncio.sleep(min(2 ** attempt, 30) * (0.5 + random.random() / 2))
+            data = response["data"]
+            if len(data) != len(texts):
+                raise ValueError(f"Expected {len(texts)} embeddings, got {len(data)}.")
+            # The embeddings may come in any order, they are matched to the input by index.
+            if all('index' in item for item in data):
+                data = sorted(data, key=lambda item: item['index'])
+            return batch_number, [item['embedding'] for item in data]
+
+        pending = set()
+        results = {}
+        # The batches submitted, but not yielded yet. Their number is bounded, so a slow
+        # batch does not make the results of the following ones accumulate in memory.
+        submitted = {}
+        next_batch = 0
+        if hasattr(batches, '__aiter__'):
+            async_batches = batches.__aiter__()
+
+            async def next_batch_or_none() -> Optional[List[Tuple[str, str]]]:
+                try:
+                    return await async_batches.__anext__()
+                except StopAsyncIteration:
+                    return None
+        else:
+            sync_batches = iter(batches)
+
+            async def next_batch_or_none() -> Optional[List[Tuple[str, str]]]:
+                return next(sync_batches, None)
+        try:
+            while True:
+                batch = await next_batch_or_none()
+                if batch is None and not pending:
+                    break
+                while pending and (batch is None or len(pending) >= max_concurrency
+                                   or len(submitted) >= 2 * max_concurrency):
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    results.update(task.result() for task in finished)
+                    while next_batch in results:
+                        yield self._join_embeddings(submitted.pop(next_batch), results.pop(next_batch))
+                        next_batch += 1
+                    if batch is None:
+                        break
+                if batch is not None:
+                    batch_number = next_batch + len(submitted)
+                    submitted[batch_number] = batch
+                    pending.add(asyncio.ensure_future(embed_batch(batch_number, batch)))
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _join_embeddings(
+            batch: List[Tuple[str, str]],
+            embeddings: List[List[float]]
+        ) -> List[Tuple[str, str, List[float]]]:
+        """Pair every chunk of the batch with its embedding."""
+        return [(token, title, embedding) for (token, title), embedding in zip(batch, embeddings)]
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        """Estimate the number of tokens in the text, about four characters per token."""
+        return len(text) // 4 + 1
 
     async def close(self):
         """Close the closeable resources, associated with SearchIndexManager."""
         if self._client:
             await self._client.close()
+
+
+class _LocalIndex:
+    """
+    The in-memory index of normalized float32 embeddings and of the chunk terms.
+
+    The vector search is the brute force cosine similarity, unless the number of documents
+    reaches ann_threshold. Then the inverted file (IVF) index is built: the documents are
+    clustered by spherical k-means and only the ann_probes closest clusters are scanned.
+
+    :param name: The name of the index.
+    :param documents: The ordered mapping of the document key to token, title and embedding.
+    :param dimensions: The number of dimensions of the embeddings.
+    :param ann_threshold: The number of documents to build the IVF index from.
+    :param ann_probes: The number of clusters scanned by the IVF search.
+    """
+
+    _KMEANS_ITERATIONS = 10
+    _KMEANS_SAMPLES_PER_CLUSTER = 64
+    _BLOCK_ROWS = 65536
+
+    def __init__(
+            self,
+            name: str,
+            documents: Dict[str, Tuple[str, str, Any]],
+            dimensions: int,
+            ann_threshold: int,
+            ann_probes: int
+        ) -> None:
+        """Constructor."""
+        import numpy as np
+        self.name = name
+        self.tokens = [token for token, _, _ in documents.values()]
+        self.titles = [title for _, title, _ in documents.values()]
+        self.matrix = np.zeros((len(documents), dimensions), dtype=np.float32)
+        for row, (_, _, embedding) in enumerate(documents.values()):
+            self.matrix[row] = embedding
+        norms = np.linalg.norm(self.matrix, axis=1, keepdims=True)
+        self.matrix /= np.where(norms == 0, 1, norms)
+        self._ann_probes = ann_probes
+        self._centroids = None
+        self._lists = None
+        if len(documents) >= ann_threshold:
+            self._build_ivf()
+        self._build_terms()
+
+    @staticmethod
+    def terms(text: str) -> List[str]:
+        """Split the text to the lower case terms."""
+        return re.findall(r"\w+", text.lower())
+
+    def _build_ivf(self) -> None:
+        """Cluster the embeddings and build the inverted lists of the IVF index."""
+        import numpy as np
+        rng = np.random.default_rng(0)
+        n = self.matrix.shape[0]
+        clusters = max(1, int(np.sqrt(n)))
+        sample = self.matrix[rng.choice(n, min(n, clusters * _LocalIndex._KMEANS_SAMPLES_PER_CLUSTER), replace=False)]
+        centroids = sample[rng.choice(sample.shape[0], clusters, replace=False)].copy()
+        for _ in range(_LocalIndex._KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # The empty clusters keep their previous centroids.
+            centroids = np.where(norms > 0, sums / np.where(norms == 0, 1, norms), centroids)
+        assignment = np.concatenate([
+            np.argmax(self.matrix[start:start + _LocalIndex._BLOCK_ROWS] @ centroids.T, axis=1)
+            for start in range(0, n, _LocalIndex._BLOCK_ROWS)])
+        self._centroids = centroids
+        self._lists = [np.flatnonzero(assignment == cluster) for cluster in range(clusters)]
+
+    def _build_terms(self) -> None:
+        """Build the postings of every term, the rows and the frequencies, for the BM25 ranking."""
+        import numpy as np
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        self._lengths = np.zeros(len(self.tokens), dtype=np.float32)
+        for row, (token, title) in enumerate(zip(self.tokens, self.titles)):
+            term_frequencies = Counter(self.terms(f"{token} {title}"))
+            self._lengths[row] = sum(term_frequencies.values())
+            for term, frequency in term_frequencies.items():
+                rows, frequencies = postings.setdefault(term, ([], []))
+                rows.append(row)
+                frequencies.append(frequency)
+        self._average_length = float(self._lengths.mean()) if len(self._lengths) else 0.0
+        n = len(self.tokens)
+        # The rows, the frequencies and the inverse document frequency of each term.
+        self._postings = {
+            term: (
+                np.array(rows, dtype=np.int64),
+                np.array(frequencies, dtype=np.float32),
+                float(np.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))))
+            for term, (rows, frequencies) in postings.items()}
+
+    def vector_search(self, query: Any, k: int) -> List[int]:
+        """
+        Return the rows of the k documents closest to the query embedding.
+
+        :param query: The query embedding.
+        :param k: The number of documents to return.
+        :return: The rows of the documents, the closest first.
+        """
+        import numpy as np
+        # Normalize a copy, the embedding of the caller is left as it is.
+        query = np.array(query, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        if self._centroids is not None:
+            probes = np.argsort(-(self._centroids @ query))[:self._ann_probes]
+            candidates = np.concatenate([self._lists[probe] for probe in probes])
+        else:
+            candidates = np.arange(self.matrix.shape[0])
+        return self._top_k(candidates, self.matrix[candidates] @ query, k)
+
+    def text_search(self, text: str, k: int, k1: float = 1.2, b: float = 0.75) -> List[int]:
+        """
+        Return the rows of the k documents best matching the text by BM25.
+
+        :param text: The query text.
+        :param k: The number of documents to return.
+        :return: The rows of the documents, the best first.
+        """
+        import numpy as np
+        # Only the documents containing a query term are scored.
+        matches = []
+        for term in set(self.terms(text)):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            rows, frequencies, idf = posting
+            matches.append((rows, idf * frequencies * (k1 + 1) / (
+                frequencies + k1 * (1 - b + b * self._lengths[rows] / (self._average_length or 1)))))
+        if not matches:
+            return []
+        matching, positions = np.unique(np.concatenate([rows for rows, _ in matches]), return_inverse=True)
+        scores = np.bincount(positions, weights=np.concatenate([term_scores for _, term_scores in matches]))
+        return self._top_k(matching, scores, k)
+
+    @staticmethod
+    def _top_k(candidates: Any, scores: Any, k: int) -> List[int]:
+        """Return the k candidates with the highest scores, the highest first."""
+        import numpy as np
+        if len(candidates) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[best], scores[best]
+        return [int(candidates[i]) for i in np.argsort(-scores, kind='stable')]
+
+
+class LocalSearchIndexManager(SearchIndexManager):
+    """
+    The in-process search backend with the same surface as SearchIndexManager.
+
+    The documents are kept in the NumPy float32 matrix, so no search service nor network
+    is needed, which is useful for development and for the offline tests. The query
+    embedding is built by the injected embedding client, the semantic search is replaced
+    by the BM25 ranking of the chunk text and title.
+
+    :param index_name: The name of the index.
+    :param dimensions: The number of dimensions in the embedding.
+    :param model: The embedding model to be used,
+                  must be the same as one use to build the file with embeddings.
+    :param embedding_client: The embedding client, used to embed the queries.
+    :param ann_threshold: The number of documents starting from which the approximate
+                          IVF index is used instead of the brute force search.
+    :param ann_probes: The number of clusters scanned by the approximate search.
+    :param top_k: The number of chunks returned by the search.
+    :param kwargs: The result cache parameters of SearchIndexManager.
+    """
+
+    def __init__(
+            self,
+            index_name: str,
+            dimensions: Optional[int],
+            model: str,
+            embedding_client: Any,
+            ann_threshold: int = 50000,
+            ann_probes: int = 8,
+            top_k: int = 5,
+            **kwargs
+        ) -> None:
+        """Constructor."""
+        super().__init__(
+            endpoint="",
+            credential=None,
+            index_name=index_name,
+            dimensions=dimensions,
+            model=model,
+            deployment_name=model,
+            embedding_endpoint="",
+            embed_api_key=None,
+            embedding_client=embedding_client,
+            **kwargs)
+        self._ann_threshold = ann_threshold
+        self._ann_probes = ann_probes
+        self._top_k = top_k
+        self._vector_dimensions = dimensions
+        self._documents: Dict[str, Tuple[str, str, Any]] = {}
+
+    async def create_index(
+        self,
+        vector_index_dimensions: Optional[int] = None,
+        raise_on_error: bool=False
+        ) -> bool:
+        """
+        Create index or return false if it already exists.
+
+        :param vector_index_dimensions: The number of dimensions in the vector index.
+        :param raise_on_error: Raise if index creation was not successful.
+        :return: True if index was created, False otherwise.
+        :raises: Value error if both dimensions of embedding model and vector_index_dimensions are not set
+                 or both of them are set and they do not equal each other.
+        """
+        vector_index_dimensions = self._check_dimensions(vector_index_dimensions)
+        if self._index is not None:
+            if raise_on_error:
+                raise ValueError(f"The index {self._index_name} already exists.")
+            return False
+        self._vector_dimensions = vector_index_dimensions
+        self._documents = {}
+        self._rebuild()
+        return True
+
+    async def upload_documents(self, embeddings_file: str, **kwargs) -> None:
+        """
+        Load the embeggings file to the index.
+
+        The delta written by build_embeddings_file is merged into the index.
+
+        :param embeddings_file: The embeddings file to upload, either the CSV file
+               or the .npy file of the binary embeddings store.
+        """
+        import numpy as np
+        self._raise_if_no_index()
+        deletes_file = self.get_deletes_file(embeddings_file)
+        if os.path.isfile(deletes_file):
+            with open(deletes_file) as fp:
+                for embed_id in json.load(fp):
+                    self._documents.pop(embed_id, None)
+        for row in self._read_rows(embeddings_file):
+            embedding = np.asarray(self._parse_embedding(row['embedding']), dtype=np.float32)
+            if embedding.shape != (self._vector_dimensions,):
+                raise ValueError(
+                    f"Expected embedding of {self._vector_dimensions} dimensions, got {embedding.shape[0]}.")
+            self._documents[self._get_row_embed_id(row)] = (row['token'], row['title'], embedding)
+        self._rebuild()
+        self._invalidate_results()
+
+    def _rebuild(self) -> None:
+        """Rebuild the in-memory index from the documents."""
+        self._index = _LocalIndex(
+            self._index_name, self._documents, self._vector_dimensions, self._ann_threshold, self._ann_probes)
+
+    async def delete_index(self):
+        """Delete the index from memory."""
+        self._raise_if_no_index()
+        self._index = None
+        self._documents = {}
+        self._invalidate_results()
+
+    async def _format_rows(self, rows: List[int]) -> str:
+        """Format the documents at the given rows as the search result."""
+        async def results():
+            for row in rows:
+                yield {'token': self._index.tokens[row], 'title': self._index.titles[row]}
+        return await self._format_search_results(results())
+
+    async def _semantic_search(self, message: str) -> str:
+        """Perform the BM25 text search on the chunk text and title."""
+        self._raise_if_no_index()
+        return await self._format_rows(self._index.text_search(message, self._top_k))
+
+    async def search(self, message: str) -> str:
+        """
+        Search the message in the in-memory index.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        return await self._cached_search('vector', message, self._search, pass_embedding=True)
+
+    async def _search(self, message: str, embedding: Optional[Any] = None) -> str:
+        """Search the embedding of the message in the in-memory index, embedding it unless it is given."""
+        self._raise_if_no_index()
+        if embedding is None:
+            embedding = await self._embed_query(message)
+        return await self._format_rows(self._index.vector_search(embedding, self._top_k))
+
+    async def close(self):
+        """Nothing to close, the embedding client is owned by the caller."""
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Convert the embeddings file between the CSV and the binary .npy store formats.")
+    parser.add_argument("input_file", help="The embeddings file to read, e.g. data/embeddings.csv.")
+    parser.add_argument("output_file", help="The embeddings file to write, e.g. data/embeddings.npy.")
+    args = parser.parse_args()
+    converted = SearchIndexManager.convert_embeddings_file(args.input_file, args.output_file)
+    print(f"Converted {converted} embeddings to {args.output_file}.")
@@ -0,0 +1,126 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import contextlib
+import json
+from typing import Any, AsyncIterator, List, NamedTuple, Optional, Union
+
+try:
+    import orjson
+
+    def dumps(data: Any) -> str:
+        """Return the compact JSON representation of the data."""
+        return orjson.dumps(data).decode("utf-8")
+except ImportError:
+    _encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def dumps(data: Any) -> str:
+        """Return the compact JSON representation of the data."""
+        return _encoder.encode(data)
+
+
+def serialize_sse_event(data: Any) -> str:
+    return f"data: {dumps(data)}\n\n"
+
+
+class TextDelta(NamedTuple):
+    """The text of the message delta, which is serialized together with the adjacent deltas."""
+    text: str
+
+
+async def coalesce_deltas(
+        events: AsyncIterator[Union[str, TextDelta]],
+        window: float = 0.03,
+        max_chars: int = 1024,
+        max_frames: int = 64
+    ) -> AsyncIterator[str]:
+    """
+    Merge the text deltas into fewer server sent events.
+
+    The first delta is sent at once to keep the time to first token low. The following
+    deltas are buffered until the window elapses, the buffer reaches max_chars or
+    another event arrives, and are sent as one message frame. The serialized events
+    are passed through in order. At most max_frames frames wait for the consumer;
+    when the client reads slower, the source is not read until the frames are taken.
+
+    :param events: The serialized events and the text deltas.
+    :param window: The time in seconds the delta may wait for the next ones. Zero disables coalescing.
+    :param max_chars: The number of buffered characters sent without waiting for the window.
+    :param max_frames: The maximal number of frames waiting for the consumer.
+    """
+    loop = asyncio.get_running_loop()
+    # The frames ready to be sent, followed by the end marker or the exception of the source.
+    frames: asyncio.Queue[Any] = asyncio.Queue(maxsize=max_frames)
+    buffer: List[str] = []
+    size = 0
+    timer: Optional[asyncio.TimerHandle] = None
+    end = object()
+
+    def take() -> Optional[str]:
+        nonlocal size, timer
+        if timer is not None:
+            timer.cancel()
+            timer = None
+        if not buffer:
+            return None
+        frame = serialize_sse_event({'content': "".join(buffer), 'type': "message"})
+        buffer.clear()
+        size = 0
+        return frame
+
+    def on_timer() -> None:
+        nonlocal timer
+        timer = None
+        if frames.full():
+            # The consumer is behind, keep merging the deltas.
+            timer = loop.call_later(window, on_timer)
+            return
+        frame = take()
+        if frame is not None:
+            frames.put_nowait(frame)
+
+    async def flush() -> None:
+        frame = take()
+        if frame is not None:
+            await frames.put(frame)
+
+    async def pump() -> None:
+        nonlocal size, timer
+        first = True
+        try:
+            async for event in events:
+                if isinstance(event, TextDelta):
+                    buffer.append(event.text)
+                    size += len(event.text)
+                    if first or window <= 0 or size >= max_chars:
+                        first = False
+                        await flush()
+                    elif timer is None:
+                        timer = loop.call_later(window, on_timer)
+                else:
+                    await flush()
+                    await frames.put(event)
+            await flush()
+            await frames.put(end)
+        except Exception as e:
+            await flush()
+            await frames.put(e)
+
+    # One task per stream reads the source, so that the timer can flush while it waits.
+    task = asyncio.ensure_future(pump())
+    try:
+        while True:
+            frame = await frames.get()
+            if frame is end:
+                break
+            if isinstance(frame, Exception):
+                raise frame
+            yield frame
+    finally:
+        task.cancel()
+        if timer is not None:
+            timer.cancel()
+        # Let the source run its cleanup before the caller goes on, e.g. closing the run stream.
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
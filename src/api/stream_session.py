@@ -0,0 +1,193 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import logging
+import secrets
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger("azureaiapp")
+
+
+def format_event_id(stream_id: str, sequence: int) -> str:
+    """Return the SSE event ID of the event of the stream."""
+    return f"{stream_id}-{sequence}"
+
+
+def parse_event_id(event_id: str) -> Optional[Tuple[str, int]]:
+    """
+    Return the stream ID and the sequence number of the SSE event ID.
+
+    :param event_id: The value of the Last-Event-ID header.
+    :return: The stream ID and the sequence number or None if the ID is malformed.
+    """
+    stream_id, _, sequence = event_id.rpartition("-")
+    if not stream_id or not sequence.isdigit():
+        return None
+    return stream_id, int(sequence)
+
+
+class EventsExpired(LookupError):
+    """The events the client has not received were dropped from the ring buffer."""
+
+
+class StreamSession:
+    """
+    The server sent events of one run, shared by the connections of the client.
+
+    The frames are read from the source in the background and kept in a ring buffer,
+    so that a client which reconnects with Last-Event-ID gets the events it missed
+    and then follows the run. The source is not read ahead of the slowest connected
+    client by more than the buffer size. When no client has been connected for the
+    grace period, from the start or since the last one left, the source is cancelled.
+    A client which disconnects for good therefore lets the run continue for the grace.
+
+    The session lives in the memory of the process, a reconnection reaching another
+    worker does not find it.
+
+    :param frames: The serialized events of the run.
+    :param thread_id: The thread of the run, the reconnecting client must own it.
+    :param max_events: The number of events kept for the replay.
+    :param grace: The time in seconds the run continues without a connected client.
+    :param on_finished: The callback called when the source is exhausted or cancelled.
+    :param on_not_started: The callback called when the session is cancelled before the source started,
+        the cleanup of a source which never started does not run, e.g. to release what it owns.
+    """
+
+    def __init__(
+            self,
+            frames: AsyncIterator[str],
+            thread_id: str,
+            max_events: int = 256,
+            grace: float = 15.0,
+            on_finished: Optional[Callable[["StreamSession"], None]] = None,
+            on_not_started: Optional[Callable[[], None]] = None
+        ) -> None:
+        """Constructor."""
+        self.stream_id = secrets.token_urlsafe(12)
+        self.thread_id = thread_id
+        self._frames = frames
+        self._max_events = max_events
+        self._grace = grace
+        self._events: Deque[Tuple[int, str]] = deque(maxlen=max_events)
+        self._last = 0
+        self._changed = asyncio.Condition()
+        # The last sequence number delivered to every connected subscriber.
+        self._positions: Dict[int, int] = {}
+        self._next_subscriber = 0
+        self._task: Optional[asyncio.Task[None]] = None
+        self._abandon_timer: Optional[asyncio.TimerHandle] = None
+        self._on_finished = on_finished
+        self._on_not_started = on_not_started
+        self._started = False
+        # The loop keeps only weak references to the tasks.
+        self._notifications: Set[asyncio.Task[None]] = set()
+        self.finished = False
+
+    def start(self) -> None:
+        """Start reading the frames in the background."""
+        self._task = asyncio.ensure_future(self._pump())
+        # The pump does not run at all when it is cancelled before its first step.
+        self._task.add_done_callback(self._on_pump_done)
+        # The client may never subscribe, e.g. when it left before the response started.
+        if not self._positions:
+            self._abandon_timer = asyncio.get_running_loop().call_later(self._grace, self._abandon)
+
+    def can_resume(self, after: int) -> bool:
+        """
+        Return True if the events following the given sequence number are still available.
+
+        :param after: The sequence number of the last event the client has received.
+        """
+        oldest = self._events[0][0] if self._events else self._last + 1
+        return after + 1 >= oldest
+
+    def cancel(self) -> None:
+        """Stop reading the frames, which cancels the run."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _pump(self) -> None:
+        # Reading the first frame starts the source, which then runs its cleanup when it is closed.
+        self._started = True
+        try:
+            async for frame in self._frames:
+                async with self._changed:
+                    # Wait for the slowest client before overwriting the events it has not seen.
+                    await self._changed.wait_for(
+                        lambda: not self._positions
+                        or self._last - min(self._positions.values()) < self._max_events)
+                    self._last += 1
+                    event_id = format_event_id(self.stream_id, self._last)
+                    self._events.append((self._last, f"id: {event_id}\n{frame}"))
+                    self._changed.notify_all()
+        finally:
+            # Run the cleanup of the source now, not when it is garbage collected.
+            aclose = getattr(self._frames, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            self._finish()
+
+    def _on_pump_done(self, task: asyncio.Task[None]) -> None:
+        if not self._started:
+            if self._on_not_started is not None:
+                self._on_not_started()
+            self._finish()
+
+    def _finish(self) -> None:
+        self.finished = True
+        if self._on_finished is not None:
+            self._on_finished(self)
+        # Waking up the subscribers must not be interrupted by the cancellation.
+        self._schedule_notify()
+
+    async def subscribe(self, after: int = 0) -> AsyncIterator[str]:
+        """
+        Yield the events following the given sequence number until the run finishes.
+
+        :param after: The sequence number of the last event the client has received.
+        :raises EventsExpired: If some of the events following it were dropped from the ring buffer.
+        """
+        subscriber = self._next_subscriber
+        self._next_subscriber += 1
+        self._positions[subscriber] = after
+        if self._abandon_timer is not None:
+            self._abandon_timer.cancel()
+            self._abandon_timer = None
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self._last > self._positions[subscriber] or self.finished)
+                    pending = [e for e in self._events if e[0] > self._positions[subscriber]]
+                if not pending:
+                    return
+                if pending[0][0] > self._positions[subscriber] + 1:
+                    raise EventsExpired(
+                        f"The events of the stream {self.stream_id} after {self._positions[subscriber]} have expired")
+                for sequence, frame in pending:
+                    self._positions[subscriber] = sequence
+                    yield frame
+                async with self._changed:
+                    self._changed.notify_all()
+        finally:
+            del self._positions[subscriber]
+            if not self._positions and not self.finished:
+                self._abandon_timer = asyncio.get_running_loop().call_later(self._grace, self._abandon)
+            # The producer may wait for this subscriber.
+            self._schedule_notify()
+
+    def _schedule_notify(self) -> None:
+        task = asyncio.ensure_future(self._notify())
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _abandon(self) -> None:
+        self._abandon_timer = None
+        if not self._positions:
+            logger.info(f"No client reconnected to the stream {self.stream_id}, cancelling it")
+            self.cancel()
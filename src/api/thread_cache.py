@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+from typing import Dict, Optional
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from opentelemetry import metrics
+
+try:
+    from .async_cache import AsyncLRUCache
+except ImportError:
+    from async_cache import AsyncLRUCache
+
+meter = metrics.get_meter(__name__)
+
+
+def is_not_found(error: Exception) -> bool:
+    """Return True if the error means that the requested resource does not exist."""
+    return isinstance(error, ResourceNotFoundError) or (
+        isinstance(error, HttpResponseError) and error.status_code == 404)
+
+
+class ThreadCache:
+    """
+    The per worker cache of thread IDs known to exist.
+
+    The requests with a known thread ID skip the threads.get round trip. The latency
+    saved is estimated from the moving average of the lookups the cache has avoided.
+
+    :param maxsize: The maximal number of thread IDs to remember.
+    :param ttl: The time in seconds a thread ID is trusted without checking it.
+    """
+
+    _SMOOTHING = 0.1
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600.0) -> None:
+        """Constructor."""
+        self._threads: AsyncLRUCache[bool] = AsyncLRUCache(maxsize=maxsize, ttl=ttl)
+        # Deleted threads mapped to the threads which replaced them after the response
+        # cookie had already been sent.
+        self._replaced: AsyncLRUCache[str] = AsyncLRUCache(maxsize=maxsize, ttl=ttl)
+        self._average_lookup: Optional[float] = None
+        self.lookups = 0
+        self.saved_seconds = 0.0
+        self._hits_counter = meter.create_counter(
+            "thread_cache.hits", description="The number of thread lookups skipped thanks to the cache.")
+        self._lookups_counter = meter.create_counter(
+            "thread_cache.lookups", description="The number of threads.get calls made to validate a thread.")
+        self._saved_histogram = meter.create_histogram(
+            "thread_cache.saved_latency", unit="ms", description="The estimated latency saved by a cache hit.")
+
+    @property
+    def hits(self) -> int:
+        return self._threads.hits
+
+    def is_known(self, thread_id: str) -> bool:
+        """
+        Return True if the thread was seen recently and can be used without checking it.
+
+        :param thread_id: The ID of the thread.
+        """
+        if self._threads.get(thread_id) is None:
+            return False
+        self._hits_counter.add(1)
+        if self._average_lookup is not None:
+            self.saved_seconds += self._average_lookup
+            self._saved_histogram.record(self._average_lookup * 1000)
+        return True
+
+    def remember(self, thread_id: str) -> None:
+        """Remember the thread which is known to exist."""
+        self._threads.set(thread_id, True)
+
+    def forget(self, thread_id: str) -> None:
+        """Forget the thread, e.g. after the service reported that it does not exist."""
+        self._threads.invalidate(thread_id)
+
+    def replace(self, stale_thread_id: str, thread_id: str) -> None:
+        """
+        Remember that the stale thread was replaced by the new one.
+
+        :param stale_thread_id: The ID of the thread which does not exist anymore.
+        :param thread_id: The ID of the thread continuing the conversation.
+        """
+        self.forget(stale_thread_id)
+        self.remember(thread_id)
+        self._replaced.set(stale_thread_id, thread_id)
+
+    def replacement(self, thread_id: str) -> Optional[str]:
+        """Return the ID of the thread which replaced the given one, if any."""
+        return self._replaced.get(thread_id)
+
+    def record_lookup(self, seconds: float) -> None:
+        """
+        Record the duration of the threads.get call, made because the thread was not cached.
+
+        :param seconds: The duration of the call.
+        """
+        self.lookups += 1
+        self._lookups_counter.add(1)
+        if self._average_lookup is None:
+            self._average_lookup = seconds
+        else:
+            self._average_lookup += ThreadCache._SMOOTHING * (seconds - self._average_lookup)
+
+    def statistics(self) -> Dict[str, float]:
+        """Return the counters of the cache."""
+        return {
+            "hits": self.hits,
+            "lookups": self.lookups,
+            "average_lookup_ms": (self._average_lookup or 0.0) * 1000,
+            "saved_ms": self.saved_seconds * 1000,
+        }
@@ -0,0 +1,139 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+from azure.ai.agents.aio import AgentsClient
+
+logger = logging.getLogger("azureaiapp")
+
+
+class ThreadPool:
+    """
+    The per worker pool of empty threads created ahead of the first message of a session.
+
+    A new session takes a thread from the pool without waiting for threads.create,
+    while the background task refills the pool and deletes the threads which were
+    not used within their lifetime.
+
+    :param agent_client: The agents client used to create and delete the threads.
+    :param size: The number of empty threads to keep ready.
+    :param max_age: The time in seconds after which an unused thread is deleted.
+    :param reap_interval: The interval in seconds between the checks for stale threads.
+    :param clock: The monotonic clock used to age the threads.
+    """
+
+    _RETRY_INITIAL_DELAY = 1.0
+    _RETRY_MAX_DELAY = 60.0
+
+    def __init__(
+            self,
+            agent_client: AgentsClient,
+            size: int = 4,
+            max_age: float = 3600.0,
+            reap_interval: float = 60.0,
+            clock: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        if size < 0:
+            raise ValueError("size must not be negative.")
+        self._agent_client = agent_client
+        self._size = size
+        self._max_age = max_age
+        self._reap_interval = reap_interval
+        self._clock = clock
+        # The pooled thread IDs with their creation time, oldest first.
+        self._threads: Deque[Tuple[float, str]] = deque()
+        self._wanted = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._threads)
+
+    def start(self) -> None:
+        """Start filling the pool in the background."""
+        if self._task is None and self._size:
+            self._wanted.set()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, delete_threads: bool = True) -> None:
+        """
+        Stop the background task.
+
+        :param delete_threads: If True, delete the threads left in the pool.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if delete_threads:
+            await self._delete([thread_id for _, thread_id in self._threads])
+        self._threads.clear()
+
+    async def acquire(self) -> str:
+        """
+        Return the ID of an empty thread, creating one only if the pool is exhausted.
+
+        :return: The thread ID.
+        """
+        self._reap()
+        self._wanted.set()
+        if self._threads:
+            self.hits += 1
+            return self._threads.pop()[1]
+        self.misses += 1
+        thread = await self._agent_client.threads.create()
+        return thread.id
+
+    def _reap(self) -> None:
+        """Remove the threads older than max_age from the pool and delete them in the background."""
+        stale = []
+        deadline = self._clock() - self._max_age
+        while self._threads and self._threads[0][0] <= deadline:
+            stale.append(self._threads.popleft()[1])
+        if stale:
+            logger.info(f"Deleting {len(stale)} stale pooled threads")
+            asyncio.ensure_future(self._delete(stale))
+
+    async def _delete(self, thread_ids) -> None:
+        results = await asyncio.gather(
+            *(self._agent_client.threads.delete(thread_id) for thread_id in thread_ids),
+            return_exceptions=True)
+        for thread_id, result in zip(thread_ids, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Error deleting pooled thread {thread_id}: {result}")
+
+    async def _run(self) -> None:
+        delay = ThreadPool._RETRY_INITIAL_DELAY
+        while True:
+            try:
+                await asyncio.wait_for(self._wanted.wait(), timeout=self._reap_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wanted.clear()
+            self._reap()
+            missing = self._size - len(self._threads)
+            if missing <= 0:
+                continue
+            results = await asyncio.gather(
+                *(self._agent_client.threads.create() for _ in range(missing)),
+                return_exceptions=True)
+            now = self._clock()
+            errors = [r for r in results if isinstance(r, Exception)]
+            self._threads.extend((now, r.id) for r in results if not isinstance(r, Exception))
+            if errors:
+                logger.warning(f"Error refilling the thread pool: {errors[0]}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, ThreadPool._RETRY_MAX_DELAY)
+                self._wanted.set()
+            else:
+                delay = ThreadPool._RETRY_INITIAL_DELAY
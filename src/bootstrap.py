@@ -0,0 +1,313 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Mapping, Optional
+
+from azure.ai.agents.aio import AgentsClient
+from azure.ai.agents.models import Agent, FilePurpose, VectorStore
+from azure.core.exceptions import ResourceNotFoundError
+
+logger = logging.getLogger("azureaiapp")
+
+# The directory of the files written by the bootstrap, next to the app.
+BOOTSTRAP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".bootstrap")
+
+# The settings which select the agent and its resources.
+CONFIG_VARIABLES = (
+    "AZURE_EXISTING_AIPROJECT_ENDPOINT",
+    "AZURE_AI_AGENT_NAME",
+    "AZURE_AI_AGENT_DEPLOYMENT_NAME",
+    "AZURE_AI_SEARCH_ENDPOINT",
+    "AZURE_AI_SEARCH_INDEX_NAME",
+    "AZURE_AI_EMBED_DEPLOYMENT_NAME",
+)
+
+# The metadata key of the vector stores holding the hash of their files.
+CONTENT_HASH_KEY = "content_sha256"
+
+_UNUSABLE_FILE_STATUSES = ("error", "deleting", "deleted")
+
+
+def file_digest(path: str) -> str:
+    """Return the SHA-256 hash of the contents of the file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def contents_digest(file_digests: Dict[str, str]) -> str:
+    """
+    Return the hash of a set of files.
+
+    :param file_digests: The hash of every file by its name.
+    """
+    return hashlib.sha256(json.dumps(sorted(file_digests.items())).encode()).hexdigest()
+
+
+def config_digest(environ: Mapping[str, str] = os.environ) -> str:
+    """Return the hash of the settings which select the agent and its resources."""
+    return hashlib.sha256(json.dumps([environ.get(name, "") for name in CONFIG_VARIABLES]).encode()).hexdigest()
+
+
+def agent_digest(agent: Agent) -> str:
+    """Return the hash of the agent definition."""
+    return hashlib.sha256(json.dumps(agent.as_dict(), sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True, default=str)
+    os.replace(temporary, path)
+
+
+class BootstrapManifest:
+    """
+    The resources created by the previous bootstraps, by the hash of their contents.
+
+    It is a JSON file next to the app, so a restart skips the files which were
+    already uploaded and the vector store which already holds them.
+
+    :param path: The path of the manifest file.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Constructor."""
+        self.path = path
+        # The file ID by the hash of the file.
+        self.files: Dict[str, str] = {}
+        # The vector store ID by the hash of its files.
+        self.vector_stores: Dict[str, str] = {}
+
+    @classmethod
+    def load(cls, path: str) -> "BootstrapManifest":
+        """Read the manifest, or return an empty one if it is missing or unreadable."""
+        manifest = cls(path)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            manifest.files = dict(data.get("files", {}))
+            manifest.vector_stores = dict(data.get("vector_stores", {}))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"Ignoring the unreadable bootstrap manifest {path}: {e}")
+        return manifest
+
+    def save(self) -> None:
+        """Write the manifest atomically."""
+        _write_json(self.path, {"files": self.files, "vector_stores": self.vector_stores})
+
+
+def _save_manifest(manifest: BootstrapManifest) -> None:
+    # A read-only app directory only costs the reuse of the resources by the next bootstrap.
+    try:
+        manifest.save()
+    except OSError as e:
+        logger.warning(f"Could not write the bootstrap manifest {manifest.path}: {e}")
+
+
+async def _existing_file_id(agents_client: AgentsClient, file_id: str) -> bool:
+    try:
+        file = await agents_client.files.get(file_id)
+    except ResourceNotFoundError:
+        return False
+    return file.status not in _UNUSABLE_FILE_STATUSES
+
+
+async def upload_files(
+        agents_client: AgentsClient,
+        file_paths: List[str],
+        manifest: BootstrapManifest,
+        concurrency: int = 8) -> List[str]:
+    """
+    Upload the files which were not uploaded yet, at most concurrency at a time.
+
+    :param agents_client: The agents client.
+    :param file_paths: The paths of the files.
+    :param manifest: The manifest of the uploaded files, updated with the new uploads.
+    :param concurrency: The maximal number of concurrent uploads.
+    :return: The file IDs in the order of the paths.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def ensure_uploaded(file_path: str) -> str:
+        digest = file_digest(file_path)
+        async with semaphore:
+            file_id = manifest.files.get(digest)
+            if file_id and await _existing_file_id(agents_client, file_id):
+                logger.info(f"Reusing the uploaded file {file_id} of {os.path.basename(file_path)}")
+                return file_id
+            file = await agents_client.files.upload_and_poll(file_path=file_path, purpose=FilePurpose.AGENTS)
+            manifest.files[digest] = file.id
+            return file.id
+
+    try:
+        return list(await asyncio.gather(*(ensure_uploaded(p) for p in file_paths)))
+    finally:
+        # Keep the completed uploads even if one of them failed.
+        _save_manifest(manifest)
+
+
+async def _find_vector_store(
+        agents_client: AgentsClient, manifest: BootstrapManifest, key: str) -> Optional[VectorStore]:
+    vector_store_id = manifest.vector_stores.get(key)
+    if vector_store_id:
+        try:
+            vector_store = await agents_client.vector_stores.get(vector_store_id)
+            if vector_store.status == "completed":
+                return vector_store
+        except ResourceNotFoundError:
+            pass
+        logger.info(f"The vector store {vector_store_id} of the manifest is not available")
+    # The manifest may be missing, e.g. in a new container, so look for the store by its hash.
+    async for vector_store in agents_client.vector_stores.list():
+        if (vector_store.metadata or {}).get(CONTENT_HASH_KEY) == key and vector_store.status == "completed":
+            return vector_store
+    return None
+
+
+async def get_vector_store(
+        agents_client: AgentsClient,
+        file_paths: List[str],
+        manifest: BootstrapManifest,
+        name: str = "sample_store",
+        concurrency: int = 8) -> VectorStore:
+    """
+    Return the vector store of the files, creating it only if no store holds the same contents.
+
+    :param agents_client: The agents client.
+    :param file_paths: The paths of the files.
+    :param manifest: The manifest of the uploaded files and the vector stores.
+    :param name: The name of a new vector store.
+    :param concurrency: The maximal number of concurrent uploads.
+    :return: The vector store.
+    """
+    key = contents_digest({os.path.basename(p): file_digest(p) for p in file_paths})
+    vector_store = await _find_vector_store(agents_client, manifest, key)
+    if vector_store is not None:
+        logger.info(f"Reusing the vector store {vector_store.id} with the same files")
+    else:
+        file_ids = await upload_files(agents_client, file_paths, manifest, concurrency)
+        vector_store = await agents_client.vector_stores.create_and_poll(
+            file_ids=file_ids,
+            name=name,
+            metadata={CONTENT_HASH_KEY: key},
+        )
+    if manifest.vector_stores.get(key) != vector_store.id:
+        manifest.vector_stores[key] = vector_store.id
+        _save_manifest(manifest)
+    return vector_store
+
+
+class BootstrapState:
+    """
+    The agent and the resources resolved by the gunicorn master, read by the workers.
+
+    The workers use the agent definition of the state without calling the service,
+    as long as it was written for the same settings, and validate it after startup.
+
+    :param agent: The definition of the agent.
+    :param config_hash: The hash of the settings the state was written for.
+    :param vector_store_id: The ID of the vector store of the file search, if any.
+    :param vector_store_hash: The hash of the files of the vector store.
+    :param index_name: The name of the Azure AI Search index, if any.
+    :param index_hash: The hash of the embeddings uploaded to the index.
+    :param written_at: The time the state was written.
+    """
+
+    VERSION = 1
+
+    def __init__(
+            self,
+            agent: Agent,
+            config_hash: str,
+            vector_store_id: Optional[str] = None,
+            vector_store_hash: Optional[str] = None,
+            index_name: Optional[str] = None,
+            index_hash: Optional[str] = None,
+            written_at: Optional[float] = None
+        ) -> None:
+        """Constructor."""
+        self.agent = agent
+        self.agent_hash = agent_digest(agent)
+        self.config_hash = config_hash
+        self.vector_store_id = vector_store_id
+        self.vector_store_hash = vector_store_hash
+        self.index_name = index_name
+        self.index_hash = index_hash
+        self.written_at = time.time() if written_at is None else written_at
+
+    def matches(self, config_hash: str, agent_id: Optional[str] = None) -> bool:
+        """
+        Return True if the state may be used.
+
+        :param config_hash: The hash of the current settings.
+        :param agent_id: The ID of the agent set in the environment, if any.
+        """
+        return self.config_hash == config_hash and (not agent_id or agent_id == self.agent.id)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["BootstrapState"]:
+        """Read the state, or return None if it is missing, unreadable or was modified."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != cls.VERSION:
+                return None
+            state = cls(
+                Agent(data["agent"]),
+                data["config_hash"],
+                vector_store_id=data.get("vector_store_id"),
+                vector_store_hash=data.get("vector_store_hash"),
+                index_name=data.get("index_name"),
+                index_hash=data.get("index_hash"),
+                written_at=data.get("written_at"),
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Ignoring the unreadable bootstrap state {path}: {e}")
+            return None
+        if state.agent_hash != data.get("agent_hash"):
+            logger.warning(f"Ignoring the bootstrap state {path}, its agent does not match its hash")
+            return None
+        return state
+
+    def save(self, path: str) -> None:
+        """Write the state atomically."""
+        _write_json(path, {
+            "version": BootstrapState.VERSION,
+            "agent": self.agent.as_dict(),
+            "agent_hash": self.agent_hash,
+            "config_hash": self.config_hash,
+            "vector_store_id": self.vector_store_id,
+            "vector_store_hash": self.vector_store_hash,
+            "index_name": self.index_name,
+            "index_hash": self.index_hash,
+            "written_at": self.written_at,
+        })
+
+
+# The state written by the gunicorn master, inherited by the forked workers.
+_shared_state: Optional[BootstrapState] = None
+
+
+def share_state(state: BootstrapState) -> None:
+    """Keep the state in this process for the processes forked later."""
+    global _shared_state
+    _shared_state = state
+
+
+def shared_state() -> Optional[BootstrapState]:
+    """Return the state inherited from the gunicorn master, or None."""
+    return _shared_state
@@ -16,17 +16,27 @@ from azure.ai.agents.models import (
     Agent,
     AsyncToolSet,
     AzureAISearchTool,
-    FilePurpose,
     FileSearchTool,
     Tool,
 )
 from azure.ai.projects.models import ConnectionType, ApiKeyCredentials
+from azure.identity import DefaultAzureCredential as SyncDefaultAzureCredential
 from azure.identity.aio import DefaultAzureCredential
 from azure.core.credentials_async import AsyncTokenCredential
 
 from dotenv import load_dotenv
 
-from logging_config import configure_logging
+from bootstrap import (
+    BOOTSTRAP_DIRECTORY,
+    BootstrapManifest,
+    BootstrapState,
+    config_digest,
+    file_digest,
+    get_vector_store,
+    share_state,
+)
+from logging_config import collect_worker_logs, configure_logging
+from shared_token import share_tokens, start_refreshing_tokens, stop_sharing_tokens
 
 load_dotenv()
 
@@ -50,6 +60,11 @@ def list_files_in_files_directory() -> List[str]:
 
 FILES_NAMES = list_files_in_files_directory()
 
+# The files and vector stores uploaded by the previous bootstraps.
+BOOTSTRAP_MANIFEST = os.getenv("BOOTSTRAP_MANIFEST", os.path.join(BOOTSTRAP_DIRECTORY, "manifest.json"))
+# The agent and the resources resolved by on_starting, read by the workers.
+BOOTSTRAP_STATE = os.getenv("BOOTSTRAP_STATE", os.path.join(BOOTSTRAP_DIRECTORY, "state.json"))
+
 
 async def create_index_maybe(
         ai_client: AIProjectClient, creds: AsyncTokenCredential) -> None:
@@ -94,14 +109,24 @@ async def create_index_maybe(
         if await search_mgr.create_index(
             vector_index_dimensions=int(
                 os.getenv('AZURE_AI_EMBED_DIMENSIONS'))):
-            embeddings_path = os.path.join(
-                os.path.dirname(__file__), 'data', 'embeddings.csv')
-
-            assert embeddings_path, f'File {embeddings_path} not found.'
+            embeddings_path = _get_embeddings_path()
             await search_mgr.upload_documents(embeddings_path)
             await search_mgr.close()
 
 
+def _get_embeddings_path() -> str:
+    """Get the path of the embeddings uploaded to the index."""
+    # Prefer the binary embeddings store if it was generated.
+    embeddings_path = os.path.join(
+        os.path.dirname(__file__), 'data', 'embeddings.npy')
+    if not os.path.isfile(embeddings_path):
+        embeddings_path = os.path.join(
+            os.path.dirname(__file__), 'data', 'embeddings.csv')
+
+    assert embeddings_path, f'File {embeddings_path} not found.'
+    return embeddings_path
+
+
 def _get_file_path(file_name: str) -> str:
     """
     Get absolute file path.
@@ -124,8 +149,6 @@ async def get_available_tool(
     :param creds: The credentials, used for the index.
     :return: The tool set, available based on the environment.
     """
-    # File name -> {"id": file_id, "path": file_path}
-    file_ids: List[str] = []
     # First try to get an index search.
     conn_id = ""
     if os.environ.get('AZURE_AI_SEARCH_INDEX_NAME'):
@@ -146,18 +169,14 @@ async def get_available_tool(
         logger.info(
             "agent: index was not initialized, falling back to file search.")
         
-        # Upload files for file search
-        for file_name in FILES_NAMES:
-            file_path = _get_file_path(file_name)
-            file = await project_client.agents.files.upload_and_poll(
-                file_path=file_path, purpose=FilePurpose.AGENTS)
-            # Store both file id and the file path using the file name as key.
-            file_ids.append(file.id)
-
-        # Create the vector store using the file IDs.
-        vector_store = await project_client.agents.vector_stores.create_and_poll(
-            file_ids=file_ids,
-            name="sample_store"
+        # Upload the new files for file search in parallel and reuse the vector store
+        # of the same files if there is one.
+        vector_store = await get_vector_store(
+            project_client.agents,
+            [_get_file_path(file_name) for file_name in FILES_NAMES],
+            BootstrapManifest.load(BOOTSTRAP_MANIFEST),
+            name="sample_store",
+            concurrency=int(os.getenv("AGENT_FILE_UPLOAD_CONCURRENCY", "8")),
         )
         logger.info("agent: file store and vector store success")
 
@@ -182,7 +201,38 @@ async def create_agent(ai_client: AIProjectClient,
     return agent
 
 
+def write_bootstrap_state(agent: Agent, config_hash: str) -> None:
+    """
+    Write the agent and its resources for the workers.
+
+    :param agent: The agent used by the workers.
+    :param config_hash: The hash of the settings the agent was resolved for.
+    """
+    state = BootstrapState(agent, config_hash)
+    # The workers forked later inherit the state, the file is read by the other ones.
+    share_state(state)
+    file_search = agent.tool_resources.file_search if agent.tool_resources else None
+    if file_search and file_search.vector_store_ids:
+        state.vector_store_id = file_search.vector_store_ids[0]
+        manifest = BootstrapManifest.load(BOOTSTRAP_MANIFEST)
+        state.vector_store_hash = next(
+            (key for key, store_id in manifest.vector_stores.items() if store_id == state.vector_store_id), None)
+    index_name = os.environ.get('AZURE_AI_SEARCH_INDEX_NAME')
+    if index_name and any(tool.get("type") == "azure_ai_search" for tool in agent.tools or []):
+        state.index_name = index_name
+        embeddings_path = _get_embeddings_path()
+        if os.path.isfile(embeddings_path):
+            state.index_hash = file_digest(embeddings_path)
+    try:
+        state.save(BOOTSTRAP_STATE)
+        logger.info(f"Wrote the bootstrap state of agent {agent.id} to {BOOTSTRAP_STATE}")
+    except OSError as e:
+        logger.warning(f"Could not write the bootstrap state {BOOTSTRAP_STATE}: {e}")
+
+
 async def initialize_resources():
+    config_hash = config_digest()
+    state = BootstrapState.load(BOOTSTRAP_STATE)
     try:
         async with DefaultAzureCredential(
                 exclude_shared_token_cache_credential=True) as creds:
@@ -190,36 +240,42 @@ async def initialize_resources():
                 credential=creds,
                 endpoint=proj_endpoint
             ) as ai_client:
+                agent = None
                 # If the environment already has AZURE_AI_AGENT_ID or AZURE_EXISTING_AGENT_ID, try
-                # fetching that agent
-                if agentID is not None:
+                # fetching that agent, else the agent of the previous bootstrap with the same settings.
+                known_agent_id = agentID
+                if known_agent_id is None and state is not None and state.matches(config_hash):
+                    known_agent_id = state.agent.id
+                if known_agent_id is not None:
                     try:
                         agent = await ai_client.agents.get_agent(
-                            agentID)
+                            known_agent_id)
                         logger.info(f"Found agent by ID: {agent.id}")
-                        return
                     except Exception as e:
                         logger.warning(
-                            "Could not retrieve agent by AZURE_EXISTING_AGENT_ID = "
-                            f"{agentID}, error: {e}")
+                            "Could not retrieve agent by ID = "
+                            f"{known_agent_id}, error: {e}")
 
                 # Check if an agent with the same name already exists
-                agent_list = ai_client.agents.list_agents()
-                if agent_list:
-                    async for agent_object in agent_list:
-                        if agent_object.name == os.environ[
-                                "AZURE_AI_AGENT_NAME"]:
-                            logger.info(
-                                "Found existing agent named "
-                                f"'{agent_object.name}'"
-                                f", ID: {agent_object.id}")
-                            os.environ["AZURE_EXISTING_AGENT_ID"] = agent_object.id
-                            return
-                        
+                if agent is None:
+                    agent_list = ai_client.agents.list_agents()
+                    if agent_list:
+                        async for agent_object in agent_list:
+                            if agent_object.name == os.environ[
+                                    "AZURE_AI_AGENT_NAME"]:
+                                logger.info(
+                                    "Found existing agent named "
+                                    f"'{agent_object.name}'"
+                                    f", ID: {agent_object.id}")
+                                agent = agent_object
+                                break
+
                 # Create a new agent
-                agent = await create_agent(ai_client, creds)
+                if agent is None:
+                    agent = await create_agent(ai_client, creds)
+                    logger.info(f"Created agent, agent ID: {agent.id}")
                 os.environ["AZURE_EXISTING_AGENT_ID"] = agent.id
-                logger.info(f"Created agent, agent ID: {agent.id}")
+                write_bootstrap_state(agent, config_hash)
 
     except Exception as e:
         logger.info("Error creating agent: {e}", exc_info=True)
@@ -229,6 +285,38 @@ async def initialize_resources():
 def on_starting(server):
     """This code runs once before the workers will start."""
     asyncio.get_event_loop().run_until_complete(initialize_resources())
+    # Acquire the access token once for all the workers.
+    if os.getenv("SHARE_ACCESS_TOKEN", "true").lower() == "true":
+        share_tokens(SyncDefaultAzureCredential(exclude_shared_token_cache_credential=True))
+
+
+def when_ready(server):
+    """Keep the shared access token fresh, the workers are not forked during a refresh."""
+    start_refreshing_tokens()
+
+
+# With APP_LOG_PER_WORKER every worker writes to its own log file, named by its PID,
+# and with APP_LOG_MERGE_WORKERS the master merges them into APP_LOG_FILE.
+log_per_worker = os.getenv("APP_LOG_PER_WORKER", "false").lower() == "true"
+merge_worker_logs = log_per_worker and os.getenv("APP_LOG_MERGE_WORKERS", "false").lower() == "true"
+
+
+def post_fork(server, worker):
+    """Replace the log handlers inherited from the master."""
+    configure_logging(os.getenv("APP_LOG_FILE", ""), per_worker_file=log_per_worker)
+
+
+def child_exit(server, worker):
+    """Merge the log file of the exited worker."""
+    if merge_worker_logs and os.getenv("APP_LOG_FILE"):
+        collect_worker_logs(os.getenv("APP_LOG_FILE"), [worker.pid])
+
+
+def on_exit(server):
+    """Stop refreshing the access token and merge the log files left by the workers."""
+    stop_sharing_tokens()
+    if merge_worker_logs and os.getenv("APP_LOG_FILE"):
+        collect_worker_logs(os.getenv("APP_LOG_FILE"))
 
 
 max_requests = 1000
@@ -1,37 +1,392 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
 
+import atexit
+import copy
+import glob
+import heapq
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
 import sys
-from typing import Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-def configure_logging(log_file_name: Optional[str] = None, logger_name: str = "azureaiapp") -> logging.Logger:
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+
+# The time at the start of the first line of a text or JSON record.
+_RECORD_TIME = re.compile(r'^(?:\{"timestamp": ")?(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3})')
+
+
+class JsonFormatter(logging.Formatter):
+    """Format every record as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of the records of the high-frequency loggers.
+
+    The rate of a record is the rate of the longest configured logger name which is
+    the name of its logger or of one of its parents. Warnings and errors are always kept.
+
+    :param rates: The fraction of the records kept, by logger name.
+    :param sample: The function returning a random number in [0, 1).
+    """
+
+    def __init__(self, rates: Dict[str, float], sample: Callable[[], float] = random.random) -> None:
+        """Constructor."""
+        super().__init__()
+        self._rates = rates
+        self._sample = sample
+        self._cache: Dict[str, float] = {}
+
+    @staticmethod
+    def parse(value: str) -> Dict[str, float]:
+        """
+        Parse the sampling rates.
+
+        :param value: The comma separated rates, e.g. "azureaiapp.events=0.1".
+        :return: The rates by logger name.
+        """
+        rates = {}
+        for item in value.split(","):
+            name, _, rate = item.partition("=")
+            if name.strip() and rate.strip():
+                rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+        return rates
+
+    def _rate(self, name: str) -> float:
+        if name not in self._cache:
+            rate = 1.0
+            matched = -1
+            for prefix, prefix_rate in self._rates.items():
+                if (name == prefix or name.startswith(prefix + ".")) and len(prefix) > matched:
+                    rate, matched = prefix_rate, len(prefix)
+            self._cache[name] = rate
+        return self._cache[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or self._sample() < rate
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue the records for the listener thread without blocking the event loop.
+
+    When the queue is full the record is dropped, or with the block policy the caller
+    waits up to block_timeout seconds for room before the record is dropped. The number
+    of dropped records is logged as a warning once the queue has room again.
+
+    :param maxsize: The maximal number of queued records.
+    :param policy: "drop" or "block".
+    :param block_timeout: The maximal time in seconds to wait for room with the block policy.
+    """
+
+    def __init__(self, maxsize: int = 10000, policy: str = "drop", block_timeout: float = 1.0) -> None:
+        """Constructor."""
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown log queue policy {policy}, expected drop or block.")
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge the arguments and the traceback, which may not be picklable, but leave
+        # the formatting of the record to the handlers of the listener.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _TRACEBACK_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self._unreported:
+                self.queue.put_nowait(self._dropped_record(record))
+                self._unreported = 0
+            if self.policy == "block":
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+    def _dropped_record(self, record: logging.LogRecord) -> logging.LogRecord:
+        return logging.LogRecord(
+            record.name, logging.WARNING, __file__, 0,
+            f"Dropped {self._unreported} log records because the log queue was full", None, None)
+
+
+class _DeferredFlush:
+    # Set by the listener while more records are queued, so a burst is flushed once.
+    defer_flush = False
+
+    def flush(self) -> None:
+        if not self.defer_flush:
+            super().flush()
+
+
+class _StreamSink(_DeferredFlush, logging.StreamHandler):
+    pass
+
+
+class _FileSink(_DeferredFlush, logging.FileHandler):
+    pass
+
+
+class _RotatingFileSink(_DeferredFlush, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def handle(self, record: logging.LogRecord) -> None:
+        pending = not self.queue.empty()
+        for handler in self.handlers:
+            handler.defer_flush = pending
+        super().handle(record)
+
+    def enqueue_sentinel(self) -> None:
+        # Wait for room, the records queued before the sentinel are still written.
+        self.queue.put(self._sentinel)
+
+    def stop(self) -> None:
+        super().stop()
+        # The last burst may have been written with the sentinel still queued.
+        for handler in self.handlers:
+            handler.defer_flush = False
+            handler.flush()
+
+
+_TRACEBACK_FORMATTER = logging.Formatter()
+
+# The queued handlers and their listener threads.
+_queues: List[Tuple[BoundedQueueHandler, _QueueListener]] = []
+
+
+def _restart_listeners() -> None:
+    # The listener thread does not survive a fork and the lock of the queue may have
+    # been held by it, so the child gets new queues and new threads.
+    for handler, listener in _queues:
+        handler.queue = listener.queue = queue.Queue(handler.maxsize)
+        listener._thread = None
+        listener.start()
+
+
+def _stop_listeners() -> None:
+    for _, listener in _queues:
+        if listener._thread is not None:
+            listener.stop()
+
+
+# The handlers installed by configure_logging, with the PID of the process which installed them.
+_installed: Dict[str, Tuple[int, List[logging.Handler]]] = {}
+
+
+def _remove_handlers(logger: logging.Logger, handlers: List[logging.Handler]) -> None:
+    for handler in handlers:
+        logger.removeHandler(handler)
+        sinks = [handler]
+        for entry in [e for e in _queues if e[0] is handler]:
+            _queues.remove(entry)
+            if entry[1]._thread is not None:
+                entry[1].stop()
+            sinks = list(entry[1].handlers)
+        for sink in sinks:
+            sink.close()
+
+
+def log_level() -> int:
+    """Return the level of APP_LOG_LEVEL, INFO by default."""
+    value = os.getenv("APP_LOG_LEVEL", "INFO").strip().upper()
+    level = int(value) if value.isdigit() else logging.getLevelName(value)
+    return level if isinstance(level, int) else logging.INFO
+
+
+def worker_log_file_name(log_file_name: str, pid: int) -> str:
+    """
+    Return the name of the log file of the worker process.
+
+    :param log_file_name: The name of the shared log file, e.g. "app.log".
+    :param pid: The PID of the worker.
+    :return: The name of the log file of the worker, e.g. "app.1234.log".
+    """
+    stem, extension = os.path.splitext(log_file_name)
+    return f"{stem}.{pid}{extension}"
+
+
+def _read_records(file_names: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    # Yield the time and the lines of every record. The lines without a time, such as
+    # a traceback, belong to the record before them.
+    record: List[str] = []
+    time = ""
+    for file_name in file_names:
+        with open(file_name, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    line += "\n"
+                match = _RECORD_TIME.match(line)
+                if match and record:
+                    yield time, "".join(record)
+                    record = []
+                if match or not record:
+                    time = match.group(1) if match else time
+                record.append(line)
+    if record:
+        yield time, "".join(record)
+
+
+def collect_worker_logs(log_file_name: str, pids: Optional[Iterable[int]] = None) -> int:
+    """
+    Merge the log files of the workers into the shared log file, in the order of the
+    record times, and delete them.
+
+    It is called by the master process for the workers which have exited, so the
+    files are complete.
+
+    :param log_file_name: The name of the shared log file.
+    :param pids: The PIDs of the workers, or None to collect every worker log file.
+    :return: The number of records merged.
+    """
+    stem, extension = os.path.splitext(log_file_name)
+    if pids is None:
+        pattern = re.compile(re.escape(stem) + r"\.(\d+)" + re.escape(extension) + r"$")
+        pids = [int(m.group(1)) for m in map(pattern.match, glob.glob(f"{glob.escape(stem)}.*{extension}")) if m]
+    worker_files = []
+    for pid in pids:
+        current = worker_log_file_name(log_file_name, pid)
+        # The rotated files are older, the oldest has the highest number.
+        rotated = [n for n in glob.glob(glob.escape(current) + ".*") if n.rpartition(".")[2].isdigit()]
+        files = sorted(rotated, key=lambda n: int(n.rpartition(".")[2]), reverse=True)
+        if os.path.exists(current):
+            files.append(current)
+        if files:
+            worker_files.append(files)
+    if not worker_files:
+        return 0
+    merged = 0
+    with open(log_file_name, "a", encoding="utf-8") as output:
+        for _, record in heapq.merge(*(_read_records(files) for files in worker_files), key=lambda r: r[0]):
+            output.write(record)
+            merged += 1
+    for files in worker_files:
+        for file_name in files:
+            os.remove(file_name)
+    return merged
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listeners)
+atexit.register(_stop_listeners)
+
+
+def _create_sinks(log_file_name: Optional[str], formatter: logging.Formatter) -> List[logging.Handler]:
+    # Stream handler (stdout)
+    stream_handler = _StreamSink(sys.stdout)
+    handlers: List[logging.Handler] = [stream_handler]
+
+    # File handler if a log file is specified, rotated when APP_LOG_MAX_BYTES is set.
+    if log_file_name:
+        max_bytes = int(os.getenv("APP_LOG_MAX_BYTES", "0"))
+        if max_bytes > 0:
+            file_handler = _RotatingFileSink(
+                log_file_name, maxBytes=max_bytes, backupCount=int(os.getenv("APP_LOG_BACKUP_COUNT", "5")))
+        else:
+            file_handler = _FileSink(log_file_name)
+        handlers.append(file_handler)
+
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def configure_logging(
+        log_file_name: Optional[str] = None,
+        logger_name: str = "azureaiapp",
+        per_worker_file: bool = False) -> logging.Logger:
     """
     Configure and return a logger with both stream (stdout) and optional file handlers.
 
+    The handlers are installed once per process: the later calls return the logger
+    as it is, and the first call in a forked process replaces the inherited handlers.
+
+    The output is configured with the environment:
+    APP_LOG_LEVEL is the level of the logger, INFO by default;
+    APP_LOG_FORMAT is "text" or "json";
+    APP_LOG_MAX_BYTES and APP_LOG_BACKUP_COUNT rotate the log file;
+    APP_LOG_SAMPLING keeps a fraction of the records of the given loggers, e.g. "azureaiapp.events=0.1";
+    APP_LOG_ASYNC writes the records from a background thread, fed by a queue of
+    APP_LOG_QUEUE_SIZE records which drops or blocks, per APP_LOG_QUEUE_POLICY, when full.
+
     :param log_file_name: The path to the log file. If provided, logs will also be written to this file.
     :type log_file_name: Optional[str]
     :param logger_name: The name of the logger to configure.
     :type logger_name: str
+    :param per_worker_file: True to write to a log file of this process, named by its PID.
+    :type per_worker_file: bool
     :return: The configured logger instance.
     :rtype: logging.Logger
     """
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
+    logger.setLevel(log_level())
 
-    # Stream handler (stdout)
-    stream_handler = logging.StreamHandler(sys.stdout)
-    stream_handler.setLevel(logging.INFO)
-    stream_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
-    stream_handler.setFormatter(stream_formatter)
-    logger.addHandler(stream_handler)
+    installed = _installed.get(logger_name)
+    if installed and installed[0] == os.getpid():
+        return logger
+    if installed:
+        _remove_handlers(logger, installed[1])
+    if log_file_name and per_worker_file:
+        log_file_name = worker_log_file_name(log_file_name, os.getpid())
 
-    # File handler if a log file is specified
-    if log_file_name:
-        file_handler = logging.FileHandler(log_file_name)
-        file_handler.setLevel(logging.INFO)
-        file_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
-        file_handler.setFormatter(file_formatter)
-        logger.addHandler(file_handler)
+    if os.getenv("APP_LOG_FORMAT", "text").lower() == "json":
+        formatter: logging.Formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT)
+    sinks = _create_sinks(log_file_name, formatter)
+
+    if os.getenv("APP_LOG_ASYNC", "false").lower() == "true":
+        queue_handler = BoundedQueueHandler(
+            maxsize=int(os.getenv("APP_LOG_QUEUE_SIZE", "10000")),
+            policy=os.getenv("APP_LOG_QUEUE_POLICY", "drop").lower(),
+        )
+        listener = _QueueListener(queue_handler.queue, *sinks, respect_handler_level=True)
+        listener.start()
+        _queues.append((queue_handler, listener))
+        handlers: List[logging.Handler] = [queue_handler]
+    else:
+        handlers = sinks
+
+    sampling = SamplingFilter.parse(os.getenv("APP_LOG_SAMPLING", ""))
+    for handler in handlers:
+        if sampling:
+            # The sampled out records are dropped before they are formatted or queued.
+            handler.addFilter(SamplingFilter(sampling))
+        logger.addHandler(handler)
+    _installed[logger_name] = (os.getpid(), handlers)
 
-    return logger
\ No newline at end of file
+    return logger
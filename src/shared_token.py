@@ -0,0 +1,276 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license. See LICENSE.md file in the project root for full license information.
+
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from azure.core.credentials import AccessToken, TokenCredential
+
+logger = logging.getLogger("azureaiapp")
+
+# The scope of the AI project and agents clients.
+DEFAULT_SCOPE = "https://ai.azure.com/.default"
+
+
+class SharedTokenCache:
+    """
+    The access tokens by scope, in an anonymous shared memory segment.
+
+    The segment is created by the gunicorn master before the workers are forked, so
+    the master and every worker, including the recycled ones, map the same memory.
+
+    :param size: The size of the segment in bytes.
+    """
+
+    _LENGTH = struct.Struct("<I")
+
+    def __init__(self, size: int = 65536) -> None:
+        """Constructor."""
+        self._memory = mmap.mmap(-1, size)
+        # A semaphore, shared by the forked processes.
+        self._lock = multiprocessing.Lock()
+
+    def _load(self) -> Dict[str, List]:
+        (length,) = SharedTokenCache._LENGTH.unpack_from(self._memory, 0)
+        if not length:
+            return {}
+        start = SharedTokenCache._LENGTH.size
+        return json.loads(self._memory[start:start + length])
+
+    def get(self, scope: str) -> Optional[AccessToken]:
+        """Return the token of the scope, or None."""
+        with self._lock:
+            entry = self._load().get(scope)
+        return AccessToken(entry[0], entry[1]) if entry else None
+
+    def put(self, scope: str, token: AccessToken) -> None:
+        """
+        Store the token of the scope.
+
+        :raises ValueError: If the tokens do not fit in the segment.
+        """
+        with self._lock:
+            tokens = self._load()
+            tokens[scope] = [token.token, token.expires_on]
+            data = json.dumps(tokens).encode()
+            start = SharedTokenCache._LENGTH.size
+            if start + len(data) > len(self._memory):
+                raise ValueError("The access tokens do not fit in the shared memory.")
+            self._memory[start:start + len(data)] = data
+            SharedTokenCache._LENGTH.pack_into(self._memory, 0, len(data))
+
+    def scopes(self) -> List[str]:
+        """Return the scopes of the stored tokens."""
+        with self._lock:
+            return list(self._load())
+
+
+class TokenRefresher:
+    """
+    Refresh the shared tokens in the master, before they expire.
+
+    It refreshes the given scopes and every scope a worker has added to the cache,
+    so the workers find a valid token instead of acquiring one each.
+
+    The process is not forked while the background thread refreshes the tokens, so a
+    worker forked from the master never inherits a lock held by the credential, the
+    HTTP connections, the logging or the cache. Between the refreshes the thread only
+    waits for the next one.
+
+    :param cache: The shared tokens.
+    :param credential: The credential of the master.
+    :param scopes: The scopes refreshed from the start.
+    :param margin: The time in seconds before the expiry when the token is refreshed.
+    :param interval: The maximal time in seconds between the checks for new scopes.
+    :param clock: The wall clock, in seconds since the epoch as the token expiry.
+    """
+
+    def __init__(
+            self,
+            cache: SharedTokenCache,
+            credential: TokenCredential,
+            scopes: Iterable[str] = (DEFAULT_SCOPE,),
+            margin: float = 300.0,
+            interval: float = 60.0,
+            clock: Callable[[], float] = time.time
+        ) -> None:
+        """Constructor."""
+        self._cache = cache
+        self._credential = credential
+        self._scopes = list(scopes)
+        self._margin = margin
+        self._interval = interval
+        self._clock = clock
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Held by the thread while it refreshes and by the process while it forks.
+        self._refreshing = threading.Lock()
+        self._fork_guarded = False
+
+    def refresh(self) -> float:
+        """
+        Refresh the tokens which expire within the margin.
+
+        :return: The time in seconds until the next refresh.
+        """
+        delay = self._interval
+        for scope in dict.fromkeys(self._scopes + self._cache.scopes()):
+            token = self._cache.get(scope)
+            if token is None or token.expires_on - self._clock() <= self._margin:
+                try:
+                    token = self._credential.get_token(*scope.split(" "))
+                    self._cache.put(scope, token)
+                except Exception as e:
+                    logger.warning(f"Could not refresh the shared access token of {scope}: {e}")
+                    # Let the workers fall back to their own credential until the next try.
+                    continue
+            remaining = token.expires_on - self._margin - self._clock()
+            if remaining > 0:
+                delay = min(delay, remaining)
+        return max(delay, 1.0)
+
+    def start(self) -> None:
+        """Acquire the tokens and refresh them in a background thread."""
+        if self._thread is None:
+            delay = self.refresh()
+            if not self._fork_guarded:
+                # The hooks cannot be unregistered, they are registered once.
+                os.register_at_fork(
+                    before=lambda: self._refreshing.acquire(),
+                    after_in_parent=lambda: self._refreshing.release(),
+                    after_in_child=self._reset_after_fork)
+                self._fork_guarded = True
+            self._thread = threading.Thread(target=self._run, args=(delay,), name="token-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _reset_after_fork(self) -> None:
+        # The thread does not exist in the forked process.
+        self._refreshing = threading.Lock()
+        self._thread = None
+
+    def _run(self, delay: float) -> None:
+        while not self._stopped.wait(delay):
+            with self._refreshing:
+                delay = self.refresh()
+
+
+class SharedTokenCredential:
+    """
+    The credential of a worker, returning the tokens refreshed by the master.
+
+    When the shared token is missing or about to expire, the token is acquired with
+    the fallback credential, created on first use, and shared with the other workers.
+
+    :param cache: The shared tokens.
+    :param create_fallback: The function creating the credential of the worker.
+    :param min_validity: The minimal remaining validity in seconds of a shared token.
+    """
+
+    def __init__(
+            self,
+            cache: SharedTokenCache,
+            create_fallback: Callable[[], TokenCredential],
+            min_validity: float = 60.0
+        ) -> None:
+        """Constructor."""
+        self._cache = cache
+        self._create_fallback = create_fallback
+        self._fallback: Optional[TokenCredential] = None
+        self._min_validity = min_validity
+        self.hits = 0
+        self.misses = 0
+
+    def _fallback_credential(self) -> TokenCredential:
+        if self._fallback is None:
+            self._fallback = self._create_fallback()
+        return self._fallback
+
+    def get_token(self, *scopes: str, **kwargs) -> AccessToken:
+        # The tokens for other claims or tenants are not shared.
+        if any(kwargs.get(name) for name in ("claims", "tenant_id", "enable_cae")):
+            return self._fallback_credential().get_token(*scopes, **kwargs)
+        scope = " ".join(scopes)
+        token = self._cache.get(scope)
+        if token is not None and token.expires_on - time.time() > self._min_validity:
+            self.hits += 1
+            return token
+        self.misses += 1
+        token = self._fallback_credential().get_token(*scopes, **kwargs)
+        try:
+            self._cache.put(scope, token)
+        except ValueError as e:
+            logger.warning(f"Could not share the access token of {scope}: {e}")
+        return token
+
+    def close(self) -> None:
+        if self._fallback is not None:
+            self._fallback.close()
+
+    def __enter__(self) -> "SharedTokenCredential":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+# The tokens shared by the gunicorn master, inherited by the forked workers.
+_shared_cache: Optional[SharedTokenCache] = None
+_refresher: Optional[TokenRefresher] = None
+
+
+def share_tokens(credential: TokenCredential, scopes: Iterable[str] = (DEFAULT_SCOPE,)) -> TokenRefresher:
+    """
+    Acquire the tokens in this process for the processes forked later.
+
+    Call start_refreshing_tokens to keep them fresh.
+
+    :param credential: The credential of the master.
+    :param scopes: The scopes of the tokens to acquire now.
+    :return: The refresher of the tokens.
+    """
+    global _shared_cache, _refresher
+    if _refresher is None:
+        _shared_cache = SharedTokenCache()
+        _refresher = TokenRefresher(_shared_cache, credential, scopes)
+        _refresher.refresh()
+    return _refresher
+
+
+def start_refreshing_tokens() -> None:
+    """
+    Keep the shared tokens fresh in a background thread of this process.
+
+    The workers may be forked while the thread runs, but not while it refreshes the tokens.
+    """
+    if _refresher is not None:
+        _refresher.start()
+
+
+def stop_sharing_tokens() -> None:
+    """Stop refreshing the shared tokens."""
+    if _refresher is not None:
+        _refresher.stop()
+
+
+def shared_credential(create_fallback: Callable[[], TokenCredential]) -> Optional[SharedTokenCredential]:
+    """
+    Return the credential reading the tokens shared by the master, or None if they are not shared.
+
+    :param create_fallback: The function creating the credential used when no shared token is valid.
+    """
+    if _shared_cache is None:
+        return None
+    return SharedTokenCredential(_shared_cache, create_fallback)
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Benchmark of the concurrent embedding engine of SearchIndexManager.
+
+The embedding service is replaced by a local fake client with a fixed latency per
+request, returning a vector derived from the input text in shuffled order. The
+benchmark checks that every chunk is paired with its own vector in the input order
+and reports the throughput for several concurrency levels. Run from the repository root:
+
+    PYTHONPATH=src/api python tests/benchmarks/bench_embedding_batches.py --chunks 5000
+"""
+import argparse
+import asyncio
+import random
+import time
+from unittest.mock import AsyncMock
+
+from search_index_manager import SearchIndexManager
+
+
+class FakeEmbeddingClient:
+    """The embedding client which answers after a fixed latency plus jitter."""
+
+    def __init__(self, latency: float):
+        self._latency = latency
+        self.requests = 0
+
+    async def embed(self, input, dimensions, model):
+        self.requests += 1
+        await asyncio.sleep(self._latency * (0.5 + random.random()))
+        data = [{'index': i, 'embedding': [float(len(text)), float(hash(text) % 1000)]} for i, text in enumerate(input)]
+        random.shuffle(data)
+        return {'data': data}
+
+
+async def measure(chunks: int, batch_size: int, concurrency: int, latency: float) -> float:
+    """Return the number of chunks embedded per second, verifying the result."""
+    client = FakeEmbeddingClient(latency)
+    manager = SearchIndexManager(
+        endpoint="https://stub", credential=AsyncMock(), index_name="bench", dimensions=2,
+        model="stub", deployment_name="stub", embedding_endpoint="", embed_api_key=None,
+        embedding_client=client)
+    items = [(f"chunk number {i} " * (1 + i % 7), f"{i % 20}.md") for i in range(chunks)]
+    batches = (items[i:i + batch_size] for i in range(0, len(items), batch_size))
+    start = time.perf_counter()
+    result = [
+        triple async for embedded in manager.embed_chunks(batches, max_concurrency=concurrency)
+        for triple in embedded]
+    elapsed = time.perf_counter() - start
+    expected = [(token, title, [float(len(token)), float(hash(token) % 1000)]) for token, title in items]
+    assert result == expected, "The embeddings are not paired with their chunks."
+    return chunks / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5000, help="The number of chunks to embed.")
+    parser.add_argument("--batch-size", type=int, default=100, help="The number of chunks per request.")
+    parser.add_argument("--latency", type=float, default=0.05, help="The fake request latency in seconds.")
+    args = parser.parse_args()
+    for concurrency in (1, 2, 4, 8, 16):
+        throughput = asyncio.run(measure(args.chunks, args.batch_size, concurrency, args.latency))
+        print(f"concurrency {concurrency:2d}: {throughput:10.1f} chunks/s, output verified")
+
+
+if __name__ == "__main__":
+    main()
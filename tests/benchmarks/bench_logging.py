@@ -0,0 +1,117 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Benchmark of the request throughput with the synchronous and the queued logging.
+
+Every request of a minimal FastAPI app logs as many INFO records as a chat turn
+logs stream events, and the requests are served concurrently on one event loop.
+The records are written to stdout, redirected to the null device, and to a log
+file. --sink-latency-ms adds a delay to every flush, as a busy disk or a blocked
+stdout pipe does. Run from the repository root:
+
+    PYTHONPATH=src python tests/benchmarks/bench_logging.py --requests 2000 --sink-latency-ms 0.2
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import patch
+
+import fastapi
+import httpx
+
+import logging_config
+from logging_config import configure_logging
+
+
+def create_app(logger: logging.Logger, records: int) -> fastapi.FastAPI:
+    app = fastapi.FastAPI()
+
+    @app.get("/chat")
+    async def chat():
+        for i in range(records):
+            logger.info("Step %d status: %s", i, "in_progress")
+            if i % 8 == 0:
+                await asyncio.sleep(0)
+        return {"status": "completed"}
+
+    return app
+
+
+class SlowStream:
+    """The stream whose every flush takes the latency in seconds."""
+
+    def __init__(self, stream, latency: float):
+        self._stream = stream
+        self._latency = latency
+
+    def write(self, text: str) -> int:
+        return self._stream.write(text)
+
+    def flush(self) -> None:
+        time.sleep(self._latency)
+        self._stream.flush()
+
+
+def slow_down(logger: logging.Logger, latency: float) -> None:
+    """Delay every flush of the sinks of the logger by the latency in seconds."""
+    handlers = list(logger.handlers)
+    for _, listener in logging_config._queues:
+        handlers.extend(listener.handlers)
+    for handler in handlers:
+        if getattr(handler, "stream", None) is not None:
+            handler.stream = SlowStream(handler.stream, latency)
+
+
+async def measure(app: fastapi.FastAPI, requests: int, concurrency: int) -> float:
+    """Return the requests per second."""
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def request():
+            async with semaphore:
+                response = await client.get("/chat")
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request() for _ in range(requests)))
+        return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="The number of requests.")
+    parser.add_argument("--concurrency", type=int, default=50, help="The number of concurrent requests.")
+    parser.add_argument("--records", type=int, default=40, help="The number of records logged per request.")
+    parser.add_argument("--sink-latency-ms", type=float, default=0.0, help="The delay of every flush.")
+    args = parser.parse_args()
+
+    variants = [
+        ("synchronous handlers", {"APP_LOG_ASYNC": "false"}),
+        ("queued handlers", {"APP_LOG_ASYNC": "true", "APP_LOG_QUEUE_POLICY": "drop"}),
+        ("queued handlers, block", {"APP_LOG_ASYNC": "true", "APP_LOG_QUEUE_POLICY": "block"}),
+        ("queued JSON, sampled", {
+            "APP_LOG_ASYNC": "true", "APP_LOG_FORMAT": "json", "APP_LOG_SAMPLING": "bench=0.1"}),
+    ]
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull:
+        for i, (name, environment) in enumerate(variants):
+            logger_name = f"bench.variant{i}"
+            with patch.dict(os.environ, environment), patch.object(sys, "stdout", devnull):
+                logger = configure_logging(os.path.join(directory, f"{i}.log"), logger_name)
+                logger.propagate = False
+                if args.sink_latency_ms:
+                    slow_down(logger, args.sink_latency_ms / 1000)
+                app = create_app(logger, args.records)
+                requests_per_second = asyncio.run(measure(app, args.requests, args.concurrency))
+                dropped = sum(getattr(handler, "dropped", 0) for handler in logger.handlers)
+                logging_config._stop_listeners()
+            print(f"{name:24}: {requests_per_second:10.1f} requests/s, {dropped} records dropped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Benchmark of concurrent SearchIndexManager.search throughput in one event loop.
+
+The search service is replaced by a stub with a fixed latency. The legacy variant
+reproduces the blocking time.sleep(1) the search used to call, which serialized
+every query in the worker. Run from the repository root:
+
+    PYTHONPATH=src/api python tests/benchmarks/bench_search_concurrency.py --queries 20
+"""
+import argparse
+import asyncio
+import time
+from unittest.mock import AsyncMock, patch
+
+from search_index_manager import SearchIndexManager
+
+
+class StubSearchClient:
+    """The search client answering every query after a fixed network latency."""
+
+    def __init__(self, latency: float):
+        self._latency = latency
+
+    async def search(self, **kwargs):
+        await asyncio.sleep(self._latency)
+        return self._results()
+
+    async def _results(self):
+        for i in range(5):
+            yield {'token': f'token {i}', 'title': 'product_info_1.md'}
+
+    async def get_document_count(self):
+        return 0
+
+    async def close(self):
+        pass
+
+
+class LegacySearchIndexManager(SearchIndexManager):
+    """The search as it was implemented before, blocking the event loop after each query."""
+
+    LAG = 1.0
+
+    async def search(self, message: str) -> str:
+        response = await self._get_client().search(search_text=message)
+        time.sleep(LegacySearchIndexManager.LAG)
+        return await self._format_search_results(response)
+
+
+async def measure(manager_class, queries: int, latency: float) -> float:
+    """Return the number of queries per second served by concurrent searches."""
+    with patch('search_index_manager.SearchClient', return_value=StubSearchClient(latency)):
+        manager = manager_class(
+            endpoint="https://stub", credential=AsyncMock(), index_name="bench", dimensions=100,
+            model="stub", deployment_name="stub", embedding_endpoint="", embed_api_key=None)
+        manager._index = AsyncMock()
+        manager._index.name = "bench"
+        start = time.perf_counter()
+        await asyncio.gather(*(manager.search(f"question {i}") for i in range(queries)))
+        return queries / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=20, help="The number of concurrent queries.")
+    parser.add_argument("--latency", type=float, default=0.05, help="The stub search latency in seconds.")
+    parser.add_argument("--lag", type=float, default=1.0, help="The legacy blocking lag in seconds.")
+    args = parser.parse_args()
+    LegacySearchIndexManager.LAG = args.lag
+
+    before = asyncio.run(measure(LegacySearchIndexManager, args.queries, args.latency))
+    after = asyncio.run(measure(SearchIndexManager, args.queries, args.latency))
+    print(f"blocking sleep:     {before:10.1f} queries/s")
+    print(f"readiness poller:   {after:10.1f} queries/s")
+    print(f"speedup:            {after / before:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Benchmark of the SSE output of concurrent chat streams against a synthetic event source.
+
+Every stream receives the token deltas at a fixed interval. The legacy variant
+serializes every delta with json.dumps and logs every frame at INFO, as the event
+handler used to. The coalesced variant merges the deltas with coalesce_deltas.
+Run from the repository root:
+
+    PYTHONPATH=src/api python tests/benchmarks/bench_sse_coalescing.py --streams 200
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from sse import TextDelta, coalesce_deltas
+
+logger = logging.getLogger("bench_sse")
+
+
+async def generate_deltas(tokens: int, interval: float):
+    """Yield the token deltas at the fixed interval, in bursts as the network delivers them."""
+    for i in range(tokens):
+        if i % 4 == 0:
+            await asyncio.sleep(interval * 4)
+        yield TextDelta(f" token{i}")
+
+
+async def legacy_stream(tokens: int, interval: float):
+    async for delta in generate_deltas(tokens, interval):
+        frame = f"data: {json.dumps({'content': delta.text, 'type': 'message'})}\n\n"
+        logger.info(f"Yielding event: {frame}")
+        yield frame
+
+
+async def coalesced_stream(tokens: int, interval: float, window: float):
+    async for frame in coalesce_deltas(generate_deltas(tokens, interval), window=window):
+        logger.debug("Yielding event: %s", frame)
+        yield frame
+
+
+async def consume(stream) -> int:
+    frames = 0
+    async for _ in stream:
+        frames += 1
+    return frames
+
+
+async def measure(streams: int, make_stream):
+    """Return the frames per second and the CPU milliseconds per stream."""
+    cpu = time.process_time()
+    start = time.perf_counter()
+    frames = sum(await asyncio.gather(*(consume(make_stream()) for _ in range(streams))))
+    elapsed = time.perf_counter() - start
+    return frames / elapsed, (time.process_time() - cpu) * 1000 / streams
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=200, help="The number of concurrent streams.")
+    parser.add_argument("--tokens", type=int, default=400, help="The number of deltas per stream.")
+    parser.add_argument("--interval", type=float, default=0.002, help="The interval between deltas in seconds.")
+    parser.add_argument("--window", type=float, default=0.03, help="The coalescing window in seconds.")
+    args = parser.parse_args()
+    # Log to the null device to include the formatting and the write cost, but not the terminal.
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    variants = [
+        ("per-delta frames", lambda: legacy_stream(args.tokens, args.interval)),
+        ("coalesced frames", lambda: coalesced_stream(args.tokens, args.interval, args.window)),
+    ]
+    for name, make_stream in variants:
+        frames_per_second, cpu_per_stream = asyncio.run(measure(args.streams, make_stream))
+        print(f"{name}: {frames_per_second:12.1f} frames/s {cpu_per_stream:8.2f} CPU ms/stream")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from admission import AdmissionController, AdmissionRejected, SharedRunCounter
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+    """Tests for the admission of the agent runs."""
+
+    async def test_fifo_queue(self):
+        """Test that the waiting requests are admitted in order as the slots free up."""
+        controller = AdmissionController(limit=1, max_limit=1, max_queue=2)
+        await controller.acquire()
+        admitted = []
+
+        async def wait(name):
+            await controller.acquire()
+            admitted.append(name)
+
+        tasks = [asyncio.create_task(wait(name)) for name in ("first", "second")]
+        await asyncio.sleep(0.01)
+        self.assertEqual(controller.queue_depth, 2)
+        with self.assertRaises(AdmissionRejected) as context:
+            await controller.acquire()
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        controller.release(1.0)
+        await asyncio.sleep(0.01)
+        self.assertEqual(admitted, ["first"])
+        controller.release(1.0)
+        await asyncio.gather(*tasks)
+        self.assertEqual(admitted, ["first", "second"])
+        self.assertEqual(controller.rejected, 1)
+
+    async def test_queue_timeout(self):
+        """Test that the request is rejected when no slot frees up in time."""
+        controller = AdmissionController(limit=1, queue_timeout=0.01)
+        await controller.acquire()
+        with self.assertRaises(AdmissionRejected):
+            await controller.acquire()
+        self.assertEqual(controller.queue_depth, 0)
+
+    def test_aimd(self):
+        """Test that throttling halves the limit once per cooldown and successes raise it slowly."""
+        clock = FakeClock()
+        controller = AdmissionController(limit=16, cooldown=5, clock=clock)
+        controller.active = 2
+        controller.release(throttled=True)
+        controller.release(throttled=True)
+        self.assertEqual(controller.limit, 8)
+        clock.now = 5
+        controller.on_throttled()
+        self.assertEqual(controller.limit, 4)
+        for _ in range(8):
+            controller.active += 1
+            controller.release()
+        self.assertEqual(controller.limit, 5)
+
+    def test_unmatched_release(self):
+        """Test that a release without an acquire neither frees a slot nor raises the limit."""
+        controller = AdmissionController(limit=2)
+        with self.assertLogs("azureaiapp", level="WARNING"):
+            controller.release()
+        self.assertEqual((controller.active, controller.limit), (0, 2))
+        self.assertEqual(controller._limit, 2.0)
+
+    async def test_shared_limit(self):
+        """Test that the shared counter limits the runs of all the controllers."""
+        shared = SharedRunCounter(1)
+        first = AdmissionController(limit=4, shared=shared)
+        second = AdmissionController(limit=4, shared=shared, queue_timeout=1)
+        await first.acquire()
+        waiting = asyncio.create_task(second.acquire())
+        await asyncio.sleep(0.1)
+        self.assertFalse(waiting.done())
+        first.release()
+        await waiting
+        self.assertEqual(second.active, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from async_cache import AsyncLRUCache
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAsyncLRUCache(unittest.IsolatedAsyncioTestCase):
+    """Tests for the async LRU cache."""
+
+    async def test_coalesces_concurrent_loads(self):
+        """Test that concurrent lookups of the same key share one load."""
+        calls = 0
+
+        async def loader():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "file.md"
+
+        cache = AsyncLRUCache(maxsize=2)
+        results = await asyncio.gather(*(cache.get_or_load("id", loader) for _ in range(10)))
+        self.assertEqual(results, ["file.md"] * 10)
+        self.assertEqual(calls, 1)
+        self.assertEqual(await cache.get_or_load("id", loader), "file.md")
+        self.assertEqual(calls, 1)
+
+    async def test_errors_are_not_cached(self):
+        """Test that a failed load is propagated and retried on the next call."""
+        async def failing():
+            raise ValueError("Mock value error")
+
+        async def loader():
+            return 42
+
+        cache = AsyncLRUCache()
+        with self.assertRaisesRegex(ValueError, "Mock value error"):
+            await cache.get_or_load("id", failing)
+        self.assertEqual(await cache.get_or_load("id", loader), 42)
+
+    def test_lru_and_ttl_eviction(self):
+        """Test that entries are evicted by size and by time to live."""
+        clock = FakeClock()
+        cache = AsyncLRUCache(maxsize=2, ttl=10, clock=clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 2)
+        clock.now = 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
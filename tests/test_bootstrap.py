@@ -0,0 +1,195 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from azure.ai.agents.models import Agent
+from azure.core.exceptions import ResourceNotFoundError
+
+from bootstrap import (
+    CONTENT_HASH_KEY,
+    BootstrapManifest,
+    BootstrapState,
+    config_digest,
+    get_vector_store,
+    upload_files,
+)
+
+
+class AsyncList:
+    def __init__(self, items):
+        self._items = items
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for item in self._items:
+            yield item
+
+
+def get_agents_client(stores=()):
+    agents_client = MagicMock()
+    uploads = iter(range(1000))
+    active = {"running": 0, "max": 0}
+
+    async def upload_and_poll(file_path, purpose):
+        active["running"] += 1
+        active["max"] = max(active["max"], active["running"])
+        await asyncio.sleep(0.01)
+        active["running"] -= 1
+        return MagicMock(id=f"file_{next(uploads)}")
+
+    agents_client.files.upload_and_poll = AsyncMock(side_effect=upload_and_poll)
+    agents_client.files.get = AsyncMock(return_value=MagicMock(status="processed"))
+    agents_client.vector_stores.create_and_poll = AsyncMock(
+        side_effect=lambda file_ids, name, metadata: MagicMock(id="vs_new", file_ids=file_ids, metadata=metadata))
+    agents_client.vector_stores.get = AsyncMock(side_effect=ResourceNotFoundError("gone"))
+    agents_client.vector_stores.list = MagicMock(side_effect=lambda: AsyncList(list(stores)))
+    return agents_client, active
+
+
+class TestBootstrap(unittest.IsolatedAsyncioTestCase):
+    """Tests for the cached upload of the agent files."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(6):
+            path = os.path.join(self.directory.name, f"file_{i}.json")
+            with open(path, "w") as f:
+                f.write(json.dumps({"customer": i}))
+            self.paths.append(path)
+        self.manifest_path = os.path.join(self.directory.name, ".bootstrap", "manifest.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def test_upload_files_bounded(self):
+        """Test that the files are uploaded concurrently up to the limit and recorded."""
+        agents_client, active = get_agents_client()
+        manifest = BootstrapManifest.load(self.manifest_path)
+        file_ids = await upload_files(agents_client, self.paths, manifest, concurrency=2)
+        self.assertEqual(sorted(file_ids), [f"file_{i}" for i in range(6)])
+        self.assertEqual(active["max"], 2)
+        self.assertEqual(len(BootstrapManifest.load(self.manifest_path).files), 6)
+
+    async def test_upload_files_skips_uploaded(self):
+        """Test that the uploaded files are reused unless they were deleted."""
+        agents_client, _ = get_agents_client()
+        manifest = BootstrapManifest.load(self.manifest_path)
+        file_ids = await upload_files(agents_client, self.paths, manifest)
+        agents_client.files.get.side_effect = lambda file_id: (
+            MagicMock(status="processed") if file_id != file_ids[0] else MagicMock(status="deleted"))
+        again = await upload_files(agents_client, self.paths, BootstrapManifest.load(self.manifest_path))
+        self.assertEqual(again[1:], file_ids[1:])
+        self.assertNotEqual(again[0], file_ids[0])
+        self.assertEqual(agents_client.files.upload_and_poll.await_count, 7)
+
+    async def test_get_vector_store_reuses_store(self):
+        """Test that the vector store is created once and then reused from the manifest."""
+        agents_client, _ = get_agents_client()
+        vector_store = await get_vector_store(agents_client, self.paths, BootstrapManifest.load(self.manifest_path))
+        self.assertEqual(vector_store.id, "vs_new")
+        key = vector_store.metadata[CONTENT_HASH_KEY]
+        self.assertEqual(BootstrapManifest.load(self.manifest_path).vector_stores, {key: "vs_new"})
+
+        agents_client.vector_stores.get = AsyncMock(return_value=MagicMock(id="vs_new", status="completed"))
+        reused = await get_vector_store(agents_client, self.paths, BootstrapManifest.load(self.manifest_path))
+        self.assertEqual(reused.id, "vs_new")
+        agents_client.vector_stores.create_and_poll.assert_awaited_once()
+        self.assertEqual(agents_client.files.upload_and_poll.await_count, 6)
+
+        # A changed file needs a new store.
+        with open(self.paths[0], "w") as f:
+            f.write("changed")
+        await get_vector_store(agents_client, self.paths, BootstrapManifest.load(self.manifest_path))
+        self.assertEqual(agents_client.vector_stores.create_and_poll.await_count, 2)
+        self.assertEqual(agents_client.files.upload_and_poll.await_count, 7)
+
+    async def test_get_vector_store_without_manifest(self):
+        """Test that the store with the same contents is found by its metadata."""
+        agents_client, _ = get_agents_client()
+        created = await get_vector_store(agents_client, self.paths, BootstrapManifest(self.manifest_path))
+        key = created.metadata[CONTENT_HASH_KEY]
+        stores = [
+            MagicMock(id="vs_other", status="completed", metadata={CONTENT_HASH_KEY: "other"}),
+            MagicMock(id="vs_same", status="completed", metadata={CONTENT_HASH_KEY: key}),
+        ]
+        agents_client, _ = get_agents_client(stores)
+        manifest = BootstrapManifest(os.path.join(self.directory.name, "new", "manifest.json"))
+        vector_store = await get_vector_store(agents_client, self.paths, manifest)
+        self.assertEqual(vector_store.id, "vs_same")
+        agents_client.files.upload_and_poll.assert_not_awaited()
+        self.assertEqual(manifest.vector_stores, {key: "vs_same"})
+
+    async def test_get_vector_store_unwritable_manifest(self):
+        """Test that the bootstrap succeeds when the manifest cannot be written."""
+        agents_client, _ = get_agents_client()
+        # The directory of the manifest cannot be created under a file.
+        manifest = BootstrapManifest(os.path.join(self.paths[0], "manifest.json"))
+        with self.assertLogs("azureaiapp", level="WARNING"):
+            vector_store = await get_vector_store(agents_client, self.paths, manifest)
+        self.assertEqual(vector_store.id, "vs_new")
+        self.assertEqual(len(manifest.files), 6)
+
+    def test_load_unreadable_manifest(self):
+        """Test that an unreadable manifest is ignored."""
+        os.makedirs(os.path.dirname(self.manifest_path))
+        with open(self.manifest_path, "w") as f:
+            f.write("{not json")
+        manifest = BootstrapManifest.load(self.manifest_path)
+        self.assertEqual((manifest.files, manifest.vector_stores), ({}, {}))
+
+
+class TestBootstrapState(unittest.TestCase):
+    """Tests for the bootstrap state read by the workers."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, ".bootstrap", "state.json")
+        self.agent = Agent({
+            "id": "asst_1", "object": "assistant", "created_at": 1700000000, "name": "agent",
+            "model": "gpt-4o-mini", "instructions": "Use File Search always.", "tools": [{"type": "file_search"}],
+            "tool_resources": {"file_search": {"vector_store_ids": ["vs_1"]}}, "metadata": {},
+        })
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """Test that the state is read as it was written."""
+        config_hash = config_digest({"AZURE_AI_AGENT_NAME": "agent"})
+        BootstrapState(self.agent, config_hash, vector_store_id="vs_1", vector_store_hash="abc").save(self.path)
+        state = BootstrapState.load(self.path)
+        self.assertEqual(state.agent.id, "asst_1")
+        self.assertEqual(state.agent.model, "gpt-4o-mini")
+        self.assertEqual(state.agent.tool_resources.file_search.vector_store_ids, ["vs_1"])
+        self.assertEqual((state.vector_store_id, state.vector_store_hash), ("vs_1", "abc"))
+        self.assertTrue(state.matches(config_hash))
+        self.assertTrue(state.matches(config_hash, "asst_1"))
+        self.assertFalse(state.matches(config_hash, "asst_2"))
+        self.assertFalse(state.matches(config_digest({"AZURE_AI_AGENT_NAME": "other"})))
+
+    def test_invalid_state(self):
+        """Test that a missing, modified or unreadable state is not used."""
+        self.assertIsNone(BootstrapState.load(self.path))
+        BootstrapState(self.agent, "hash").save(self.path)
+        with open(self.path) as f:
+            data = json.load(f)
+        data["agent"]["id"] = "asst_2"
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+        self.assertIsNone(BootstrapState.load(self.path))
+        with open(self.path, "w") as f:
+            f.write("{")
+        self.assertIsNone(BootstrapState.load(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
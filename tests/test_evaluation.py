@@ -0,0 +1,60 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from evaluation import EvaluationDispatcher
+
+
+def get_project_mock(delay=0.0):
+    ai_project = MagicMock()
+
+    async def create_agent_evaluation(evaluation):
+        await asyncio.sleep(delay)
+        return evaluation.run_id
+
+    ai_project.evaluations.create_agent_evaluation = AsyncMock(side_effect=create_agent_evaluation)
+    return ai_project
+
+
+class TestEvaluationDispatcher(unittest.IsolatedAsyncioTestCase):
+    """Tests for the background queue of the agent evaluations."""
+
+    async def test_drain_on_close(self):
+        """Test that the queued evaluations are submitted before the dispatcher stops."""
+        ai_project = get_project_mock()
+        dispatcher = EvaluationDispatcher(ai_project, "conn_str", workers=2, per_minute=60000)
+        dispatcher.start()
+        for i in range(5):
+            self.assertTrue(dispatcher.submit("thread_1", f"run_{i}"))
+        await dispatcher.close()
+        self.assertEqual(dispatcher.submitted, 5)
+        evaluation = ai_project.evaluations.create_agent_evaluation.await_args.kwargs["evaluation"]
+        self.assertEqual(evaluation.app_insights_connection_string, "conn_str")
+
+    async def test_queue_full_and_sampling(self):
+        """Test that the runs are dropped when the queue is full or they are not sampled."""
+        dispatcher = EvaluationDispatcher(
+            get_project_mock(), "conn_str", max_queue=2, sampling_percent=50,
+            sample=iter([0.1, 0.2, 0.3, 0.9]).__next__)
+        self.assertTrue(dispatcher.submit("thread_1", "run_1"))
+        self.assertTrue(dispatcher.submit("thread_1", "run_2"))
+        self.assertFalse(dispatcher.submit("thread_1", "run_3"))
+        self.assertFalse(dispatcher.submit("thread_1", "run_4"))
+        self.assertEqual(dispatcher.dropped, 1)
+
+    async def test_drain_timeout(self):
+        """Test that the evaluations left after the drain timeout are dropped."""
+        dispatcher = EvaluationDispatcher(get_project_mock(delay=1), "conn_str", workers=1, per_minute=60000)
+        dispatcher.start()
+        for i in range(3):
+            dispatcher.submit("thread_1", f"run_{i}")
+        await dispatcher.close(timeout=0.01)
+        self.assertEqual(dispatcher.submitted, 0)
+        self.assertEqual(dispatcher.dropped, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+from unittest.mock import MagicMock
+
+from latency import LatencyBreakdown
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLatencyBreakdown(unittest.TestCase):
+    """Tests for the latency breakdown of a request."""
+
+    def test_phases(self):
+        """Test that every phase lasts from the previous mark."""
+        clock = FakeClock()
+        breakdown = LatencyBreakdown(clock=clock)
+        clock.now = 0.01
+        breakdown.mark("thread")
+        clock.now = 0.25
+        self.assertAlmostEqual(breakdown.mark("run_start"), 0.24)
+        self.assertEqual(breakdown.server_timing(), "thread;dur=10.0, run_start;dur=240.0")
+        span = MagicMock()
+        breakdown.record(span)
+        span.set_attribute.assert_any_call("latency.thread_ms", 10.0)
+        self.assertEqual(span.set_attribute.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
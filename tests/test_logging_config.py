@@ -0,0 +1,174 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import json
+import logging
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import logging_config
+from logging_config import (
+    BoundedQueueHandler,
+    JsonFormatter,
+    SamplingFilter,
+    collect_worker_logs,
+    configure_logging,
+    worker_log_file_name,
+)
+
+
+def make_record(name="azureaiapp", level=logging.INFO, msg="message %s", args=("one",), exc_info=None):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, exc_info)
+
+
+class TestLoggingConfig(unittest.TestCase):
+    """Tests for the logging configuration."""
+
+    def setUp(self):
+        self.logger_name = f"test_logging_{self.id()}"
+
+    def tearDown(self):
+        logger = logging.getLogger(self.logger_name)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        logging_config._installed.pop(self.logger_name, None)
+        logging_config._stop_listeners()
+        logging_config._queues.clear()
+
+    def test_json_formatter(self):
+        """Test that the records are formatted as JSON with the traceback."""
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = make_record(exc_info=sys.exc_info())
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "message one")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "azureaiapp")
+        self.assertIn("ValueError: boom", entry["exception"])
+
+    def test_sampling_filter(self):
+        """Test that the longest matching logger name sets the rate and warnings are kept."""
+        rates = SamplingFilter.parse("azureaiapp=0.5, azureaiapp.events=0.1,bad")
+        self.assertEqual(rates, {"azureaiapp": 0.5, "azureaiapp.events": 0.1})
+        sampling = SamplingFilter(rates, sample=lambda: 0.3)
+        self.assertFalse(sampling.filter(make_record("azureaiapp.events.run")))
+        self.assertTrue(sampling.filter(make_record("azureaiapp.eventsx")))
+        self.assertTrue(sampling.filter(make_record("azureaiapp.events", logging.WARNING)))
+        self.assertTrue(sampling.filter(make_record("other")))
+
+    def test_queue_drops_when_full(self):
+        """Test that the full queue drops the records and reports them later."""
+        handler = BoundedQueueHandler(maxsize=2)
+        for _ in range(4):
+            handler.handle(make_record())
+        self.assertEqual(handler.dropped, 2)
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "message one")
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "message one")
+        handler.handle(make_record(msg="after", args=None))
+        warning = handler.queue.get_nowait()
+        self.assertEqual(warning.levelno, logging.WARNING)
+        self.assertIn("Dropped 2 log records", warning.getMessage())
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "after")
+
+    def test_queue_blocks_until_timeout(self):
+        """Test that the block policy waits for room before dropping."""
+        handler = BoundedQueueHandler(maxsize=1, policy="block", block_timeout=0.01)
+        handler.handle(make_record())
+        handler.handle(make_record())
+        self.assertEqual(handler.dropped, 1)
+        with self.assertRaises(ValueError):
+            BoundedQueueHandler(policy="wait")
+
+    def test_async_json_logging(self):
+        """Test that the queued records are written as JSON by the listener thread."""
+        with tempfile.TemporaryDirectory() as directory:
+            log_file = os.path.join(directory, "app.log")
+            environment = {
+                "APP_LOG_ASYNC": "true",
+                "APP_LOG_FORMAT": "json",
+                "APP_LOG_SAMPLING": f"{self.logger_name}.events=0",
+            }
+            with patch.dict(os.environ, environment), patch("sys.stdout"):
+                logger = configure_logging(log_file, self.logger_name)
+                self.assertIsInstance(logger.handlers[0], BoundedQueueHandler)
+                logger.info("kept %d", 1)
+                logging.getLogger(f"{self.logger_name}.events").info("sampled out")
+                logging_config._stop_listeners()
+            with open(log_file) as f:
+                entries = [json.loads(line) for line in f]
+        self.assertEqual([e["message"] for e in entries], ["kept 1"])
+
+    def test_rotation(self):
+        """Test that the log file is rotated when APP_LOG_MAX_BYTES is set."""
+        with tempfile.TemporaryDirectory() as directory:
+            log_file = os.path.join(directory, "app.log")
+            with patch.dict(os.environ, {"APP_LOG_MAX_BYTES": "200", "APP_LOG_BACKUP_COUNT": "2"}), \
+                    patch("sys.stdout"):
+                logger = configure_logging(log_file, self.logger_name)
+                for i in range(20):
+                    logger.info("line %d", i)
+            self.assertTrue(os.path.exists(log_file + ".1"))
+            self.assertFalse(os.path.exists(log_file + ".3"))
+
+    def test_configure_once_per_process(self):
+        """Test that the handlers are installed once and replaced in a forked process."""
+        with tempfile.TemporaryDirectory() as directory, patch("sys.stdout"):
+            log_file = os.path.join(directory, "app.log")
+            logger = configure_logging(log_file, self.logger_name)
+            handlers = list(logger.handlers)
+            self.assertIs(configure_logging(log_file, self.logger_name), logger)
+            self.assertEqual(logger.handlers, handlers)
+            with patch("os.getpid", return_value=1234):
+                configure_logging(log_file, self.logger_name, per_worker_file=True)
+                logger.info("from the worker")
+            self.assertEqual(len(logger.handlers), 2)
+            self.assertTrue(all(h not in handlers for h in logger.handlers))
+            self.assertIsNone(handlers[1].stream)
+            with open(os.path.join(directory, "app.1234.log")) as f:
+                self.assertIn("from the worker", f.read())
+
+    def test_log_level(self):
+        """Test that the level is read from APP_LOG_LEVEL."""
+        with patch.dict(os.environ, {"APP_LOG_LEVEL": "warning"}), patch("sys.stdout"):
+            self.assertEqual(configure_logging(None, self.logger_name).level, logging.WARNING)
+        with patch.dict(os.environ, {"APP_LOG_LEVEL": "loud"}):
+            self.assertEqual(logging_config.log_level(), logging.INFO)
+
+    def test_collect_worker_logs(self):
+        """Test that the worker log files are merged in the order of the records and deleted."""
+        with tempfile.TemporaryDirectory() as directory:
+            log_file = os.path.join(directory, "app.log")
+            self.assertEqual(worker_log_file_name(log_file, 7), os.path.join(directory, "app.7.log"))
+            with open(log_file, "w") as f:
+                f.write("2026-01-01 10:00:00,000 [INFO] azureaiapp: master\n")
+            with open(worker_log_file_name(log_file, 7) + ".1", "w") as f:
+                f.write("2026-01-01 10:00:01,000 [INFO] azureaiapp: a1\n")
+            with open(worker_log_file_name(log_file, 7), "w") as f:
+                f.write("2026-01-01 10:00:03,000 [ERROR] azureaiapp: a3\nTraceback\n  line\n")
+            with open(worker_log_file_name(log_file, 8), "w") as f:
+                f.write('{"timestamp": "2026-01-01 10:00:02,000", "message": "b2"}\n')
+                f.write('{"timestamp": "2026-01-01 10:00:04,000", "message": "b4"}')
+            self.assertEqual(collect_worker_logs(log_file, [7]), 2)
+            self.assertEqual(collect_worker_logs(log_file), 2)
+            self.assertEqual(collect_worker_logs(log_file), 0)
+            self.assertEqual(os.listdir(directory), ["app.log"])
+            with open(log_file) as f:
+                lines = f.read().splitlines()
+        self.assertEqual(lines, [
+            "2026-01-01 10:00:00,000 [INFO] azureaiapp: master",
+            "2026-01-01 10:00:01,000 [INFO] azureaiapp: a1",
+            "2026-01-01 10:00:03,000 [ERROR] azureaiapp: a3",
+            "Traceback",
+            "  line",
+            '{"timestamp": "2026-01-01 10:00:02,000", "message": "b2"}',
+            '{"timestamp": "2026-01-01 10:00:04,000", "message": "b4"}',
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import InMemoryMetricReader
+from prometheus import render
+
+
+class TestPrometheus(unittest.TestCase):
+    """Tests for the Prometheus text format of the metrics."""
+
+    def test_render(self):
+        """Test that the counters, gauges and histograms are rendered with their labels."""
+        reader = InMemoryMetricReader()
+        meter = MeterProvider(metric_readers=[reader]).get_meter("test")
+        meter.create_counter("chat.runs.cancelled", description="Cancelled runs.").add(2)
+        meter.create_up_down_counter("queue.depth").add(3)
+        histogram = meter.create_histogram("chat.run.duration", unit="ms")
+        histogram.record(7, {"phase": 'the "run"'})
+        histogram.record(20, {"phase": 'the "run"'})
+        text = render(reader.get_metrics_data())
+        self.assertIn("# HELP chat_runs_cancelled_total Cancelled runs.\n", text)
+        self.assertIn("# TYPE chat_runs_cancelled_total counter\nchat_runs_cancelled_total 2\n", text)
+        self.assertIn("# TYPE queue_depth gauge\nqueue_depth 3\n", text)
+        self.assertIn('chat_run_duration_milliseconds_bucket{phase="the \\"run\\"",le="10.0"} 1\n', text)
+        self.assertIn('chat_run_duration_milliseconds_bucket{phase="the \\"run\\"",le="+Inf"} 2\n', text)
+        self.assertIn('chat_run_duration_milliseconds_sum{phase="the \\"run\\""} 27\n', text)
+        self.assertIn('chat_run_duration_milliseconds_count{phase="the \\"run\\""} 2\n', text)
+
+    def test_render_nothing(self):
+        """Test that the empty metrics are rendered as an empty page."""
+        self.assertEqual(render(None), "\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import gc
+import unittest
+from unittest.mock import AsyncMock
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError, ServiceRequestError
+from resilience import CircuitBreaker, CircuitOpenError, ResiliencePolicy
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def get_http_error(status_code):
+    error = HttpResponseError("Mock error")
+    error.status_code = status_code
+    return error
+
+
+class TestResiliencePolicy(unittest.IsolatedAsyncioTestCase):
+    """Tests for the retry, circuit breaker and hedging policy."""
+
+    async def test_retry_idempotent_calls(self):
+        """Test that only the idempotent calls are retried and only on transient errors."""
+        policy = ResiliencePolicy(backoff=0.001)
+        func = AsyncMock(side_effect=[ServiceRequestError("Mock error"), get_http_error(503), "file"])
+        self.assertEqual(await policy.call("files.get", func, idempotent=True), "file")
+        self.assertEqual(func.await_count, 3)
+
+        func = AsyncMock(side_effect=[get_http_error(503), "message"])
+        with self.assertRaises(HttpResponseError):
+            await policy.call("messages.create", func)
+        self.assertEqual(func.await_count, 1)
+
+        func = AsyncMock(side_effect=ResourceNotFoundError("Mock not found"))
+        with self.assertRaises(ResourceNotFoundError):
+            await policy.call("threads.get", func, idempotent=True)
+        self.assertEqual(func.await_count, 1)
+
+    async def test_circuit_opens(self):
+        """Test that the failing operation is short-circuited."""
+        policy = ResiliencePolicy(max_retries=0, failure_threshold=2)
+        func = AsyncMock(side_effect=get_http_error(500))
+        for _ in range(2):
+            with self.assertRaises(HttpResponseError):
+                await policy.call("runs.stream", func)
+        with self.assertRaises(CircuitOpenError) as context:
+            await policy.call("runs.stream", func)
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        self.assertEqual(func.await_count, 2)
+        # The other operations are not affected.
+        self.assertEqual(await policy.call("files.get", AsyncMock(return_value="file")), "file")
+
+    def test_circuit_half_open(self):
+        """Test that one trial call is let through after the reset timeout."""
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        clock.now = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        clock.now = 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.is_open)
+
+    async def test_cancelled_trial_call(self):
+        """Test that a cancelled trial call lets the next call try the operation."""
+        policy = ResiliencePolicy(max_retries=0, failure_threshold=1, reset_timeout=0)
+        with self.assertRaises(HttpResponseError):
+            await policy.call("runs.stream", AsyncMock(side_effect=get_http_error(500)))
+        self.assertTrue(policy.breaker("runs.stream").is_open)
+
+        started = asyncio.Event()
+
+        async def slow_call():
+            started.set()
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(policy.call("runs.stream", slow_call))
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(await policy.call("runs.stream", AsyncMock(return_value="run")), "run")
+        self.assertFalse(policy.breaker("runs.stream").is_open)
+
+    def test_release_trial(self):
+        """Test that only the trial call releases the trial."""
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        # The call was allowed before the circuit opened.
+        closed = breaker.allow()
+        breaker.record_failure()
+        clock.now = 10
+        trial = breaker.allow()
+        self.assertTrue(trial.trial)
+        breaker.release_trial(closed)
+        self.assertIsNone(breaker.allow())
+        breaker.release_trial(trial)
+        self.assertTrue(breaker.allow().trial)
+
+    async def test_hedged_call(self):
+        """Test that the slow call is repeated and the first result wins."""
+        policy = ResiliencePolicy(hedge_delay=0.01)
+        calls = 0
+
+        async def func():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(1 if calls == 1 else 0)
+            return calls
+
+        self.assertEqual(await policy.call("files.get", func, idempotent=True, hedge=True), 2)
+        self.assertEqual(calls, 2)
+
+
+    async def test_cancelled_hedged_call(self):
+        """Test that the call is cancelled with the hedged call, also before it is repeated."""
+        policy = ResiliencePolicy(hedge_delay=10)
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def func():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        task = asyncio.create_task(policy.call("files.get", func, idempotent=True, hedge=True))
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+    async def test_failed_hedged_calls(self):
+        """Test that the error of the first call is raised and no error is left unretrieved."""
+        policy = ResiliencePolicy(max_retries=0, hedge_delay=0.01)
+        errors = [get_http_error(500), get_http_error(503)]
+        unhandled = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+
+        async def func():
+            error = errors.pop(0)
+            await asyncio.sleep(0.02 if error.status_code == 500 else 0)
+            raise error
+
+        with self.assertRaises(HttpResponseError) as context:
+            await policy.call("files.get", func, idempotent=True, hedge=True)
+        self.assertEqual(context.exception.status_code, 500)
+        await asyncio.sleep(0)
+        gc.collect()
+        self.assertEqual(unhandled, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,261 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from api import routes
+from api.admission import AdmissionController
+from api.stream_session import StreamSession, format_event_id
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+def make_message(index: int, status: str = "completed") -> SimpleNamespace:
+    return SimpleNamespace(
+        id=f"msg_{index}",
+        role="assistant" if index % 2 else "user",
+        status=status,
+        created_at=datetime(2026, 1, 1, 0, index, tzinfo=timezone.utc),
+        text_messages=[SimpleNamespace(text=SimpleNamespace(value=f"Message {index}"))],
+        file_citation_annotations=[],
+        url_citation_annotations=[],
+    )
+
+
+class FakeMessages:
+    """The messages of one thread, listed by page as the agent service does."""
+
+    def __init__(self, messages):
+        # The messages, newest first.
+        self.messages = messages
+        self.pages = 0
+
+    def list(self, thread_id, order, limit, retry_total):
+        return SimpleNamespace(by_page=lambda continuation_token=None: self._pages(limit, continuation_token))
+
+    async def _pages(self, limit, after):
+        ids = [message.id for message in self.messages]
+        start = ids.index(after) + 1 if after else 0
+        while start < len(self.messages):
+            self.pages += 1
+            yield iterate(self.messages[start:start + limit])
+            start += limit
+
+    async def get(self, thread_id, message_id, retry_total):
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        raise ResourceNotFoundError("message not found")
+
+
+def make_request(body: bytes = b"", query: bytes = b"", cookie: bytes = b"") -> Request:
+    """Return a chat request with the body."""
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/chat",
+        "headers": [(b"content-type", b"application/json")] + ([(b"cookie", cookie)] if cookie else []),
+        "query_string": query,
+    }
+    return Request(scope, receive)
+
+
+class TestChatAdmission(unittest.IsolatedAsyncioTestCase):
+    """Tests that the chat requests which do not start a run release their admission slot."""
+
+    def setUp(self):
+        self.admission = AdmissionController(limit=1, max_limit=1, max_queue=0)
+        self.agent_client = SimpleNamespace(messages=SimpleNamespace(create=mock.AsyncMock()))
+        self.ai_project = SimpleNamespace(agents=self.agent_client)
+        patches = [
+            mock.patch.object(routes, "admission", self.admission),
+            mock.patch.object(routes, "get_thread_id", mock.AsyncMock(return_value=("thread_1", False))),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def chat(self, body: bytes):
+        return await routes.chat(
+            make_request(body),
+            agent=SimpleNamespace(id="agent_1"),
+            ai_project=self.ai_project,
+            app_insights_conn_str="",
+            thread_pool=None,
+            evaluation_dispatcher=None,
+            _=None,
+        )
+
+    async def test_invalid_body(self):
+        """Test that a request which is not an object is rejected without taking a slot."""
+        for body in (json.dumps([1, 2]).encode(), json.dumps({"message": 1}).encode()):
+            with self.assertRaises(HTTPException) as context:
+                await self.chat(body)
+            self.assertEqual(context.exception.status_code, 400)
+            self.assertEqual(self.admission.active, 0)
+
+    async def test_cancelled_message_creation(self):
+        """Test that the slot is released when the request is cancelled while the message is created."""
+        self.agent_client.messages.create.side_effect = asyncio.CancelledError()
+        with mock.patch.object(routes, "CHAT_FAST_PATH", False):
+            with self.assertRaises(asyncio.CancelledError):
+                await self.chat(json.dumps({"message": "Hello"}).encode())
+        self.assertEqual(self.admission.active, 0)
+
+    async def test_failed_message_creation(self):
+        """Test that the slot is released once when the message cannot be created."""
+        self.agent_client.messages.create.side_effect = RuntimeError("unavailable")
+        with mock.patch.object(routes, "CHAT_FAST_PATH", False):
+            with self.assertRaises(HTTPException) as context:
+                await self.chat(json.dumps({"message": "Hello"}).encode())
+        self.assertEqual(context.exception.status_code, 500)
+        self.assertEqual(self.admission.active, 0)
+
+    async def test_throttled_message_creation(self):
+        """Test that the limit is decreased when the service throttles the message creation."""
+        self.admission = AdmissionController(limit=2, max_limit=2, max_queue=0)
+        self.agent_client.messages.create.side_effect = HttpResponseError(response=SimpleNamespace(
+            status_code=429, reason="Too Many Requests", headers={}, text=lambda: "", request=None))
+        with mock.patch.object(routes, "admission", self.admission), mock.patch.object(routes, "CHAT_FAST_PATH", False):
+            with self.assertRaises(HTTPException):
+                await self.chat(json.dumps({"message": "Hello"}).encode())
+        self.assertEqual((self.admission.active, self.admission.limit), (0, 1))
+
+
+class TestChatHistory(unittest.IsolatedAsyncioTestCase):
+    """Tests for the paged chat history."""
+
+    def setUp(self):
+        self.messages = FakeMessages([make_message(i, "in_progress" if i == 9 else "completed")
+                                      for i in reversed(range(10))])
+        self.ai_project = SimpleNamespace(agents=SimpleNamespace(messages=self.messages))
+        routes.history_cache.clear()
+        self.addCleanup(routes.history_cache.clear)
+        patch = mock.patch.object(routes, "get_thread_id", mock.AsyncMock(return_value=("thread_1", False)))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def history(self, limit=None, before=None):
+        response = await routes.history(
+            make_request(),
+            limit=limit,
+            before=before,
+            ai_project=self.ai_project,
+            agent=SimpleNamespace(id="agent_1"),
+            thread_pool=None,
+            _=None,
+        )
+        return [message["id"] for message in json.loads(response.body)], response.headers.get("X-Next-Before")
+
+    async def test_full_history(self):
+        """Test that the history without a limit has every message, newest first."""
+        ids, next_before = await self.history()
+        self.assertEqual(ids, [f"msg_{i}" for i in reversed(range(10))])
+        self.assertIsNone(next_before)
+
+    async def test_limit_and_before(self):
+        """Test that the pages follow each other and only the needed messages are listed."""
+        ids, next_before = await self.history(limit=4)
+        self.assertEqual(ids, ["msg_9", "msg_8", "msg_7", "msg_6"])
+        self.assertEqual(next_before, "msg_6")
+        self.assertEqual(self.messages.pages, 1)
+
+        ids, next_before = await self.history(limit=4, before=next_before)
+        self.assertEqual(ids, ["msg_5", "msg_4", "msg_3", "msg_2"])
+        self.assertEqual(next_before, "msg_2")
+
+        ids, next_before = await self.history(limit=4, before=next_before)
+        self.assertEqual(ids, ["msg_1", "msg_0"])
+        self.assertIsNone(next_before)
+
+    async def test_unknown_before(self):
+        """Test that an unknown cursor is rejected."""
+        with self.assertRaises(HTTPException) as context:
+            await self.history(limit=4, before="msg_unknown")
+        self.assertEqual(context.exception.status_code, 400)
+
+    async def test_cache(self):
+        """Test that only the messages which will not change are cached, up to the limit per thread."""
+        with mock.patch.object(routes, "HISTORY_CACHE_MESSAGES", 5):
+            await self.history()
+        # The newest message is still being generated.
+        self.assertEqual(sorted(routes.history_cache.get("thread_1")), ["msg_4", "msg_5", "msg_6", "msg_7", "msg_8"])
+        with mock.patch.object(routes, "format_history_messages", wraps=routes.format_history_messages) as formatter:
+            ids, _ = await self.history(limit=3)
+        self.assertEqual(ids, ["msg_9", "msg_8", "msg_7"])
+        self.assertEqual([message.id for message in formatter.call_args.args[1]], ["msg_9"])
+
+
+class TestChatResume(unittest.IsolatedAsyncioTestCase):
+    """Tests for the reconnection of the clients to their run."""
+
+    async def test_resume(self):
+        """Test that a client resumes within the buffer and gets a 410 after the dropped events."""
+        session = StreamSession(iterate([f"data: {i}\n\n" for i in range(10)]), "thread_1", max_events=4)
+        routes.stream_sessions.set(session.stream_id, session)
+        self.addCleanup(routes.stream_sessions.invalidate, session.stream_id)
+        session.start()
+        await asyncio.sleep(0.01)
+
+        response = routes.resume_chat(make_request(), "thread_1", format_event_id(session.stream_id, 6))
+        self.assertEqual(response.status_code, 200)
+        with self.assertRaises(HTTPException) as context:
+            routes.resume_chat(make_request(), "thread_1", format_event_id(session.stream_id, 5))
+        self.assertEqual(context.exception.status_code, 410)
+        with self.assertRaises(HTTPException) as context:
+            routes.resume_chat(make_request(), "thread_2", format_event_id(session.stream_id, 6))
+        self.assertEqual(context.exception.status_code, 404)
+
+    async def test_resume_replaced_thread(self):
+        """Test that a client resumes a run of the thread which replaced the thread of its cookie."""
+        sessions = []
+        start = routes.start_stream_session
+
+        def start_stream_session(frames, thread_id, **kwargs):
+            sessions.append(start(frames, thread_id, **kwargs))
+            self.addCleanup(routes.stream_sessions.invalidate, sessions[-1].stream_id)
+            return sessions[-1]
+
+        patches = [
+            mock.patch.object(routes, "admission", AdmissionController(limit=1, max_limit=1, max_queue=0)),
+            mock.patch.object(routes, "get_thread_id", mock.AsyncMock(return_value=("thread_new", False))),
+            mock.patch.object(routes, "get_result", lambda *args, **kwargs: iterate(["data: 1\n\n"])),
+            mock.patch.object(routes, "start_stream_session", start_stream_session),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        response = await routes.chat(
+            make_request(json.dumps({"message": "Hello"}).encode(), cookie=b"thread_id=thread_old"),
+            agent=SimpleNamespace(id="agent_1"),
+            ai_project=SimpleNamespace(agents=None),
+            app_insights_conn_str="",
+            thread_pool=None,
+            evaluation_dispatcher=None,
+            _=None,
+        )
+        self.assertIn("thread_id=thread_new", response.headers["set-cookie"])
+        self.assertEqual(sessions[0].thread_id, "thread_new")
+        await asyncio.sleep(0.01)
+        resumed = routes.resume_chat(make_request(), "thread_new", format_event_id(sessions[0].stream_id, 0))
+        self.assertEqual(resumed.status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,25 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
+import asyncio
 import csv
 import json
 import os
+import random
+import re
 import tempfile
+import zlib
+from collections import Counter
 import unittest
 from unittest.mock import AsyncMock, patch
 from azure.identity.aio import DefaultAzureCredential
 
-from search_index_manager import SearchIndexManager
+import nltk
+from search_index_manager import (
+    LocalSearchIndexManager, SearchIndexManager, _LocalIndex, _ensure_tokenizer, _json_to_lines)
 from azure.ai.projects.aio import AIProjectClient
 from azure.ai.projects.models._enums import ConnectionType
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 
 from ddt import ddt, data
 
@@ -172,6 +179,8 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
             {'token': 'a', 'title': 'a.txt'},
             {'token': 'b', 'title': 'b.txt'}
         ])
+        mock_serch_client.get_document_count.return_value = 10 ** 6
+        mock_serch_client.get_document.side_effect = ResourceNotFoundError('Absent')
         with patch(
             'search_index_manager.SearchIndexClient',
                 return_value=mock_ix_client):
@@ -192,6 +201,231 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
                 self.assertEqual(search_result,
                                  "a, source: a.txt\n------\nb, source: b.txt")
 
+    async def test_search_waits_for_uploaded_documents_mock(self):
+        """Test that only the first search after upload polls the document count."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        mock_serch_client.search.side_effect = lambda **kwargs: MockAsyncIterator([
+            {'token': 'a', 'title': 'a.txt'}])
+        mock_serch_client.get_document_count.side_effect = [0, 1, 2]
+        mock_serch_client.get_document.side_effect = ResourceNotFoundError('Absent')
+        with patch(
+            'search_index_manager.SearchIndexClient',
+                return_value=mock_ix_client):
+            with patch(
+                'search_index_manager.SearchClient',
+                    return_value=mock_serch_client):
+                with patch('search_index_manager.asyncio.sleep') as mock_sleep:
+                    rag = self._get_mock_rag(AsyncMock())
+                    self.assertTrue(await rag.create_index())
+                    with tempfile.TemporaryDirectory() as d:
+                        embeddings_file = os.path.join(d, 'embeddings.csv')
+                        with open(embeddings_file, 'w', newline='') as fp:
+                            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                            writer.writeheader()
+                            writer.writerow({'token': 'a', 'embedding': '[0, 0]', 'title': 'a.txt'})
+                            writer.writerow({'token': 'b', 'embedding': '[1, 1]', 'title': 'b.txt'})
+                        await rag.upload_documents(embeddings_file)
+                    self.assertEqual(await rag.search('test'), "a, source: a.txt")
+                    self.assertEqual(mock_serch_client.get_document_count.call_count, 3)
+                    self.assertEqual(mock_sleep.call_count, 2)
+                    # Steady state queries do not poll the index.
+                    self.assertEqual(await rag.search('test'), "a, source: a.txt")
+                    self.assertEqual(mock_serch_client.get_document_count.call_count, 3)
+
+    async def test_upload_documents_resume_mock(self):
+        """Test that the upload is batched and resumes after the last acknowledged batch."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        error = HttpResponseError('Mock http error')
+        error.status_code = 400
+        mock_serch_client.upload_documents.side_effect = [[], error, [], []]
+        mock_serch_client.get_document.side_effect = ResourceNotFoundError('Absent')
+        with patch(
+            'search_index_manager.SearchIndexClient',
+                return_value=mock_ix_client):
+            with patch(
+                'search_index_manager.SearchClient',
+                    return_value=mock_serch_client):
+                rag = self._get_mock_rag(AsyncMock())
+                self.assertTrue(await rag.create_index())
+                with tempfile.TemporaryDirectory() as d:
+                    embeddings_file = os.path.join(d, 'embeddings.csv')
+                    checkpoint_file = os.path.join(d, 'checkpoint.json')
+                    with open(embeddings_file, 'w', newline='') as fp:
+                        writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                        writer.writeheader()
+                        for i in range(5):
+                            writer.writerow({'token': str(i), 'embedding': f'[{i}, {i}]', 'title': 'a.txt'})
+                    with self.assertRaisesRegex(HttpResponseError, 'Mock http error'):
+                        await rag.upload_documents(
+                            embeddings_file, batch_size=2, max_concurrency=1, checkpoint_file=checkpoint_file)
+                    with open(checkpoint_file) as fp:
+                        self.assertEqual(json.load(fp)['acknowledged_batches'], 1)
+                    await rag.upload_documents(
+                        embeddings_file, batch_size=2, max_concurrency=1, checkpoint_file=checkpoint_file)
+                    self.assertFalse(os.path.exists(checkpoint_file))
+                batches = [
+                    [doc['embedId'] for doc in call.args[0]]
+                    for call in mock_serch_client.upload_documents.call_args_list]
+                ids = [SearchIndexManager.get_embed_id(str(i), 'a.txt') for i in range(5)]
+                self.assertListEqual(batches, [ids[0:2], ids[2:4], ids[2:4], ids[4:]])
+                self.assertListEqual(
+                    mock_serch_client.upload_documents.call_args_list[-1].args[0][0]['embedding'], [4, 4])
+
+    async def test_upload_documents_deletes_legacy_mock(self):
+        """Test that the documents keyed by their row number are deleted after the full upload."""
+        mock_ix_client = AsyncMock()
+        mock_serch_client = AsyncMock()
+        mock_serch_client.upload_documents.return_value = []
+        mock_serch_client.delete_documents.return_value = []
+        mock_serch_client.get_document.return_value = {'embedId': '0'}
+        mock_serch_client.get_document_count.return_value = 3
+        with patch(
+            'search_index_manager.SearchIndexClient',
+                return_value=mock_ix_client):
+            with patch(
+                'search_index_manager.SearchClient',
+                    return_value=mock_serch_client):
+                rag = self._get_mock_rag(AsyncMock())
+                self.assertTrue(await rag.create_index())
+                with tempfile.TemporaryDirectory() as d:
+                    embeddings_file = os.path.join(d, 'embeddings.csv')
+                    with open(embeddings_file, 'w', newline='') as fp:
+                        writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                        writer.writeheader()
+                        for i in range(3):
+                            writer.writerow({'token': str(i), 'embedding': f'[{i}, {i}]', 'title': 'a.txt'})
+                    await rag.upload_documents(embeddings_file, batch_size=2)
+                mock_serch_client.get_document.assert_awaited_once_with(key='0', selected_fields=['embedId'])
+                # The count of the legacy documents does not make the index ready.
+                mock_serch_client.get_document.side_effect = [{'embedId': '0'}, ResourceNotFoundError('Absent'),
+                                                              ResourceNotFoundError('Absent')]
+                with patch('search_index_manager.asyncio.sleep') as mock_sleep:
+                    self.assertTrue(await rag.wait_until_ready())
+                self.assertEqual(mock_sleep.call_count, 1)
+                mock_serch_client.get_document.side_effect = None
+                deleted = [
+                    [doc['embedId'] for doc in call.args[0]]
+                    for call in mock_serch_client.delete_documents.call_args_list]
+                self.assertListEqual(deleted, [['0', '1'], ['2']])
+
+                mock_serch_client.get_document.side_effect = ResourceNotFoundError('Absent')
+                mock_serch_client.delete_documents.reset_mock()
+                with tempfile.TemporaryDirectory() as d:
+                    embeddings_file = os.path.join(d, 'embeddings.csv')
+                    with open(embeddings_file, 'w', newline='') as fp:
+                        writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                        writer.writeheader()
+                        writer.writerow({'token': 'a', 'embedding': '[0, 0]', 'title': 'a.txt'})
+                    await rag.upload_documents(embeddings_file)
+                mock_serch_client.delete_documents.assert_not_called()
+
+    def test_convert_embeddings_store(self):
+        """Test that the embeddings survive the CSV to binary store round trip."""
+        with tempfile.TemporaryDirectory() as d:
+            csv_file = os.path.join(d, 'embeddings.csv')
+            npy_file = os.path.join(d, 'embeddings.npy')
+            exported_file = os.path.join(d, 'exported.csv')
+            rows = [
+                {'token': f'token, {i}', 'embedding': json.dumps([i + 0.5, i * 2.0]), 'title': f'{i}.md'}
+                for i in range(3)]
+            with open(csv_file, 'w', newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+                writer.writeheader()
+                writer.writerows(rows)
+            self.assertEqual(SearchIndexManager.convert_embeddings_file(csv_file, npy_file), 3)
+            matrix = SearchIndexManager.load_embeddings_matrix(npy_file)
+            self.assertEqual(matrix.shape, (3, 2))
+            self.assertEqual(str(matrix.dtype), 'float32')
+            self.assertTrue(os.path.isfile(SearchIndexManager.get_metadata_file(npy_file)))
+            self.assertEqual(SearchIndexManager.convert_embeddings_file(npy_file, exported_file), 3)
+            with open(exported_file, newline='') as fp:
+                self.assertListEqual(list(csv.DictReader(fp)), rows)
+
+    @data(1, 4)
+    async def test_embed_chunks_order(self, max_concurrency):
+        """Test that concurrent embedding keeps every chunk paired with its own vector."""
+        async def embed(input, dimensions, model):
+            await asyncio.sleep(random.random() / 100)
+            data = [{'index': i, 'embedding': [int(text)]} for i, text in enumerate(input)]
+            random.shuffle(data)
+            return {'data': data}
+
+        embedding_client = AsyncMock()
+        embedding_client.embed.side_effect = embed
+        rag = self._get_mock_rag(embedding_client)
+        chunks = [(str(i), f'{i}.md') for i in range(50)]
+        batches = [chunks[i:i + 3] for i in range(0, len(chunks), 3)]
+        result = [
+            triple async for embedded in rag.embed_chunks(
+                batches, max_concurrency=max_concurrency, requests_per_minute=6000)
+            for triple in embedded]
+        self.assertListEqual(result, [(str(i), f'{i}.md', [i]) for i in range(50)])
+        self.assertEqual(embedding_client.embed.call_count, len(batches))
+
+    async def test_build_embeddings_file_incremental_mock(self):
+        """Test that only the changed chunks are embedded and the delta is emitted."""
+        async def embed(input, dimensions, model):
+            return {'data': [{'index': i, 'embedding': [len(text), 0]} for i, text in enumerate(input)]}
+
+        embedding_client = AsyncMock()
+        embedding_client.embed.side_effect = embed
+        rag = self._get_mock_rag(embedding_client)
+        with tempfile.TemporaryDirectory() as d:
+            out_file = os.path.join(d, 'embeddings.csv')
+            delta_file = os.path.join(d, 'delta.csv')
+            with patch.object(rag, '_iter_chunks', side_effect=lambda *args: MockAsyncIterator(
+                    [('a', '1.md'), ('bb', '1.md')]).__aiter__()):
+                await rag.build_embeddings_file(input_directory=d, output_file=out_file)
+            with patch.object(rag, '_iter_chunks', side_effect=lambda *args: MockAsyncIterator(
+                    [('a', '1.md'), ('ccc', '2.md'), ('a', '1.md')]).__aiter__()):
+                await rag.build_embeddings_file(
+                    input_directory=d, output_file=out_file, incremental=True, delta_file=delta_file)
+            self.assertEqual(embedding_client.embed.call_args_list[-1].kwargs['input'], ['ccc'])
+            with open(out_file, newline='') as fp:
+                rows = [(row['token'], row['title'], json.loads(row['embedding'])) for row in csv.DictReader(fp)]
+            self.assertListEqual(rows, [('ccc', '2.md', [3, 0]), ('a', '1.md', [1, 0])])
+            with open(delta_file, newline='') as fp:
+                self.assertListEqual([row['token'] for row in csv.DictReader(fp)], ['ccc'])
+            with open(SearchIndexManager.get_deletes_file(delta_file)) as fp:
+                self.assertListEqual(json.load(fp), [SearchIndexManager.get_embed_id('bb', '1.md')])
+
+    def test_json_to_lines(self):
+        """Test that the customer JSON files are rendered as text lines for chunking."""
+        document = {'firstName': 'John', 'orders': [{'name': 'Tent', 'total': 700.0}, {'name': 'Boots'}]}
+        self.assertListEqual(
+            list(_json_to_lines(document)),
+            ['firstName: John', 'orders name: Tent', 'orders total: 700.0', 'orders name: Boots'])
+
+    @data(0, 2)
+    async def test_iter_chunks(self, chunking_workers):
+        """Test that the markdown and JSON files are chunked in the order of the files and their sentences."""
+        _ensure_tokenizer()
+        try:
+            nltk.data.find('tokenizers/punkt_tab')
+        except LookupError:
+            self.skipTest("The nltk tokenizer data is not available.")
+        rag = self._get_mock_rag(AsyncMock())
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'b_tent.md'), 'w') as f:
+                f.write("# Alpine Explorer Tent\n"
+                        "The tent sleeps eight people. It has three seasons of use. The poles are aluminum.\n"
+                        "---\n"
+                        "Set it up in ten minutes.\n")
+            with open(os.path.join(d, 'a_customer.json'), 'w') as f:
+                json.dump({'name': 'Jane Doe', 'orders': [{'item': 'Trail boots'}, {'item': 'Camp stove'}]}, f)
+            with open(os.path.join(d, 'ignored.csv'), 'w') as f:
+                f.write("This file is not chunked.")
+            chunks = [chunk async for chunk in rag._iter_chunks(d, 2, chunking_workers=chunking_workers)]
+        self.assertListEqual(chunks, [
+            ('name: Jane Doe orders item: Trail boots', 'a_customer.json'),
+            ('orders item: Camp stove', 'a_customer.json'),
+            ('# Alpine Explorer Tent The tent sleeps eight people.', 'b_tent.md'),
+            ('It has three seasons of use. The poles are aluminum.', 'b_tent.md'),
+            ('Set it up in ten minutes.', 'b_tent.md'),
+        ])
+
     @data(2, 4)
     async def test_build_embeddings_file_mock(self, sentences_per_embedding):
         """Use this test to build
@@ -301,6 +535,122 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
 
         )
 
+class HashingEmbeddingClient:
+    """The offline embedding client, hashing the words of the text to the vector."""
+
+    def __init__(self, dimensions):
+        self._dimensions = dimensions
+
+    def vector(self, text):
+        vector = [0.0] * self._dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode()) % self._dimensions] += 1.0
+        return vector
+
+    async def embed(self, input, dimensions, model):
+        return {'data': [{'index': i, 'embedding': self.vector(text)} for i, text in enumerate(input)]}
+
+
+class TestLocalSearchIndexManager(unittest.IsolatedAsyncioTestCase):
+    """Offline tests of the in-process search backend."""
+
+    CHUNKS = [
+        ('The CozyNights sleeping bag has a temperature rating of 20 degrees.', 'product_info_7.md'),
+        ('The Alpine Explorer Tent is an 8-person, 3-season tent.', 'product_info_8.md'),
+        ('TrekReady hiking boots are waterproof and breathable.', 'product_info_4.md'),
+    ]
+
+    async def _get_rag(self, client, chunks, **kwargs):
+        rag = LocalSearchIndexManager(index_name="local", dimensions=64, model="hashing",
+                                      embedding_client=client, **kwargs)
+        self.assertTrue(await rag.create_index())
+        self.assertFalse(await rag.create_index())
+        embeddings_file = os.path.join(self._dir.name, 'embeddings.csv')
+        with open(embeddings_file, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding', 'title'])
+            writer.writeheader()
+            for token, title in chunks:
+                writer.writerow({'token': token, 'embedding': json.dumps(client.vector(token)), 'title': title})
+        await rag.upload_documents(embeddings_file)
+        return rag
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    async def test_search(self):
+        """Test the vector and the text search."""
+        client = HashingEmbeddingClient(64)
+        rag = await self._get_rag(client, TestLocalSearchIndexManager.CHUNKS, top_k=1)
+        expected = "The CozyNights sleeping bag has a temperature rating of 20 degrees., source: product_info_7.md"
+        question = "What is the temperature rating of the cozynights sleeping bag?"
+        self.assertEqual(await rag.search(question), expected)
+        self.assertEqual(await rag.semantic_search(question), expected)
+        self.assertEqual(await rag.semantic_search("unknown"), "")
+        await rag.delete_index()
+        with self.assertRaisesRegex(ValueError, "Unable to perform the operation as the index is absent.+"):
+            await rag.search(question)
+
+    async def test_result_cache(self):
+        """Test the cache hits for the same and the similar questions and the invalidation on upload."""
+        client = HashingEmbeddingClient(64)
+        rag = await self._get_rag(client, TestLocalSearchIndexManager.CHUNKS, top_k=1, similarity_threshold=0.9)
+        with patch.object(rag, '_search', wraps=rag._search) as mock_search, \
+                patch.object(client, 'embed', wraps=client.embed) as mock_embed:
+            first = await rag.search("What is the temperature rating of the CozyNights sleeping bag?")
+            # The embedding computed to find the similar questions is searched.
+            self.assertEqual(mock_embed.call_count, 1)
+            self.assertEqual(await rag.search("what is the temperature rating of the cozynights  sleeping bag"), first)
+            self.assertEqual(await rag.search("What is the temperature rating for the CozyNights sleeping bag?"), first)
+            self.assertEqual(mock_search.call_count, 1)
+            self.assertDictEqual(rag.get_cache_statistics(), {'hits': 2, 'misses': 1, 'similar_hits': 1, 'size': 1})
+            await rag.upload_documents(os.path.join(self._dir.name, 'embeddings.csv'))
+            self.assertEqual(await rag.search("What is the temperature rating of the CozyNights sleeping bag?"), first)
+            self.assertEqual(mock_search.call_count, 2)
+
+    def test_text_search_ranking(self):
+        """Test that the BM25 scores from the postings rank the documents as the scores of every document."""
+        import numpy as np
+        rng = random.Random(0)
+        words = [f"w{i}" for i in range(50)]
+        documents = {
+            str(i): (' '.join(rng.choice(words) for _ in range(rng.randint(1, 20))), f"{i}.md", [1.0, 0.0])
+            for i in range(300)}
+        index = _LocalIndex("local", documents, 2, ann_threshold=1000, ann_probes=1)
+        document_terms = [Counter(_LocalIndex.terms(f"{token} {title}")) for token, title, _ in documents.values()]
+        lengths = np.array([sum(terms.values()) for terms in document_terms])
+        for query in ("w1 w2 w3", "w7 w7 unknown", "w10 1"):
+            scores = np.zeros(len(documents))
+            for term in set(_LocalIndex.terms(query)):
+                frequencies = np.array([terms[term] for terms in document_terms])
+                df = np.count_nonzero(frequencies)
+                if df:
+                    idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+                    scores += idf * frequencies * 2.2 / (frequencies + 1.2 * (0.25 + 0.75 * lengths / lengths.mean()))
+            expected = sorted(scores[scores > 0], reverse=True)[:10]
+            rows = index.text_search(query, 10)
+            # The documents with equal scores may come in any order.
+            np.testing.assert_allclose(scores[rows], expected, rtol=1e-5)
+        self.assertListEqual(index.text_search("unknown", 10), [])
+
+    async def test_approximate_search(self):
+        """Test that the IVF index finds the exact match of the document."""
+        client = HashingEmbeddingClient(64)
+        chunks = [(f"product {i} feature {i * 7} color {i % 13}", f"{i}.md") for i in range(500)]
+        rag = await self._get_rag(client, chunks, ann_threshold=100, ann_probes=4, top_k=1)
+        for i in range(0, 500, 50):
+            self.assertEqual(await rag.search(chunks[i][0]), f"{chunks[i][0]}, source: {i}.md")
+
+    def test_vector_search_keeps_query(self):
+        """Test that the query embedding of the caller is not normalized in place."""
+        import numpy as np
+        index = _LocalIndex("local", {'1': ('token', '1.md', [3.0, 4.0])}, 2, ann_threshold=1000, ann_probes=1)
+        query = np.array([6.0, 8.0], dtype=np.float32)
+        self.assertListEqual(index.vector_search(query, 1), [0])
+        self.assertListEqual(query.tolist(), [6.0, 8.0])
+
 
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,160 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from azure.core.credentials import AccessToken
+
+import shared_token
+from shared_token import DEFAULT_SCOPE, SharedTokenCache, SharedTokenCredential, TokenRefresher
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def get_credential(clock, lifetime=3600):
+    credential = MagicMock()
+    tokens = iter(range(1000))
+    credential.get_token.side_effect = lambda *scopes, **kwargs: AccessToken(
+        f"token_{next(tokens)}", int(clock() + lifetime))
+    return credential
+
+
+class TestSharedToken(unittest.TestCase):
+    """Tests for the access tokens shared by the gunicorn master."""
+
+    def test_cache(self):
+        """Test that the tokens are stored by scope."""
+        cache = SharedTokenCache(size=256)
+        self.assertIsNone(cache.get(DEFAULT_SCOPE))
+        cache.put(DEFAULT_SCOPE, AccessToken("a", 10))
+        cache.put("other", AccessToken("b", 20))
+        self.assertEqual(cache.get(DEFAULT_SCOPE), AccessToken("a", 10))
+        self.assertEqual(cache.scopes(), [DEFAULT_SCOPE, "other"])
+        with self.assertRaises(ValueError):
+            cache.put("large", AccessToken("x" * 300, 30))
+        self.assertEqual(cache.get("other"), AccessToken("b", 20))
+
+    @unittest.skipUnless(hasattr(os, "fork"), "Requires fork")
+    def test_cache_is_shared_with_forked_process(self):
+        """Test that the token written by the parent is read by the child and the other way around."""
+        cache = SharedTokenCache()
+        cache.put(DEFAULT_SCOPE, AccessToken("parent", 10))
+        pid = os.fork()
+        if pid == 0:
+            ok = cache.get(DEFAULT_SCOPE) == AccessToken("parent", 10)
+            cache.put("child", AccessToken("child", 20))
+            os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(cache.get("child"), AccessToken("child", 20))
+
+    def test_refresher(self):
+        """Test that the tokens are refreshed within the margin, including the scopes added by the workers."""
+        clock = FakeClock()
+        credential = get_credential(clock)
+        cache = SharedTokenCache()
+        refresher = TokenRefresher(cache, credential, margin=300, interval=60, clock=clock)
+        self.assertEqual(refresher.refresh(), 60)
+        self.assertEqual(cache.get(DEFAULT_SCOPE).token, "token_0")
+        cache.put("scope_a scope_b", AccessToken("worker", int(clock() + 330)))
+        # The worker token is refreshed 30 seconds before it enters the margin.
+        self.assertEqual(refresher.refresh(), 30)
+        clock.now += 30
+        refresher.refresh()
+        self.assertEqual(cache.get("scope_a scope_b").token, "token_1")
+        credential.get_token.assert_called_with("scope_a", "scope_b")
+        clock.now += 3270
+        refresher.refresh()
+        self.assertEqual(cache.get(DEFAULT_SCOPE).token, "token_2")
+
+    def test_refresher_failure(self):
+        """Test that a failed refresh keeps the other scopes and is retried."""
+        clock = FakeClock()
+        credential = MagicMock()
+        credential.get_token.side_effect = RuntimeError("unavailable")
+        cache = SharedTokenCache()
+        refresher = TokenRefresher(cache, credential, interval=60, clock=clock)
+        self.assertEqual(refresher.refresh(), 60)
+        self.assertIsNone(cache.get(DEFAULT_SCOPE))
+
+    def test_refresher_thread(self):
+        """Test that the token is acquired on start and the thread stops."""
+        credential = get_credential(time.time)
+        cache = SharedTokenCache()
+        refresher = TokenRefresher(cache, credential)
+        refresher.start()
+        self.assertEqual(cache.get(DEFAULT_SCOPE).token, "token_0")
+        refresher.stop()
+
+    def test_share_tokens_before_fork(self):
+        """Test that the token is acquired without a thread, which is only started by start_refreshing_tokens."""
+        with patch.object(shared_token, "_shared_cache", None), patch.object(shared_token, "_refresher", None):
+            shared_token.share_tokens(get_credential(time.time))
+            self.assertEqual(shared_token.shared_credential(MagicMock()).get_token(DEFAULT_SCOPE).token, "token_0")
+            self.assertNotIn("token-refresher", [thread.name for thread in threading.enumerate()])
+            shared_token.start_refreshing_tokens()
+            self.assertIn("token-refresher", [thread.name for thread in threading.enumerate()])
+            shared_token.stop_sharing_tokens()
+
+    def test_no_fork_during_refresh(self):
+        """Test that the process is forked only once the refresh in progress has finished."""
+        refreshing = threading.Event()
+        refreshed = threading.Event()
+        calls = []
+
+        def get_token(*scopes, **kwargs):
+            calls.append(scopes)
+            # The first token is acquired by start, the next ones by the thread.
+            if len(calls) > 1:
+                refreshing.set()
+                time.sleep(0.2)
+                refreshed.set()
+            # The token is always within the margin, so the thread refreshes it after the minimal delay.
+            return AccessToken("token", int(time.time()))
+
+        credential = MagicMock()
+        credential.get_token.side_effect = get_token
+        refresher = TokenRefresher(SharedTokenCache(), credential, interval=0)
+        refresher.start()
+        try:
+            self.assertTrue(refreshing.wait(timeout=5))
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0)
+            self.assertTrue(refreshed.is_set())
+            os.waitpid(pid, 0)
+        finally:
+            refresher.stop()
+
+    def test_credential(self):
+        """Test that the worker uses the shared token and falls back when it is expiring."""
+        cache = SharedTokenCache()
+        cache.put(DEFAULT_SCOPE, AccessToken("shared", int(time.time() + 3600)))
+        fallback = get_credential(time.time)
+        create_fallback = MagicMock(return_value=fallback)
+        credential = SharedTokenCredential(cache, create_fallback)
+        self.assertEqual(credential.get_token(DEFAULT_SCOPE).token, "shared")
+        create_fallback.assert_not_called()
+
+        cache.put(DEFAULT_SCOPE, AccessToken("expiring", int(time.time() + 30)))
+        self.assertEqual(credential.get_token(DEFAULT_SCOPE).token, "token_0")
+        self.assertEqual(cache.get(DEFAULT_SCOPE).token, "token_0")
+        self.assertEqual(credential.get_token(DEFAULT_SCOPE, claims="c").token, "token_1")
+        self.assertEqual(cache.get(DEFAULT_SCOPE).token, "token_0")
+        self.assertEqual((credential.hits, credential.misses), (1, 1))
+        credential.close()
+        fallback.close.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import unittest
+
+from sse import TextDelta, coalesce_deltas, serialize_sse_event
+
+
+async def generate_events(events, delay=0.0):
+    for event in events:
+        if delay:
+            await asyncio.sleep(delay)
+        yield event
+
+
+def parse(frame):
+    return json.loads(frame[len("data: "):])
+
+
+class TestCoalesceDeltas(unittest.IsolatedAsyncioTestCase):
+    """Tests for merging the message deltas into fewer events."""
+
+    async def test_deltas_are_merged(self):
+        """Test that the first delta is sent at once and the rest are merged before the next event."""
+        end = serialize_sse_event({'type': "stream_end"})
+        events = [TextDelta("Hello"), TextDelta(" wor"), TextDelta("ld"), end]
+        frames = [f async for f in coalesce_deltas(generate_events(events), window=1)]
+        self.assertEqual([parse(f) for f in frames], [
+            {'content': "Hello", 'type': "message"},
+            {'content': " world", 'type': "message"},
+            {'type': "stream_end"},
+        ])
+
+    async def test_window_and_size(self):
+        """Test that the buffered deltas are sent when the window elapses or the buffer is full."""
+        events = [TextDelta("a")] * 5
+        frames = [f async for f in coalesce_deltas(generate_events(events, delay=0.02), window=0.001)]
+        self.assertEqual(len(frames), 5)
+        frames = [f async for f in coalesce_deltas(generate_events(events), window=1, max_chars=2)]
+        self.assertEqual([parse(f)['content'] for f in frames], ["a", "aa", "aa"])
+
+    async def test_backpressure(self):
+        """Test that the source is not read ahead of a slow consumer by more than max_frames."""
+        read = 0
+
+        async def source():
+            nonlocal read
+            for _ in range(100):
+                read += 1
+                yield serialize_sse_event({'type': "thread_run"})
+
+        frames = coalesce_deltas(source(), max_frames=4)
+        await frames.__anext__()
+        await asyncio.sleep(0.01)
+        self.assertLessEqual(read, 6)
+        await frames.aclose()
+
+    async def test_no_coalescing(self):
+        """Test that a zero window sends every delta."""
+        events = [TextDelta("a")] * 3
+        frames = [f async for f in coalesce_deltas(generate_events(events), window=0)]
+        self.assertEqual(len(frames), 3)
+
+
+    async def test_source_closed_on_close(self):
+        """Test that the source has run its cleanup when the closed stream returns."""
+        closed = []
+
+        async def events():
+            try:
+                yield TextDelta("a")
+                await asyncio.sleep(10)
+            finally:
+                closed.append(True)
+
+        stream = coalesce_deltas(events(), window=0)
+        await stream.__anext__()
+        await stream.aclose()
+        self.assertEqual(closed, [True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from stream_session import EventsExpired, StreamSession, format_event_id, parse_event_id
+
+
+async def generate_frames(count, delay=0.0):
+    for i in range(count):
+        if delay:
+            await asyncio.sleep(delay)
+        yield f"data: {i}\n\n"
+
+
+def get_sequence(frame):
+    return parse_event_id(frame.split("\n")[0][len("id: "):])[1]
+
+
+class TestStreamSession(unittest.IsolatedAsyncioTestCase):
+    """Tests for the resumable streams of the runs."""
+
+    def test_event_id(self):
+        """Test that the event IDs are parsed back."""
+        self.assertEqual(parse_event_id(format_event_id("a-b_c", 12)), ("a-b_c", 12))
+        self.assertIsNone(parse_event_id("12"))
+        self.assertIsNone(parse_event_id("abc-x"))
+
+    async def test_replay_after_reconnect(self):
+        """Test that the reconnecting client gets the events it missed and the rest of the run."""
+        session = StreamSession(generate_frames(10, delay=0.001), "thread_1", grace=1)
+        session.start()
+        received = []
+        async for frame in session.subscribe():
+            received.append(frame)
+            if len(received) == 3:
+                break
+        await asyncio.sleep(0.05)
+        self.assertTrue(session.finished)
+        resumed = [frame async for frame in session.subscribe(get_sequence(received[-1]))]
+        self.assertEqual([get_sequence(f) for f in received + resumed], list(range(1, 11)))
+        self.assertTrue(resumed[0].endswith("data: 3\n\n"))
+
+    async def test_abandoned_stream_is_cancelled(self):
+        """Test that the source is cancelled when no client reconnects within the grace period."""
+        cancelled = asyncio.Event()
+
+        async def frames():
+            try:
+                yield "data: 0\n\n"
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        session = StreamSession(frames(), "thread_1", grace=0.01)
+        session.start()
+        async for _ in session.subscribe():
+            break
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        await asyncio.sleep(0)
+        self.assertTrue(session.finished)
+
+    async def test_unsubscribed_stream_is_cancelled(self):
+        """Test that the source is cancelled when no client ever subscribes."""
+        session = StreamSession(generate_frames(1000, delay=0.001), "thread_1", grace=0.01)
+        session.start()
+        await asyncio.sleep(0.1)
+        self.assertTrue(session.finished)
+        self.assertLess(session._last, 1000)
+
+    async def test_cancelled_before_start(self):
+        """Test that the session releases what the source owns when the source never started."""
+        released = []
+        for cancel_after in (0, 0.01):
+            async def frames():
+                try:
+                    yield "data: 0\n\n"
+                    await asyncio.sleep(10)
+                finally:
+                    released.append("source")
+
+            session = StreamSession(frames(), "thread_1", on_not_started=lambda: released.append("session"))
+            session.start()
+            if cancel_after:
+                await asyncio.sleep(cancel_after)
+            session.cancel()
+            await asyncio.sleep(0.01)
+            self.assertTrue(session.finished)
+        self.assertEqual(released, ["session", "source"])
+
+    async def test_resume_after_dropped_events(self):
+        """Test that resuming after the events dropped from the ring buffer is an error, not a gap."""
+        session = StreamSession(generate_frames(10), "thread_1", max_events=4)
+        session.start()
+        await asyncio.sleep(0.01)
+        self.assertTrue(session.finished)
+        self.assertTrue(session.can_resume(6))
+        self.assertFalse(session.can_resume(5))
+        self.assertEqual([get_sequence(f) async for f in session.subscribe(6)], [7, 8, 9, 10])
+        with self.assertRaises(EventsExpired):
+            async for _ in session.subscribe(2):
+                pass
+
+    async def test_ring_buffer_backpressure(self):
+        """Test that the source is not read ahead of a connected client by more than the buffer."""
+        session = StreamSession(generate_frames(100), "thread_1", max_events=4)
+        subscription = session.subscribe()
+        session.start()
+        await subscription.__anext__()
+        await asyncio.sleep(0.01)
+        self.assertLessEqual(session._last, 5)
+        await subscription.aclose()
+        session.cancel()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from thread_cache import ThreadCache, is_not_found
+
+
+class TestThreadCache(unittest.TestCase):
+    """Tests for the cache of known threads."""
+
+    def test_known_threads(self):
+        """Test that only the remembered threads are known and hits count the saved lookups."""
+        cache = ThreadCache()
+        self.assertFalse(cache.is_known("thread_1"))
+        cache.record_lookup(0.2)
+        cache.remember("thread_1")
+        self.assertTrue(cache.is_known("thread_1"))
+        self.assertTrue(cache.is_known("thread_1"))
+        cache.forget("thread_1")
+        self.assertFalse(cache.is_known("thread_1"))
+        statistics = cache.statistics()
+        self.assertEqual(statistics["hits"], 2)
+        self.assertEqual(statistics["lookups"], 1)
+        self.assertAlmostEqual(statistics["saved_ms"], 400)
+
+    def test_replaced_threads(self):
+        """Test that the replaced thread is redirected to the new one."""
+        cache = ThreadCache()
+        cache.remember("thread_1")
+        cache.replace("thread_1", "thread_2")
+        self.assertFalse(cache.is_known("thread_1"))
+        self.assertTrue(cache.is_known("thread_2"))
+        self.assertEqual(cache.replacement("thread_1"), "thread_2")
+        self.assertIsNone(cache.replacement("thread_2"))
+
+    def test_is_not_found(self):
+        """Test that only the not found errors allow to replace the thread."""
+        self.assertTrue(is_not_found(ResourceNotFoundError("Mock not found")))
+        error = HttpResponseError("Mock error")
+        error.status_code = 404
+        self.assertTrue(is_not_found(error))
+        error.status_code = 500
+        self.assertFalse(is_not_found(error))
+        self.assertFalse(is_not_found(ValueError("Mock value error")))
+
+
+if __name__ == "__main__":
+    unittest.main()
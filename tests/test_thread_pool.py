@@ -0,0 +1,73 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import itertools
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from thread_pool import ThreadPool
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def get_agent_client_mock():
+    """Return the agents client mock creating the threads thread_0, thread_1 etc."""
+    counter = itertools.count()
+    agent_client = MagicMock()
+    agent_client.threads.create = AsyncMock(
+        side_effect=lambda: MagicMock(id=f"thread_{next(counter)}"))
+    agent_client.threads.delete = AsyncMock()
+    return agent_client
+
+
+class TestThreadPool(unittest.IsolatedAsyncioTestCase):
+    """Tests for the pool of pre-created threads."""
+
+    async def test_acquire_and_refill(self):
+        """Test that the threads are taken from the pool and the pool is refilled."""
+        agent_client = get_agent_client_mock()
+        pool = ThreadPool(agent_client, size=2)
+        pool.start()
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(pool), 2)
+        self.assertIn(await pool.acquire(), {"thread_0", "thread_1"})
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(agent_client.threads.create.await_count, 3)
+        await pool.close()
+        self.assertEqual(agent_client.threads.delete.await_count, 2)
+        self.assertEqual(pool.hits, 1)
+
+    async def test_stale_threads_are_deleted(self):
+        """Test that the threads older than max_age are not handed out."""
+        agent_client = get_agent_client_mock()
+        clock = FakeClock()
+        pool = ThreadPool(agent_client, size=1, max_age=10, clock=clock)
+        pool.start()
+        await asyncio.sleep(0.01)
+        clock.now = 10
+        self.assertEqual(await pool.acquire(), "thread_1")
+        await asyncio.sleep(0.01)
+        agent_client.threads.delete.assert_awaited_with("thread_0")
+        self.assertEqual(pool.misses, 1)
+        await pool.close(delete_threads=False)
+
+    async def test_acquire_without_pool(self):
+        """Test that a thread is created inline when the pool is empty."""
+        agent_client = get_agent_client_mock()
+        pool = ThreadPool(agent_client, size=0)
+        pool.start()
+        self.assertEqual(await pool.acquire(), "thread_0")
+        await pool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()